@@ -0,0 +1,79 @@
+import os
+import sys
+import glob
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The pipeline scripts import the helper modules of the repository root
+sys.path.insert(0, REPO_ROOT)
+
+import sharding
+
+def chunk_names(num_files):
+    """Generate `num_files` chunk file names like the ones of Pipeline Step 2."""
+    return [f"{i // 7}_{i // 3}_{i}_2020-01-01_P{i % 50}.txt_{i % 3 + 1}.txt" for i in range(num_files)]
+
+def create_files(folder, names, shards):
+    """Create an empty file for every name of `names` in `folder`."""
+    os.makedirs(folder, exist_ok=True)
+    for name in names:
+        with open(sharding.new_file_path(folder, name, shards), "w"):
+            pass
+
+def legacy_list(folder):
+    """The original listing of Pipeline Steps 2, 4 and 5 (a full glob, then the base names)."""
+    return {os.path.basename(path) for path in glob.glob(os.path.join(folder, "*.txt"))}
+
+def scandir_list(folder):
+    """The streaming listing of sharding.iter_files."""
+    return {name for name, _ in sharding.iter_files(folder, ".txt")}
+
+def lookup(folder, names, shards):
+    """Check that every name of `names` exists, as Pipeline Step 4 and the queue scheduler do."""
+    return all(os.path.exists(sharding.file_path(folder, name, shards)) for name in names)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark creating, listing and looking up chunk files in a flat and in a sharded folder.")
+    parser.add_argument("--files", type=int, default=1_000_000, help="number of files per folder")
+    parser.add_argument("--shards", type=int, default=256, help="directory_shards of the sharded folder")
+    parser.add_argument("--lookups", type=int, default=100_000, help="number of random files looked up")
+    parser.add_argument("--directory", default=None, help="where to create the folders (a temporary folder by default); use the file system of the pipeline")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="benchmark_directory_layout_", dir=args.directory)
+    names = chunk_names(args.files)
+    lookup_names = random.Random(0).sample(names, min(args.lookups, len(names)))
+    try:
+        results = {}
+        for layout, shards in (("flat", 0), ("sharded", args.shards)):
+            folder = os.path.join(root, layout)
+            _, create_seconds = timed(create_files, folder, names, shards)
+            listed, scandir_seconds = timed(scandir_list, folder)
+            assert listed == set(names)
+            found, lookup_seconds = timed(lookup, folder, lookup_names, shards)
+            assert found
+            results[layout] = (create_seconds, scandir_seconds, lookup_seconds)
+            line = f"{layout:>7} ({shards} shards): create {len(names) / create_seconds:,.0f} files/s, scandir listing {len(names) / scandir_seconds:,.0f} files/s"
+            if not shards:
+                listed, glob_seconds = timed(legacy_list, folder)
+                assert listed == set(names)
+                line += f", glob listing {len(names) / glob_seconds:,.0f} files/s"
+            print(line + f", lookups {len(lookup_names) / lookup_seconds:,.0f} files/s")
+
+        flat, sharded = results["flat"], results["sharded"]
+        print(f"Sharded vs flat: create {flat[0] / sharded[0]:.2f}x, listing {flat[1] / sharded[1]:.2f}x, lookups {flat[2] / sharded[2]:.2f}x; "
+              f"scandir vs glob listing (flat) {glob_seconds / flat[1]:.2f}x")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
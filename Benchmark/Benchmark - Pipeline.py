@@ -0,0 +1,204 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The pipeline scripts import the helper modules of the repository root
+sys.path.insert(0, REPO_ROOT)
+
+import result_storage
+import synthetic_data
+
+# Every benchmark runs one pipeline script on its own, in a scratch folder, on synthetic data. The
+# benchmarks of a chain need the output of the earlier ones, which are run untimed if not selected.
+BENCHMARKS = {
+    "step1": "Pipeline Step 1 - Prepare Input.py",
+    "step2": "Pipeline Step 2 - Chunk Input.py",
+    "step5": "Pipeline Step 5 - Process Output.py",
+    "post1": "Post Processing Step 1 - Aggregate Output.py",
+    "post2": "Post Processing Step 2 - Generate Note Level Results.py",
+    "post3": "Post Processing Step 3 - Generate Final Results.py",
+}
+CHAINS = [["step1", "step2"], ["step5", "post1", "post2", "post3"]]
+# Settings the synthetic data relies on; the others (xmi_parser, result_format, ...) come from --config
+BENCHMARK_SETTINGS = {
+    "clinical_notes_directory": "./notes",
+    "fuse_prepare_and_chunk": False,
+    "pipeline_mode": "sequential",
+    "manifest": False,
+    "directory_shards": 0,
+    "annotation_cache": False,
+    "prefilter_mode": "off",
+    "metrics": False,
+}
+
+def git_commit():
+    """Return the commit of the repository and whether the working tree has uncommitted changes."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, bool(changes.strip())
+
+# A process started from this one inherits its peak memory, so the scripts are started from a small
+# launcher that reports the CPU time and peak memory of its children: (result path, command...)
+LAUNCHER = """
+import sys, json, resource, subprocess
+code = subprocess.call(sys.argv[2:])
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(sys.argv[1], "w") as f:
+    json.dump({"cpu_seconds": usage.ru_utime + usage.ru_stime, "maxrss": usage.ru_maxrss}, f)
+sys.exit(code)
+"""
+
+def run_script(file_name, workdir):
+    """
+    Run the pipeline script `file_name` in `workdir`, logging to {workdir}/{file_name}.log. Returns
+    the wall seconds, the CPU seconds and the peak resident memory (MB) of the largest process of
+    the script, its worker processes included.
+    """
+    usage_path = os.path.join(workdir, "usage.json")
+    with open(os.path.join(workdir, f"{file_name[:-3]}.log"), "w") as log:
+        start = time.perf_counter()
+        code = subprocess.call([sys.executable, "-c", LAUNCHER, usage_path, sys.executable, os.path.join(REPO_ROOT, file_name)], cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        seconds = time.perf_counter() - start
+    if code != 0:
+        raise RuntimeError(f"'{file_name}' failed with exit code {code}; see {log.name}")
+    with open(usage_path, "r") as f:
+        usage = json.load(f)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak_mb = usage["maxrss"] / (2**20 if sys.platform == "darwin" else 2**10)
+    return seconds, usage["cpu_seconds"], peak_mb
+
+def count_rows(paths, result_format):
+    return sum(len(result_storage.read_table(path, result_format)) for path in paths)
+
+def prepare(name, workdir, config, args):
+    """Create the input of benchmark `name` that the earlier steps of its chain do not; return what it processes as {unit: count}."""
+    num_folders = config["num_processes"]
+    extension = result_storage.EXTENSIONS[config.get("result_format", "csv")]
+    features = list(synthetic_data.load_cui_lists())
+    if name == "step1":
+        total_bytes = synthetic_data.generate_notes(
+            os.path.join(workdir, "notes"), config, args.notes, args.csv_files, args.note_bytes, args.note_bytes_sigma, args.term_rate, args.seed,
+        )
+        return {"notes": args.notes, "bytes": total_bytes}
+    if name == "step2":
+        paths = glob.glob(os.path.join(workdir, "Input", "Input_*", "*.txt"))
+        return {"notes": len(paths), "bytes": sum(map(os.path.getsize, paths))}
+    if name == "step5":
+        folders = [os.path.join(workdir, "Output", f"Output_{i}") for i in range(1, num_folders + 1)]
+        total_bytes = synthetic_data.generate_xmi_files(folders, args.xmi_files, args.xmi_text_bytes, args.hit_rate, seed=args.seed)
+        return {"xmi_files": args.xmi_files, "bytes": total_bytes}
+    if name == "post1":
+        return {"rows": args.xmi_files * len(features)}
+    if name == "post2":
+        paths = glob.glob(os.path.join(workdir, "Result", "Result_*", "*", f"*_aggregated{extension}"))
+        return {"rows": count_rows(paths, config.get("result_format", "csv"))}
+    paths = [os.path.join(workdir, f"fe_feature_detail_table_{feature}{extension}") for feature in features]
+    return {"rows": count_rows(paths, config.get("result_format", "csv"))}
+
+def run_benchmarks(selected, workdir, config, args):
+    """Run the chains of the `selected` benchmarks in `workdir`; return {benchmark: result}."""
+    results = {}
+    for chain in CHAINS:
+        last = max((chain.index(name) for name in selected if name in chain), default=-1)
+        for name in chain[:last + 1]:
+            processed = prepare(name, workdir, config, args)
+            seconds, cpu_seconds, peak_mb = run_script(BENCHMARKS[name], workdir)
+            if name not in selected:
+                continue
+            result = {"script": BENCHMARKS[name], "seconds": round(seconds, 3), "cpu_seconds": round(cpu_seconds, 3), "peak_rss_mb": round(peak_mb, 1), **processed}
+            for unit, count in processed.items():
+                result[f"{unit}_per_second"] = round(count / seconds, 1)
+            if name == "step2":
+                result["chunks"] = len(glob.glob(os.path.join(workdir, "Input_chunk", "Input_*", "*.txt")))
+            results[name] = result
+            rates = ", ".join(
+                f"{count / seconds / 2**20:,.1f} MB/s" if unit == "bytes" else f"{count / seconds:,.0f} {unit}/s"
+                for unit, count in processed.items()
+            )
+            print(f"{name}: {seconds:.2f} s ({cpu_seconds:.1f} s CPU), {rates}, peak RSS {peak_mb:,.0f} MB")
+    return results
+
+def compare(report, baseline_path):
+    """Print the throughput and memory of `report` relative to an earlier result file."""
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    print(f"Compared to {baseline['commit'][:12]}{' (uncommitted changes)' if baseline.get('dirty') else ''}:")
+    if baseline["parameters"] != report["parameters"] or baseline["config"] != report["config"]:
+        print("  Warning: the two runs used different parameters or settings.")
+    for name, result in report["benchmarks"].items():
+        old = baseline["benchmarks"].get(name)
+        if old is None:
+            continue
+        speedup = old["seconds"] / result["seconds"] if result["seconds"] else float("inf")
+        print(f"  {name}: {speedup:.2f}x the throughput, peak RSS {result['peak_rss_mb'] - old['peak_rss_mb']:+,.0f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Pipeline Steps 1, 2 and 5 and the post processing steps on synthetic data.")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="benchmarks to run (all by default)")
+    parser.add_argument("--config", default=os.path.join(REPO_ROOT, "config.json"), help="config.json whose settings the steps run with")
+    parser.add_argument("--processes", type=int, default=4, help="num_processes (and folders) of the steps")
+    parser.add_argument("--notes", type=int, default=20000, help="number of synthetic notes (Steps 1 and 2)")
+    parser.add_argument("--csv-files", type=int, default=4, help="number of csv files the notes are spread over")
+    parser.add_argument("--note-bytes", type=int, default=3000, help="mean note size in bytes")
+    parser.add_argument("--note-bytes-sigma", type=float, default=0.8, help="sigma of the log-normal note size distribution (0 for equal sizes)")
+    parser.add_argument("--term-rate", type=float, default=0.2, help="share of notes that mention a term of the CUI lists")
+    parser.add_argument("--xmi-files", type=int, default=20000, help="number of synthetic XMI files (Step 5 and post processing)")
+    parser.add_argument("--xmi-text-bytes", type=int, default=3000, help="bytes of annotated text per XMI file")
+    parser.add_argument("--hit-rate", type=float, default=0.1, help="share of XMI files with a concept of each feature's CUI list")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument("--directory", default=None, help="where to create the scratch folder (a temporary folder by default); use the file system of the pipeline")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch folder")
+    parser.add_argument("--output", default=None, help="result file (benchmark_pipeline_{commit}.json by default)")
+    parser.add_argument("--compare", default=None, help="an earlier result file to compare the throughput with")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = {**json.load(f), **BENCHMARK_SETTINGS, "num_processes": args.processes}
+    result_storage.check_result_format(config.get("result_format", "csv"))
+    commit, dirty = git_commit()
+    print(f"Benchmarking {commit[:12]}{' with uncommitted changes' if dirty else ''}.")
+
+    workdir = tempfile.mkdtemp(prefix="benchmark_pipeline_", dir=args.directory)
+    try:
+        with open(os.path.join(workdir, "config.json"), "w") as f:
+            json.dump(config, f, indent=4)
+        os.symlink(os.path.join(REPO_ROOT, "CUI"), os.path.join(workdir, "CUI"))
+        results = run_benchmarks(args.benchmarks, workdir, config, args)
+    finally:
+        if args.keep:
+            print(f"Kept the scratch folder {workdir}.")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    parameters = {name: value for name, value in vars(args).items() if name not in ("benchmarks", "config", "directory", "keep", "output", "compare")}
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": parameters,
+        "config": {key: value for key, value in config.items() if not key.startswith("UMLS_")},
+        "benchmarks": results,
+    }
+    output = args.output or f"benchmark_pipeline_{commit[:12]}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved the results to {output}.")
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    sys.exit(main())
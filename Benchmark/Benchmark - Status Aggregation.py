@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The pipeline scripts import the helper modules of the repository root
+sys.path.insert(0, REPO_ROOT)
+
+import pipeline_scripts
+
+STATUS_ORDER = {"A": 5, "N": 4, "H": 3, "X": 2, "U": 1}
+ENCOUNTER_KEYS = ["PatID", "EncounterID", "FeatureID", "Feature", "FE_CodeType", "Confidence"]
+
+def generate_chunk_table(num_rows, chunks_per_note, notes_per_encounter, seed=0):
+    """Generate a chunk-level FE feature table of `num_rows` rows, like the ones of Pipeline Step 5."""
+    rng = np.random.default_rng(seed)
+    note_id = np.arange(num_rows) // chunks_per_note
+    encounter_id = note_id // notes_per_encounter
+    dates = pd.date_range("2015-01-01", periods=3650).strftime("%Y-%m-%d").to_numpy(dtype=object)
+    statuses = np.array(list(STATUS_ORDER), dtype=object)
+    return pd.DataFrame({
+        "PatID": encounter_id // 3,
+        "EncounterID": encounter_id,
+        "NoteID": note_id,
+        "FeatureID": 1005,
+        "Feature_dt": dates[(note_id * 7919) % len(dates)],
+        "Feature": "C0028754",
+        "FE_CodeType": "UC",
+        "ProviderID": (note_id * 31) % 5000,
+        "Confidence": "N",
+        # Mostly U, as in real notes
+        "Feature_Status": statuses[rng.choice(len(statuses), num_rows, p=[0.05, 0.05, 0.02, 0.03, 0.85])],
+    })
+
+def legacy_aggregate_chunks(df):
+    """The original Post Processing Step 1 aggregation (a Python lambda per group)."""
+    grouping_cols = [col for col in df.columns if col != "Feature_Status"]
+    return df.groupby(grouping_cols, as_index=False).agg({
+        "Feature_Status": lambda s: max(s, key=lambda x: STATUS_ORDER.get(x, 0))
+    })
+
+def legacy_aggregate_encounters(df):
+    """The original Post Processing Step 3 aggregation (two groupbys and a merge)."""
+    df_grouped_status = df.groupby(ENCOUNTER_KEYS).agg({"Feature_Status": lambda x: max(x, key=lambda y: STATUS_ORDER[y])}).reset_index()
+    df_grouped_date = df.groupby(ENCOUNTER_KEYS).agg({"Feature_dt": "min", "ProviderID": "first"}).reset_index()
+    return pd.merge(df_grouped_date, df_grouped_status, on=ENCOUNTER_KEYS, how="inner")
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized status aggregation of post processing against the original implementation.")
+    parser.add_argument("--rows", type=int, default=20_000_000, help="number of rows of the synthetic chunk-level table")
+    parser.add_argument("--legacy-rows", type=int, default=1_000_000, help="number of leading rows the (slow) original implementation is timed and checked on")
+    parser.add_argument("--chunks-per-note", type=int, default=3, help="chunk rows per note")
+    parser.add_argument("--notes-per-encounter", type=int, default=4, help="notes per encounter")
+    args = parser.parse_args()
+
+    # The post processing scripts read config.json from the working directory
+    os.chdir(REPO_ROOT)
+    step1 = pipeline_scripts.load_script(os.path.join(REPO_ROOT, "Post Processing Step 1 - Aggregate Output.py"))
+    step3 = pipeline_scripts.load_script(os.path.join(REPO_ROOT, "Post Processing Step 3 - Generate Final Results.py"))
+
+    df, seconds = timed(generate_chunk_table, args.rows, args.chunks_per_note, args.notes_per_encounter)
+    print(f"Generated {len(df):,} chunk rows in {seconds:.1f} s.")
+    sample = df.iloc[:min(args.legacy_rows, len(df))]
+    grouping_cols = [col for col in df.columns if col != "Feature_Status"]
+
+    # Post Processing Step 1: chunk rows -> note rows
+    legacy_notes, legacy_seconds = timed(legacy_aggregate_chunks, sample)
+    current_sample = step1.max_status_by_group(sample, grouping_cols)
+    assert current_sample.equals(legacy_notes)
+    notes, current_seconds = timed(step1.max_status_by_group, df, grouping_cols)
+    print(f"Step 1 on {len(sample):,} rows, outputs are identical. Original: {len(sample) / legacy_seconds:,.0f} rows/s")
+    print(f"Step 1 on {len(df):,} rows -> {len(notes):,} notes in {current_seconds:.1f} s. Vectorized: {len(df) / current_seconds:,.0f} rows/s "
+          f"({len(df) / current_seconds / (len(sample) / legacy_seconds):.1f}x)")
+
+    # Post Processing Step 3: note rows -> encounter rows
+    notes = notes.drop(columns="NoteID")
+    note_sample = notes.iloc[:max(1, len(sample) // args.chunks_per_note)]
+    legacy_encounters, legacy_seconds = timed(legacy_aggregate_encounters, note_sample)
+    current_sample = step3.aggregate_encounters(note_sample)
+    # ProviderID now comes from the earliest note instead of the first one, so only the other columns must match
+    compared = ENCOUNTER_KEYS + ["Feature_dt", "Feature_Status"]
+    assert current_sample[compared].reset_index(drop=True).equals(legacy_encounters[compared])
+    encounters, current_seconds = timed(step3.aggregate_encounters, notes)
+    print(f"Step 3 on {len(note_sample):,} rows, statuses and dates are identical. Original: {len(note_sample) / legacy_seconds:,.0f} rows/s")
+    print(f"Step 3 on {len(notes):,} rows -> {len(encounters):,} encounters in {current_seconds:.1f} s. Single pass: {len(notes) / current_seconds:,.0f} rows/s "
+          f"({len(notes) / current_seconds / (len(note_sample) / legacy_seconds):.1f}x)")
+
+if __name__ == "__main__":
+    sys.exit(main())
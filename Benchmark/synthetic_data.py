@@ -0,0 +1,187 @@
+import os
+import sys
+import math
+import json
+import random
+import argparse
+import pandas as pd
+from xml.sax.saxutils import quoteattr
+
+# Generators of synthetic pipeline inputs for the benchmarks:
+#   notes: clinical-note csv files in the column layout of config.json, with a configurable number
+#          of notes, a log-normal note size distribution and a share of notes mentioning a term of
+#          the CUI lists (so the chunk and status distributions look like real data).
+#   xmi:   cTAKES-style {name}.txt_{chunk_id}.txt.xmi files with a Sofa, one WordToken per word
+#          and refsem:UmlsConcept / textsem:DiseaseDisorderMention elements, where the share of
+#          files with a concept of each feature's CUI list is controlled by `hit_rate`.
+# Both can also be run on their own, e.g. `python3 Benchmark/synthetic_data.py notes --notes 100000`.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CUI_FOLDER = os.path.join(REPO_ROOT, "CUI")
+
+FILLER_WORDS = (
+    "patient presents with stable vital signs and reports mild pain since last visit . "
+    "blood pressure heart rate temperature within normal limits ; continue current medication "
+    "plan follow up in two weeks labs reviewed no acute distress noted on exam alert oriented "
+    "abdomen soft nontender lungs clear to auscultation bilaterally discussed diet exercise"
+).split()
+NEGATIONS = ["", "", "", "no ", "denies ", "history of ", "mother has "]
+
+XMI_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<xmi:XMI xmlns:xmi="http://www.omg.org/XMI" xmlns:cas="http:///uima/cas.ecore"'
+    ' xmlns:refsem="http:///org/apache/ctakes/typesystem/type/refsem.ecore"'
+    ' xmlns:syntax="http:///org/apache/ctakes/typesystem/type/syntax.ecore"'
+    ' xmlns:textsem="http:///org/apache/ctakes/typesystem/type/textsem.ecore" xmi:version="2.0">'
+)
+
+def load_cui_lists(cui_folder=CUI_FOLDER):
+    """Return {feature: [(term, CUI)]} of every ./CUI/{feature}_umls_cui_clean.txt."""
+    cui_lists = {}
+    for file_name in sorted(os.listdir(cui_folder)):
+        if file_name.endswith("_umls_cui_clean.txt"):
+            with open(os.path.join(cui_folder, file_name), "r") as file:
+                entries = [line.rpartition("|") for line in file]
+            cui_lists[file_name[:-len("_umls_cui_clean.txt")]] = [(term.strip(), cui.strip()) for term, _, cui in entries if term.strip()]
+    return cui_lists
+
+def filler_text(rng, num_bytes, line_bytes=80):
+    """Return about `num_bytes` of filler words, broken into lines of about `line_bytes`."""
+    words, size, line = [], 0, 0
+    while size < num_bytes:
+        word = rng.choice(FILLER_WORDS)
+        line += len(word) + 1
+        if line > line_bytes:
+            words.append("\n")
+            line = 0
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+def note_sizes(rng, num_notes, mean_bytes, sigma):
+    """Draw `num_notes` note sizes from a log-normal distribution with mean `mean_bytes` (sigma 0 gives equal sizes)."""
+    mu = math.log(mean_bytes) - sigma ** 2 / 2
+    return [max(16, int(rng.lognormvariate(mu, sigma))) for _ in range(num_notes)]
+
+def generate_notes(folder, config, num_notes, num_files=1, mean_bytes=3000, sigma=0.8, term_rate=0.2, seed=0, cui_lists=None):
+    """
+    Write `num_notes` synthetic notes into `num_files` csv files under `folder`, with the column
+    names of `config`. A share `term_rate` of the notes mentions a term of the CUI lists, sometimes
+    negated or as history. Returns the total bytes of note text.
+    """
+    rng = random.Random(seed)
+    terms = [term for entries in (cui_lists or load_cui_lists()).values() for term, _ in entries]
+    # Slicing one long filler text is much faster than drawing every word of every note
+    corpus = filler_text(rng, 1 << 20)
+    os.makedirs(folder, exist_ok=True)
+    sizes = note_sizes(rng, num_notes, mean_bytes, sigma)
+    total_bytes = 0
+    notes_per_file = -(-num_notes // num_files)
+    for file_id in range(num_files):
+        rows = []
+        for note_id in range(file_id * notes_per_file, min(num_notes, (file_id + 1) * notes_per_file)):
+            start = rng.randrange(max(1, len(corpus) - sizes[note_id]))
+            text = corpus[start:start + sizes[note_id]]
+            if rng.random() < term_rate:
+                position = rng.randrange(len(text) + 1)
+                text = f"{text[:position]} {rng.choice(NEGATIONS)}{rng.choice(terms)} {text[position:]}"
+            encounter_id = note_id // 4
+            rows.append({
+                config["patient_id_column_name"]: encounter_id // 3,
+                config["encounter_id_column_name"]: encounter_id,
+                config["note_id_column_name"]: note_id,
+                config["note_date_column_name"]: f"20{15 + note_id % 10}-{1 + note_id % 12:02d}-{1 + note_id % 28:02d}",
+                config["provider_id_column_name"]: f"P{note_id % 500}",
+                config["note_text_column_name"]: text,
+            })
+            total_bytes += len(text.encode("utf-8"))
+        pd.DataFrame(rows).to_csv(os.path.join(folder, f"notes_{file_id + 1}.csv"), index=False)
+    return total_bytes
+
+def xmi_document(rng, text, concepts):
+    """Return an XMI document for `text` with a WordToken per word and a mention for each (CUI, polarity, subject, historyOf) of `concepts`."""
+    parts = [XMI_HEADER, f'<cas:Sofa xmi:id="1" sofaNum="1" sofaID="_InitialView" mimeType="text" sofaString={quoteattr(text)}/>']
+    next_id, position = 2, 0
+    for word in text.split(" "):
+        parts.append(f'<syntax:WordToken xmi:id="{next_id}" sofa="1" begin="{position}" end="{position + len(word)}" tokenNumber="{next_id - 2}" normalizedForm="{word.strip()}" partOfSpeech="NN"/>')
+        next_id += 1
+        position += len(word) + 1
+    for cui, polarity, subject, history_of in concepts:
+        begin = rng.randrange(max(1, len(text)))
+        parts.append(f'<refsem:UmlsConcept xmi:id="{next_id}" codingScheme="SNOMEDCT_US" cui="{cui}" tui="T047"/>')
+        parts.append(
+            f'<textsem:DiseaseDisorderMention xmi:id="{next_id + 1}" sofa="1" begin="{begin}" end="{begin + 1}"'
+            f' ontologyConceptArr="{next_id}" polarity="{polarity}" conditional="false" subject="{subject}"'
+            f' historyOf="{history_of}" confidence="0.0"/>'
+        )
+        next_id += 2
+    parts.append("</xmi:XMI>")
+    return "".join(parts)
+
+def random_mention(rng, cui):
+    """Return (cui, polarity, subject, historyOf) covering every status of Pipeline Step 5, mostly "A"."""
+    polarity, subject, history_of = rng.choice([("1", "patient", "0")] * 4 + [("-1", "patient", "0"), ("1", "patient", "1"), ("1", "family_member", "0")])
+    return cui, polarity, subject, history_of
+
+def generate_xmi_files(folders, num_files, text_bytes=3000, hit_rate=0.1, other_concepts=2, chunks_per_note=3, seed=0, cui_lists=None):
+    """
+    Write `num_files` synthetic XMI files, `chunks_per_note` per note and the notes round-robin
+    into `folders`, named like the chunks of Pipeline Step 2. Each file gets a concept of a
+    feature's CUI list with probability `hit_rate` per feature, and `other_concepts` concepts that
+    belong to no feature. Returns the total bytes.
+    """
+    rng = random.Random(seed)
+    cui_lists = cui_lists or load_cui_lists()
+    feature_cuis = {feature: [cui for _, cui in entries] for feature, entries in cui_lists.items()}
+    known = {cui for cuis in feature_cuis.values() for cui in cuis}
+    other_cuis = [cui for cui in (f"C{n:07d}" for n in range(9000000, 9001000)) if cui not in known]
+    corpus = filler_text(rng, 1 << 20)
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    total_bytes = 0
+    for i in range(num_files):
+        note_id = i // chunks_per_note
+        encounter_id = note_id // 4
+        name = f"{encounter_id // 3}_{encounter_id}_{note_id}_20{15 + note_id % 10}-01-01_P{note_id % 500}.txt_{i % chunks_per_note + 1}.txt"
+        start = rng.randrange(max(1, len(corpus) - text_bytes))
+        concepts = [random_mention(rng, rng.choice(other_cuis)) for _ in range(other_concepts)]
+        concepts += [random_mention(rng, rng.choice(cuis)) for cuis in feature_cuis.values() if rng.random() < hit_rate]
+        document = xmi_document(rng, corpus[start:start + text_bytes], concepts).encode("utf-8")
+        # The chunks of a note share a folder, as in the pipeline
+        with open(os.path.join(folders[note_id % len(folders)], f"{name}.xmi"), "wb") as file:
+            file.write(document)
+        total_bytes += len(document)
+    return total_bytes
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic clinical-note csv files or cTAKES-style XMI files.")
+    subparsers = parser.add_subparsers(dest="kind", required=True)
+    notes = subparsers.add_parser("notes", help="clinical-note csv files in the column layout of config.json")
+    notes.add_argument("--output", required=True, help="folder of the csv files")
+    notes.add_argument("--config", default=os.path.join(REPO_ROOT, "config.json"), help="config.json with the column names")
+    notes.add_argument("--notes", type=int, default=10000, help="number of notes")
+    notes.add_argument("--files", type=int, default=1, help="number of csv files")
+    notes.add_argument("--note-bytes", type=int, default=3000, help="mean note size in bytes")
+    notes.add_argument("--note-bytes-sigma", type=float, default=0.8, help="sigma of the log-normal note size distribution (0 for equal sizes)")
+    notes.add_argument("--term-rate", type=float, default=0.2, help="share of notes that mention a term of the CUI lists")
+    xmi = subparsers.add_parser("xmi", help="cTAKES-style XMI files")
+    xmi.add_argument("--output", required=True, help="folder of the XMI files")
+    xmi.add_argument("--files", type=int, default=10000, help="number of XMI files")
+    xmi.add_argument("--text-bytes", type=int, default=3000, help="bytes of annotated text per file")
+    xmi.add_argument("--hit-rate", type=float, default=0.1, help="share of files with a concept of each feature's CUI list")
+    for subparser in (notes, xmi):
+        subparser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    if args.kind == "notes":
+        with open(args.config, "r") as f:
+            config = json.load(f)
+        total_bytes = generate_notes(args.output, config, args.notes, args.files, args.note_bytes, args.note_bytes_sigma, args.term_rate, args.seed)
+        print(f"Wrote {args.notes} note(s) ({total_bytes / 2**20:.1f} MB of text) into {args.files} csv file(s) under {args.output}.")
+    else:
+        total_bytes = generate_xmi_files([args.output], args.files, args.text_bytes, args.hit_rate, seed=args.seed)
+        print(f"Wrote {args.files} XMI file(s) ({total_bytes / 2**20:.1f} MB) under {args.output}.")
+
+if __name__ == "__main__":
+    sys.exit(main())
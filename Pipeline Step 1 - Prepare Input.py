@@ -1,66 +1,165 @@
 import os
+import heapq
 import pandas as pd
 import regex
 import json
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
+from note_chunking import chunk_text, write_chunks, chunk_file_name, check_split_mode
+import manifest
+import sharding
+import pipeline_metrics
 
 # Load configuration from config.json
 def load_config(config_path="config.json"):
     with open(config_path, "r") as f:
         return json.load(f)
 
+# Any character outside the valid XML 1.0 character range
+INVALID_XML_10_RE = regex.compile(
+    r'[^\x09\x0A\x0D\x20-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]'
+)
+# The same character class in RE2 syntax, the regex engine of pyarrow-backed string columns
+INVALID_XML_10_RE2 = r'[^\x09\x0A\x0D\x20-\x{D7FF}\x{E000}-\x{FFFD}\x{10000}-\x{10FFFF}]'
+
 def remove_invalid_xml_chars(text):
     """
     Replaces invalid XML 1.0 characters in a given string with spaces.
     """
-    valid_xml_10_re = regex.compile(
-        r'[\x09\x0A\x0D\x20-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]'
-    )
-
-    return ''.join(c if valid_xml_10_re.match(c) else ' ' for c in text)
+    return INVALID_XML_10_RE.sub(' ', text)
 
-def process_csv(args):
-    """Processes a single CSV file and saves rows as text files in designated folders."""
-    input_file, num_folders, patient_id_col, encounter_id_col, note_id_col, note_date_col, provider_id_col, note_text_col = args
-
-    try:
-        df = pd.read_csv(input_file)
+def sanitize_note_texts(note_texts):
+    """
+    Replaces invalid XML 1.0 characters with spaces across a whole Series of note texts, with a
+    single column-wide `str.replace` instead of a Python call per note.
+    """
+    if getattr(note_texts.dtype, "storage", None) == "pyarrow":
+        return note_texts.str.replace(INVALID_XML_10_RE2, ' ', regex=True)
+    return note_texts.str.replace(INVALID_XML_10_RE.pattern, ' ', regex=True)
 
-        df[patient_id_col] = df[patient_id_col].astype(str)
-        df[encounter_id_col] = df[encounter_id_col].astype(str)
-        df[note_id_col] = df[note_id_col].astype(str)
-        df[note_date_col] = df[note_date_col].astype(str)
-        df[provider_id_col] = df[provider_id_col].astype(str)
-        df[note_text_col] = df[note_text_col].astype(str)
+def iter_note_batches(input_file, note_columns, csv_chunk_rows):
+    """
+    Yield the notes of `input_file` as DataFrames of the six `note_columns` converted to strings.
 
-        for row_id, row in df.iterrows():
-            try:
-                patient_id = row[patient_id_col]
-                encounter_id = row[encounter_id_col]
-                note_id = row[note_id_col]
-                note_date = row[note_date_col]
-                provider_id = row[provider_id_col]
-                note_text = row[note_text_col]
+    If `csv_chunk_rows` is positive, the file is streamed in batches of at most `csv_chunk_rows`
+    rows, only `note_columns` are loaded and every value is read verbatim as a string, so the
+    memory used is bounded by the batch size rather than the file size. Otherwise the whole
+    file is loaded at once with pandas' default type inference.
+    """
+    if csv_chunk_rows and csv_chunk_rows > 0:
+        batches = pd.read_csv(input_file, usecols=list(dict.fromkeys(note_columns)), dtype=str, chunksize=csv_chunk_rows)
+    else:
+        batches = [pd.read_csv(input_file)]
 
-                note_text = remove_invalid_xml_chars(note_text)
+    for df in batches:
+        yield pd.DataFrame({col: df[col].astype(str) for col in dict.fromkeys(note_columns)})
 
-                folder_index = row_id % num_folders + 1
-                output_folder = os.path.join("Input", f"Input_{folder_index}")
+def new_folder_heap(num_folders, file_position):
+    """
+    Build the min-heap of (assigned bytes, tie-breaker, folder_index) used by balanced folder
+    assignment. The tie-breaker rotates with `file_position` so that CSV files processed in
+    parallel do not all start filling the same folders.
+    """
+    folder_heap = [(0, (i - file_position) % num_folders, i + 1) for i in range(num_folders)]
+    heapq.heapify(folder_heap)
+    return folder_heap
 
-                os.makedirs(output_folder, exist_ok=True)
+def assign_balanced_folders(note_sizes, folder_heap):
+    """
+    Greedy least-loaded bin packing: assign each note (largest first) to the folder with the
+    fewest assigned bytes so far. Returns the folder index of each note and updates `folder_heap`.
+    """
+    folders = [0] * len(note_sizes)
+    for i in sorted(range(len(note_sizes)), key=note_sizes.__getitem__, reverse=True):
+        load, tie_breaker, folder_index = folder_heap[0]
+        heapq.heapreplace(folder_heap, (load + note_sizes[i], tie_breaker, folder_index))
+        folders[i] = folder_index
+    return folders
 
-                output_file_name = f"{patient_id}_{encounter_id}_{note_id}_{note_date}_{provider_id}.txt"
-                output_file_path = os.path.join(output_folder, output_file_name)
-                with open(output_file_path, "w", encoding="utf-8") as file:
-                    file.write(str(note_text))
-            except Exception as e:
-                print(f"Error processing row {row_id} in file {input_file}: {e}")
+def process_csv(args):
+    """
+    Processes a single CSV file and saves rows as text files in designated folders.
+    If `chunk_size_bytes` is set (fused mode), each note is chunked in memory instead and its
+    chunks are written straight to ./Input_chunk/Input_{folder_index}, exactly as
+    `Pipeline Step 2 - Chunk Input.py` would name them. If `directory_shards` is set, every
+    file goes into its shard subdirectory of the folder.
+
+    Notes are assigned to folders round robin by row, or by their size in bytes if
+    `folder_assignment` is "balanced". With `use_manifest`, the notes (and chunks) of every
+    batch are recorded in the manifest in one transaction. The notes, chunks and bytes written
+    are recorded to the metrics file `metrics_path`. Returns a status message and the number of
+    note bytes assigned to each folder.
+    """
+    input_file, file_position, num_folders, patient_id_col, encounter_id_col, note_id_col, note_date_col, provider_id_col, note_text_col, csv_chunk_rows, chunk_size_bytes, folder_assignment, use_manifest, directory_shards, chunk_split_mode, metrics_path = args
+    note_columns = [patient_id_col, encounter_id_col, note_id_col, note_date_col, provider_id_col, note_text_col]
+    folder_bytes = [0] * num_folders
+    folder_heap = new_folder_heap(num_folders, file_position)
+    connection = manifest.open_manifest() if use_manifest else None
 
-        return f"Processed file: {input_file}"  # Return message for tqdm tracking
+    try:
+        with pipeline_metrics.Timer(metrics_path, "step1", unit="file", key=os.path.basename(input_file)) as timer:
+            row_id = 0
+            for df in iter_note_batches(input_file, note_columns, csv_chunk_rows):
+                df[note_text_col] = sanitize_note_texts(df[note_text_col])
+                note_sizes = df[note_text_col].str.encode("utf-8").str.len().tolist()
+
+                if folder_assignment == "balanced":
+                    folders = assign_balanced_folders(note_sizes, folder_heap)
+                else:
+                    folders = [(row_id + i) % num_folders + 1 for i in range(len(df))]
+
+                manifest_notes, manifest_chunks = [], []
+                for folder_index, note_size, (patient_id, encounter_id, note_id, note_date, provider_id, note_text) in zip(
+                    folders, note_sizes, df[note_columns].itertuples(index=False, name=None)
+                ):
+                    try:
+                        output_file_name = f"{patient_id}_{encounter_id}_{note_id}_{note_date}_{provider_id}.txt"
+
+                        if chunk_size_bytes:
+                            output_folder = os.path.join("Input_chunk", f"Input_{folder_index}")
+                            os.makedirs(output_folder, exist_ok=True)
+                            num_chunks = write_chunks(chunk_text(str(note_text), chunk_size_bytes, chunk_split_mode), output_file_name, output_folder, directory_shards)
+                            manifest_chunks.extend(
+                                (folder_index, chunk_file_name(output_file_name, chunk_id), output_file_name)
+                                for chunk_id in range(1, num_chunks + 1)
+                            )
+                        else:
+                            output_folder = os.path.join("Input", f"Input_{folder_index}")
+                            os.makedirs(output_folder, exist_ok=True)
+                            output_file_path = sharding.new_file_path(output_folder, output_file_name, directory_shards)
+                            with open(output_file_path, "w", encoding="utf-8") as file:
+                                file.write(str(note_text))
+                        manifest_notes.append((folder_index, output_file_name, patient_id, encounter_id, note_id, note_date, provider_id))
+                        folder_bytes[folder_index - 1] += note_size
+                    except Exception as e:
+                        print(f"Error processing row {row_id} in file {input_file}: {e}")
+                    row_id += 1
+
+                if connection is not None:
+                    with connection:
+                        manifest.add_notes(connection, manifest_notes)
+                        manifest.add_chunks(connection, manifest_chunks)
+                timer.add(notes=len(manifest_notes), bytes=sum(note_sizes))
+                if chunk_size_bytes:
+                    timer.add(chunks=len(manifest_chunks))
+            timer.add(files=1)
+
+        return f"Processed file: {input_file}", folder_bytes  # Return message for tqdm tracking
 
     except Exception as e:
-        return f"Error processing file {input_file}: {e}"  # Return error message for tqdm
+        return f"Error processing file {input_file}: {e}", folder_bytes  # Return error message for tqdm
+    finally:
+        if connection is not None:
+            connection.close()
+
+def report_folder_bytes(folder_bytes, folder_assignment):
+    """Print the note bytes assigned to each folder and how skewed the assignment is."""
+    print(f"Note bytes assigned per folder ({folder_assignment}):")
+    for folder_index, num_bytes in enumerate(folder_bytes, start=1):
+        print(f"  Input_{folder_index}: {num_bytes} bytes")
+    mean_bytes = sum(folder_bytes) / len(folder_bytes)
+    if mean_bytes:
+        print(f"Min/mean/max bytes per folder: {min(folder_bytes)}/{mean_bytes:.0f}/{max(folder_bytes)} (max/mean skew {max(folder_bytes) / mean_bytes:.3f})")
 
 def main(config_path="config.json"):
     config = load_config(config_path)
@@ -74,8 +173,18 @@ def main(config_path="config.json"):
     note_text_col = config["note_text_column_name"]
     num_processes = config["num_processes"]
     num_folders = num_processes
-
-    input_main_folder = "Input"
+    csv_chunk_rows = config.get("csv_chunk_rows", 0)
+    # In fused mode notes are chunked here and Pipeline Step 2 has nothing left to do
+    chunk_size_bytes = config["note_chunk_size_bytes"] if config.get("fuse_prepare_and_chunk", False) else 0
+    folder_assignment = config.get("folder_assignment", "round_robin")
+    use_manifest = config.get("manifest", False)
+    directory_shards = config.get("directory_shards", 0)
+    chunk_split_mode = config.get("chunk_split_mode", "line")
+    metrics_path = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+    if chunk_size_bytes:
+        check_split_mode(chunk_split_mode, chunk_size_bytes)
+
+    input_main_folder = "Input_chunk" if chunk_size_bytes else "Input"
     os.makedirs(input_main_folder, exist_ok=True)
 
     output_main_folder = "Output"
@@ -87,18 +196,26 @@ def main(config_path="config.json"):
     for i in range(1, num_folders + 1):
         os.makedirs(os.path.join(output_main_folder, f"Output_{i}"), exist_ok=True)
 
+    if use_manifest:
+        # Create the manifest before the processes write to it
+        manifest.open_manifest().close()
+
     csv_files = sorted([os.path.join(clinical_notes_dir, f) for f in os.listdir(clinical_notes_dir) if f.endswith(".csv")])
     print(f"Found {len(csv_files)} CSV files.")
 
     args = [
-        (file, num_folders, patient_id_col, encounter_id_col, note_id_col, note_date_col, provider_id_col, note_text_col)
-        for file in csv_files
+        (file, file_position, num_folders, patient_id_col, encounter_id_col, note_id_col, note_date_col, provider_id_col, note_text_col, csv_chunk_rows, chunk_size_bytes, folder_assignment, use_manifest, directory_shards, chunk_split_mode, metrics_path)
+        for file_position, file in enumerate(csv_files)
     ]
 
-    with Pool(processes=num_processes) as pool:
-        # Use tqdm with `imap_unordered` for better progress tracking
-        for _ in tqdm(pool.imap_unordered(process_csv, args), total=len(args), desc="Processing CSV files", unit="file"):
-            pass  # tqdm automatically updates progress
+    total_folder_bytes = [0] * num_folders
+    with pipeline_metrics.Timer(metrics_path, "step1", total=len(csv_files), total_counter="files"):
+        with Pool(processes=num_processes) as pool:
+            # Use tqdm with `imap_unordered` for better progress tracking
+            for _, folder_bytes in tqdm(pool.imap_unordered(process_csv, args), total=len(args), desc="Processing CSV files", unit="file"):
+                total_folder_bytes = [total + new for total, new in zip(total_folder_bytes, folder_bytes)]
+
+    report_folder_bytes(total_folder_bytes, folder_assignment)
 
     print(f"All {num_processes} processes have finished processing the input. Pipeline Step 1 complete.")
 
@@ -1,7 +1,12 @@
 import os
-import glob
 import multiprocessing
 import json
+from note_chunking import iter_chunks, write_chunks, chunk_file_name, check_split_mode
+import manifest
+import sharding
+import pipeline_metrics
+import work_batches
+from tqdm import tqdm
 
 # Load configuration from config.json
 def load_config(config_path="config.json"):
@@ -10,7 +15,14 @@ def load_config(config_path="config.json"):
 
 config = load_config()
 CHUNK_SIZE_BYTES = config["note_chunk_size_bytes"]
+CHUNK_SPLIT_MODE = config.get("chunk_split_mode", "line")
 NUM_PROCESSES = config["num_processes"]
+USE_MANIFEST = config.get("manifest", False)
+DIRECTORY_SHARDS = config.get("directory_shards", 0)
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+# Notes chunked per batch (see work_batches.py); with USE_MANIFEST, a batch is recorded in one transaction
+MIN_BATCH_NOTES = 50
+MAX_BATCH_NOTES = 1000
 BASE_INPUT = "./Input"
 BASE_OUTPUT = "./Input_chunk"
 
@@ -19,83 +31,94 @@ def ensure_directory_exists(path: str):
     if not os.path.isdir(path):
         os.makedirs(path, exist_ok=True)
 
-def chunk_file(input_path: str, output_folder: str, chunk_size_bytes: int = CHUNK_SIZE_BYTES):
+def chunk_file(input_path: str, output_folder: str, chunk_size_bytes: int = CHUNK_SIZE_BYTES, shards: int = DIRECTORY_SHARDS):
     """
     Read a text file line by line, group lines into chunks up to `chunk_size_bytes`,
-    and write each chunk to a new file under `output_folder`.
-    Each chunk is named {original_filename}_{chunk_id}.txt.
+    and write each chunk to a new file under `output_folder` (in its shard subdirectory if
+    `shards` is set). Each chunk is named {original_filename}_{chunk_id}.txt.
     
-    A single line larger than `chunk_size_bytes` will occupy a chunk by itself.
+    A single line larger than `chunk_size_bytes` will occupy a chunk by itself, unless
+    CHUNK_SPLIT_MODE is "hard_cap" (see note_chunking.iter_chunks).
+    Returns the number of chunks written.
     """
     ensure_directory_exists(output_folder)
 
     # e.g., if input_path = ".../somefile.txt", original_name = "somefile.txt"
     original_name = os.path.basename(input_path)
-    base_name, ext = os.path.splitext(original_name)  # e.g. ("somefile", ".txt")
-
-    chunk_id = 1
-    buffer_lines = []
-    buffer_size = 0  # track bytes in current chunk
 
     with open(input_path, "r", encoding="utf-8") as infile:
-        for line in infile:
-            # Calculate the size (in bytes) of this line (including the newline if present)
-            line_bytes = len(line.encode("utf-8"))
-
-            # If adding this line would exceed chunk_size_bytes, flush what we have so far
-            # BUT if buffer is empty, we have to put this line alone in a chunk (even if > chunk_size_bytes).
-            if buffer_lines and (buffer_size + line_bytes > chunk_size_bytes):
-                # Write current buffer to a chunk file
-                out_name = f"{original_name}_{chunk_id}.txt"
-                out_path = os.path.join(output_folder, out_name)
-                with open(out_path, "w", encoding="utf-8") as out_f:
-                    out_f.writelines(buffer_lines)
-
-                chunk_id += 1
-                buffer_lines = []
-                buffer_size = 0
-
-            # Now add the current line to the buffer (even if it alone exceeds chunk_size_bytes).
-            buffer_lines.append(line)
-            buffer_size += line_bytes
+        return write_chunks(iter_chunks(infile, chunk_size_bytes, CHUNK_SPLIT_MODE), original_name, output_folder, shards)
 
-        # After reading all lines, if anything remains in the buffer, flush it
-        if buffer_lines:
-            out_name = f"{original_name}_{chunk_id}.txt"
-            out_path = os.path.join(output_folder, out_name)
-            with open(out_path, "w", encoding="utf-8") as out_f:
-                out_f.writelines(buffer_lines)
-
-def process_input_folder(folder_index: int):
+def list_notes(folder_index: int):
     """
-    Process all .txt files in ./Input/Input_{folder_index}.
-    Chunk each file into ~5 KB pieces (line boundary–aware) and write them to
-    ./Input_chunk/Input_{folder_index}.
+    Return the notes to chunk in ./Input/Input_{folder_index}, as (file name, path), listing the
+    folder in a single streaming os.scandir pass. With USE_MANIFEST, the notes are the ones the
+    manifest records as ingested into the folder instead.
     """
     input_folder = os.path.join(BASE_INPUT, f"Input_{folder_index}")
+    if not USE_MANIFEST:
+        return list(sharding.iter_files(input_folder, ".txt"))
+    connection = manifest.open_manifest()
+    note_names = manifest.list_notes(connection, folder_index, "ingested")
+    connection.close()
+    return [(name, sharding.file_path(input_folder, name, DIRECTORY_SHARDS)) for name in note_names]
+
+def chunk_notes(batch):
+    """
+    Chunk a batch of notes, (folder_index, [(file name, path), ...]), into ~5 KB pieces (line
+    boundary–aware) under ./Input_chunk/Input_{folder_index}, removing each input file once it is
+    chunked. With USE_MANIFEST, the chunks of the batch are recorded in one transaction before the
+    input files are removed. The notes, chunks and bytes chunked are recorded to the metrics file.
+    Returns (folder_index, number of notes, number of chunks).
+    """
+    folder_index, txt_files = batch
     output_folder = os.path.join(BASE_OUTPUT, f"Input_{folder_index}")
-
-    ensure_directory_exists(output_folder)
-
-    txt_files_before = glob.glob(os.path.join(input_folder, "*.txt"))
-    for txt_file in txt_files_before:
-        chunk_file(txt_file, output_folder, CHUNK_SIZE_BYTES)
-
-    txt_files_after = glob.glob(os.path.join(output_folder, "*.txt"))
-    print(f"[Folder {folder_index}] Finished chuncking {len(txt_files_before)} file(s) into {len(txt_files_after)} file(s).")
-
-    # Delte the original input files
-    for txt_file in txt_files_before:
-        os.remove(txt_file)
-    print(f"[Folder {folder_index}] Finished removing {len(txt_files_before)} input files")
-    print(f"[Folder {folder_index}] Finished processing.")
+    chunks = []
+    with pipeline_metrics.Timer(METRICS_PATH, "step2", unit="folder", key=folder_index) as timer:
+        for name, txt_file in txt_files:
+            note_bytes = os.path.getsize(txt_file)
+            note_chunks = chunk_file(txt_file, output_folder, CHUNK_SIZE_BYTES)
+            chunks.extend((folder_index, chunk_file_name(name, chunk_id), name) for chunk_id in range(1, note_chunks + 1))
+            timer.add(notes=1, chunks=note_chunks, bytes=note_bytes)
+        if USE_MANIFEST:
+            connection = manifest.open_manifest()
+            with connection:
+                manifest.add_chunks(connection, chunks)
+            connection.close()
+        # Delete the original input files once their chunks are recorded
+        for _, txt_file in txt_files:
+            os.remove(txt_file)
+    return folder_index, len(txt_files), len(chunks)
 
 def main():
+    """
+    Chunk the notes of every ./Input/Input_{folder_index}. The processes take batches of notes of
+    any folder from a shared queue (see work_batches.py), so that a folder with more or larger
+    notes than the others does not hold up the step.
+    """
+    check_split_mode(CHUNK_SPLIT_MODE, CHUNK_SIZE_BYTES)
     folder_indices = range(1, NUM_PROCESSES + 1)
-
-    with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
-        pool.map(process_input_folder, folder_indices)
-
+    if USE_MANIFEST:
+        # Create the manifest before the processes open it
+        manifest.open_manifest().close()
+
+    folder_counts = {folder_index: [0, 0] for folder_index in folder_indices}
+    with pipeline_metrics.Timer(METRICS_PATH, "step2"):
+        with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+            folder_notes = dict(zip(folder_indices, pool.map(list_notes, folder_indices)))
+            for folder_index in folder_indices:
+                ensure_directory_exists(os.path.join(BASE_OUTPUT, f"Input_{folder_index}"))
+            total = sum(map(len, folder_notes.values()))
+            batch_notes = work_batches.batch_size(total, NUM_PROCESSES, MIN_BATCH_NOTES, MAX_BATCH_NOTES)
+            batches = work_batches.split_batches(folder_notes, batch_notes)
+            for folder_index, num_notes, num_chunks in tqdm(pool.imap_unordered(chunk_notes, batches), total=len(batches), desc="Chunking notes", unit="batch"):
+                folder_counts[folder_index][0] += num_notes
+                folder_counts[folder_index][1] += num_chunks
+
+    for folder_index, (num_notes, num_chunks) in folder_counts.items():
+        print(f"[Folder {folder_index}] Finished chuncking {num_notes} file(s) into {num_chunks} file(s).")
+        print(f"[Folder {folder_index}] Finished removing {num_notes} input files")
+        print(f"[Folder {folder_index}] Finished processing.")
     print(f"All {NUM_PROCESSES} processes have finished chunking the input. Pipeline Step 2 complete.")
 
 if __name__ == "__main__":
@@ -12,6 +12,11 @@ USER=$(jq -r '.UMLS_username' "$CONFIG_FILE")
 PASS=$(jq -r '.UMLS_password' "$CONFIG_FILE")
 KEY=$(jq -r '.UMLS_API_key' "$CONFIG_FILE")
 PROCESS=$(jq -r '.num_processes' "$CONFIG_FILE")
+SCHEDULER=$(jq -r '.ctakes_scheduler // "static"' "$CONFIG_FILE")
+WORKERS=$(jq -r ".ctakes_workers // $PROCESS" "$CONFIG_FILE")
+SHARDS=$(jq -r '.directory_shards // 0' "$CONFIG_FILE")
+METRICS=$(jq -r 'if .metrics == false then "false" else "true" end' "$CONFIG_FILE")
+METRICS_PATH="./pipeline_metrics.jsonl"
 INPUT="./Input_chunk"
 OUTPUT="./Output"
 
@@ -29,22 +34,44 @@ fi
 
 echo "Found $num_folders input folders. Processing with $PROCESS parallel jobs."
 
-# Ensure the cTAKES directory exists
-if [ ! -d "./cTAKES" ]; then 
-    mkdir -p "./cTAKES" 
+# cTAKES reads flat folders; only the queue scheduler stages sharded folders into flat ones
+if [ "$SHARDS" != "0" ] && [ "$SCHEDULER" != "queue" ]; then
+  echo "Error: \"directory_shards\" requires \"ctakes_scheduler\": \"queue\"."
+  exit 1
+fi
+
+# The static scheduler runs one cTAKES process per folder, the queue scheduler one per worker
+if [ "$SCHEDULER" == "queue" ]; then
+  num_installs=$WORKERS
+else
+  num_installs=$num_folders
 fi
 
-for id in $(seq 1 $((num_folders)))
-do
-  # Check if ./cTAKES/apache-ctakes-4.0.0.1_${id} does not exist
-  if [ ! -d "./cTAKES/apache-ctakes-4.0.0.1_${id}" ]; then  
-      cp -r apache-ctakes-4.0.0.1 ./cTAKES/apache-ctakes-4.0.0.1_${id}
+# Provision (if needed) and verify one cTAKES folder ./cTAKES/apache-ctakes-4.0.0.1_${id} per process
+if [ "$(jq -r '.ctakes_provisioning // "copy"' "$CONFIG_FILE")" != "none" ]; then
+  if ! python3 -u provision_ctakes.py $num_installs; then
+    exit 1
   fi
-done
+fi
+
+if [ "$SCHEDULER" == "queue" ]; then
+  # Workers pull batches of chunk files from a shared queue until all folders are annotated
+  python3 -u ctakes_scheduler.py
+  exit $?
+fi
+
+# Append a record to the metrics file (see pipeline_metrics.py): event, id, unit, key, then extra JSON fields
+record_metrics() {
+  if [ "$METRICS" == "true" ]; then
+    jq -nc --argjson time "$(date +%s.%N)" --arg event "$1" --arg id "$2" --argjson unit "$3" --argjson key "$4" --argjson extra "${5:-{\}}" --argjson pid $BASHPID \
+      '{time: $time, stage: "step3", event: $event, pid: $pid, id: $id, unit: $unit, key: $key} + $extra' >> "$METRICS_PATH"
+  fi
+}
 
 # Initialize counters
 running_jobs=0
 folder_index=0
+record_metrics start "step3-$start_time" null null "{\"total\": $num_folders, \"total_counter\": \"folders\"}"
 
 # Function to clean up finished processes
 check_jobs() {
@@ -66,13 +93,21 @@ while [ $folder_index -lt $num_folders ]; do
       mkdir -p "${OUTPUT}/Output_${id}" 
   fi
 
-  # Run the command for each folder in the background
-  ./cTAKES/apache-ctakes-4.0.0.1_${id}/bin/runClinicalPipeline.sh \
-    -i ${input_folder} \
-    --xmiOut "../../${OUTPUT}/Output_${id}" \
-    --user $USER \
-    --pass $PASS \
-    --key $KEY &
+  # Run the command for each folder in the background, recording its wall time and XMI files
+  (
+    folder_start=$(date +%s)
+    record_metrics start "step3-folder-$id-$folder_start" '"folder"' $id
+    ./cTAKES/apache-ctakes-4.0.0.1_${id}/bin/runClinicalPipeline.sh \
+      -i ${input_folder} \
+      --xmiOut "../../${OUTPUT}/Output_${id}" \
+      --user $USER \
+      --pass $PASS \
+      --key $KEY
+    ok=$([ $? -eq 0 ] && echo true || echo false)
+    xmi_files=$(find "${OUTPUT}/Output_${id}" -name '*.xmi' | wc -l)
+    record_metrics end "step3-folder-$id-$folder_start" '"folder"' $id \
+      "{\"ok\": $ok, \"wall_seconds\": $(( $(date +%s) - folder_start )), \"counters\": {\"folders\": 1, \"xmi_files\": $xmi_files}}"
+  ) &
   
   echo "Started processing ${input_folder}"
 
@@ -90,6 +125,7 @@ end_time=$(date +%s)
 
 # Calculate the total execution time in seconds
 execution_time=$((end_time - start_time))
+record_metrics end "step3-$start_time" null null "{\"ok\": true, \"wall_seconds\": $execution_time}"
 
 echo "All processes have completed cTAKES annotation. Pipeline Step 3 complete."
 echo "Total execution time: ${execution_time} seconds."
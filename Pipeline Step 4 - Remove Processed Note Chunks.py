@@ -1,9 +1,11 @@
 import os
-import glob
-import shutil
-import random
 import multiprocessing
 import json
+import manifest
+import sharding
+import pipeline_metrics
+import work_batches
+from tqdm import tqdm
 
 # Load configuration from config.json
 def load_config(config_path="config.json"):
@@ -12,47 +14,95 @@ def load_config(config_path="config.json"):
 
 config = load_config()
 NUM_PROCESSES = config["num_processes"]
+USE_MANIFEST = config.get("manifest", False)
+DIRECTORY_SHARDS = config.get("directory_shards", 0)
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
 BASE_INPUT = "./Input_chunk"
 BASE_OUTPUT = "./Output"
+# Chunks checked and removed per batch (see work_batches.py)
+MIN_BATCH_FILES = 100
+MAX_BATCH_FILES = 10000
 
-def process_folder(i):
+def list_chunks(i):
+    """
+    Return the chunks of ./Input_chunk/Input_{i} as (file name, path, has XMI). Both folders are
+    listed in a single streaming os.scandir pass each. With USE_MANIFEST, the chunks are looked up
+    in the manifest instead: the chunks recorded as annotated have an XMI, and whether the chunks
+    recorded as chunked have one (None) is left to remove_chunks.
+    """
     input_folder = os.path.join(BASE_INPUT, f"Input_{i}")
     output_folder = os.path.join(BASE_OUTPUT, f"Output_{i}")
+    if not USE_MANIFEST:
+        output_set = {name[:-4] for name, _ in sharding.iter_files(output_folder, ".xmi")}  # remove ".xmi"
+        return [(name, txt_path, name in output_set) for name, txt_path in sharding.iter_files(input_folder, ".txt")]
 
-    # 1. Gather text files (.txt) in input_folder
-    input_txt_paths = glob.glob(os.path.join(input_folder, "*.txt"))
-    input_filenames = [os.path.basename(p) for p in input_txt_paths]
+    connection = manifest.open_manifest()
+    chunked = manifest.list_chunks(connection, i, "chunked")
+    annotated = manifest.list_chunks(connection, i, "annotated")
+    connection.close()
+    return [
+        (name, sharding.file_path(input_folder, name, DIRECTORY_SHARDS), state)
+        for names, state in ((chunked, None), (annotated, True)) for name in names
+    ]
 
-    # 2. Gather xmi files in output_folder and strip ".xmi"
-    output_xmi_paths = glob.glob(os.path.join(output_folder, "*.xmi"))
-    output_filenames = [os.path.basename(p)[:-4] for p in output_xmi_paths]  # remove ".xmi"
-
-    input_set = set(input_filenames)
-    output_set = set(output_filenames)
-
-    # 3. Determine which input files are missing corresponding output
-    missing_set = input_set - output_set  # Those that do NOT have corresponding XMI
-    found_set = input_set & output_set    # Those that DO have corresponding XMI
-
-    found_count = len(found_set)
-
-    # Print how many files are processed and missing for this folder
-    missing_count = len(missing_set)
-    print(f"[Folder {i}] Processed {found_count} output file(s); Missing {missing_count} output file(s).")
-
-    # Delete the input text files that have corresponding XMI
-    for fname in found_set:
-        txt_path = os.path.join(input_folder, fname)
-        if os.path.exists(txt_path):
-            os.remove(txt_path)
-    print(f"[Folder {i}] Finished removing {found_count} output file(s)")
-    print(f"[Folder {i}] Finished processing.")
+def remove_chunks(batch):
+    """
+    Delete the input files of the chunks of a batch, (folder_index, [(file name, path, has XMI), ...]),
+    that have an XMI. With USE_MANIFEST, the chunks recorded as chunked that now have an XMI are
+    recorded as annotated (the queue scheduler records them itself). The chunks removed and missing
+    are recorded to the metrics file. Returns (folder_index, processed, missing, removed).
+    """
+    i, chunks = batch
+    output_folder = os.path.join(BASE_OUTPUT, f"Output_{i}")
+    processed = missing = removed = 0
+    newly_annotated = []
+    with pipeline_metrics.Timer(METRICS_PATH, "step4", unit="folder", key=i) as timer:
+        for name, txt_path, has_xmi in chunks:
+            if has_xmi is None:
+                has_xmi = os.path.exists(sharding.file_path(output_folder, name + ".xmi", DIRECTORY_SHARDS))
+                if has_xmi:
+                    newly_annotated.append(name)
+            if not has_xmi:
+                missing += 1
+                continue
+            processed += 1
+            if os.path.exists(txt_path):
+                os.remove(txt_path)
+                removed += 1
+        if newly_annotated:
+            connection = manifest.open_manifest()
+            with connection:
+                manifest.set_chunk_state(connection, i, newly_annotated, "annotated")
+            connection.close()
+        timer.add(chunks=len(chunks), removed=removed, missing=missing)
+    return i, processed, missing, removed
 
 def main():
+    """
+    Delete the chunks of every ./Input_chunk/Input_{i} that have an XMI. The processes take batches
+    of chunks of any folder from a shared queue (see work_batches.py), so that a folder with more
+    chunks than the others does not hold up the step.
+    """
     folder_indices = range(1, NUM_PROCESSES + 1)
+    if USE_MANIFEST:
+        # Create the manifest before the processes open it
+        manifest.open_manifest().close()
+    folder_counts = {i: [0, 0, 0] for i in folder_indices}
     with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
-        pool.map(process_folder, folder_indices)
+        folder_chunks = dict(zip(folder_indices, pool.map(list_chunks, folder_indices)))
+        total = sum(map(len, folder_chunks.values()))
+        batch_files = work_batches.batch_size(total, NUM_PROCESSES, MIN_BATCH_FILES, MAX_BATCH_FILES)
+        batches = work_batches.split_batches(folder_chunks, batch_files)
+        with pipeline_metrics.Timer(METRICS_PATH, "step4", total=total, total_counter="chunks"):
+            for i, processed, missing, removed in tqdm(pool.imap_unordered(remove_chunks, batches), total=len(batches), desc="Removing chunks", unit="batch"):
+                folder_counts[i][0] += processed
+                folder_counts[i][1] += missing
+                folder_counts[i][2] += removed
 
+    for i, (processed, missing, removed) in folder_counts.items():
+        print(f"[Folder {i}] Processed {processed} output file(s); Missing {missing} output file(s).")
+        print(f"[Folder {i}] Finished removing {removed} output file(s)")
+        print(f"[Folder {i}] Finished processing.")
     print(f"All {NUM_PROCESSES} processes have finished. Pipeline Step 4 complete.")
 
 if __name__ == "__main__":
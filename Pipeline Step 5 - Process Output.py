@@ -1,10 +1,30 @@
 import os
-import glob
+import time
+import queue
 import tarfile
+import threading
 import pandas as pd
 import multiprocessing
 import xml.etree.ElementTree as ET
 import json
+import result_storage
+import manifest
+import sharding
+import annotation_cache
+import lexical_prefilter
+import pipeline_metrics
+import work_batches
+from tqdm import tqdm
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Load configuration from config.json
 def load_config(config_path="config.json"):
@@ -16,58 +36,163 @@ config = load_config()
 NUM_PROCESSES = config["num_processes"]
 BASE_OUTPUT = "./Output"
 BASE_RESULT = "./Result"
+XMI_PARSER = config.get("xmi_parser", "etree")
+# What happens to the XMI files once they are processed: "off" deletes them, "compressed" keeps
+# them in a compressed tar archive under ./Output_archive, "failed" keeps only the ones that
+# could not be parsed under ./Output_failed
+XMI_ARCHIVE_MODE = config.get("xmi_archive_mode", "off")
+XMI_ARCHIVE_COMPRESSION = config.get("xmi_archive_compression", "gzip")
+BASE_ARCHIVE = "./Output_archive"
+# Suffix of an XMI file handed to the archive, so that no listing of ./Output picks it up again
+ARCHIVING_SUFFIX = ".archiving"
+BASE_FAILED = "./Output_failed"
+RESULT_FORMAT = config.get("result_format", "csv")
+USE_MANIFEST = config.get("manifest", False)
+DIRECTORY_SHARDS = config.get("directory_shards", 0)
+ANNOTATION_CACHE = config.get("annotation_cache", False)
+ANNOTATION_CACHE_MAX_ENTRIES = config.get("annotation_cache_max_entries", 1000000)
+PREFILTER_MODE = config.get("prefilter_mode", "off")
+PREFILTER_SYNONYMS = config.get("prefilter_synonyms", [])
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+# XMI files parsed per batch (see work_batches.py)
+MIN_BATCH_FILES = 50
+XMI_BATCH_FILES = 10000
+
+if XMI_PARSER == "lxml" and lxml_etree is None:
+    print("lxml is not installed; falling back to the 'iterparse' XMI parser.")
+    XMI_PARSER = "iterparse"
+
+if XMI_ARCHIVE_COMPRESSION == "zstd" and zstandard is None:
+    print("zstandard is not installed; falling back to gzip for the XMI archive.")
+    XMI_ARCHIVE_COMPRESSION = "gzip"
+
+# Features annotated in one run: feature name -> (FeatureID, Feature CUI)
+FEATURES = {
+    "obesity": (1005, "C0028754"),
+    "substance_abuse": (1006, "C0740858"),
+}
 
-def get_cui_list(feature):
-    cui_list = []
+# The custom ranking for Feature_Status
+STATUS_ORDER = {"A": 5, "N": 4, "H": 3, "X": 2, "U": 1}
+
+# Define namespace map
+NAMESPACES = {
+    'refsem': 'http:///org/apache/ctakes/typesystem/type/refsem.ecore',
+    'textsem': 'http:///org/apache/ctakes/typesystem/type/textsem.ecore'
+}
+XMI_ID = '{http://www.omg.org/XMI}id'
+UMLS_CONCEPT_TAG = f"{{{NAMESPACES['refsem']}}}UmlsConcept"
+DISEASE_DISORDER_MENTION_TAG = f"{{{NAMESPACES['textsem']}}}DiseaseDisorderMention"
+SOFA_TAG = "{http:///uima/cas.ecore}Sofa"
+
+def get_cui_set(feature):
+    """Read the CUIs of `feature` from ./CUI/{feature}_umls_cui_clean.txt into a frozenset."""
     with open(f'./CUI/{feature}_umls_cui_clean.txt', 'r') as file:
-        lines = file.readlines()
-        for line in lines:
-            cui_list.append(line.split("|")[-1].strip())
-    return cui_list
-
-def assign_status(xmi_file, cui_list):
-    status = "U"
-    order = {"A": 5, "N": 4, "H": 3, "X": 2, "U": 1}
-    # Load and parse the XMI file
-    tree = ET.parse(xmi_file)
-    root = tree.getroot()
-    
-    # Define namespace map
-    namespaces = {
-        'refsem': 'http:///org/apache/ctakes/typesystem/type/refsem.ecore',
-        'textsem': 'http:///org/apache/ctakes/typesystem/type/textsem.ecore'
-    }
-    
-    # Extract xmi:id
-    target_ids = []
-    for concept in root.findall(".//refsem:UmlsConcept", namespaces):
-        cui = concept.get('cui')
-        if cui in cui_list:
-            target_ids.append(concept.get('{http://www.omg.org/XMI}id'))
-    
-    # Get polarity, conditional, subject, and historyOf from textsem:DiseaseDisorderMention fields
-    for target_id in target_ids:
-        for mention in root.findall(".//textsem:DiseaseDisorderMention", namespaces):
-            ontology_concepts = mention.get('ontologyConceptArr')
-            if ontology_concepts and target_id in ontology_concepts.split():
-                confidence = mention.get('confidence')
-                polarity = mention.get('polarity')
-                conditional = mention.get('conditional')
-                subject = mention.get('subject')
-                historyOf = mention.get('historyOf')
-                if polarity == '1' and conditional == 'false' and subject == 'patient' and historyOf == '0':
-                    status = "A"
-                    return status
-                elif polarity == '-1' and conditional == 'false' and subject == 'patient' and historyOf == '0':
-                    status = "N" if order[status] < order["N"] else status
-                elif polarity == '1' and conditional == 'false' and subject == 'patient' and historyOf == '1':
-                    status = "H" if order[status] < order["H"] else status
-                elif polarity == '1' and conditional == 'false' and subject != 'patient' and historyOf == '0':
-                    status = "X" if order[status] < order["X"] else status
-                else:
-                    status = "U" if order[status] < order["U"] else status
-
-    return status
+        return frozenset(line.split("|")[-1].strip() for line in file)
+
+def load_cui_sets(features=FEATURES):
+    """Load the CUI set of every feature once, keyed by feature name."""
+    return {feature: get_cui_set(feature) for feature in features}
+
+CUI_SETS = load_cui_sets()
+CUI_FINGERPRINT = annotation_cache.fingerprint(CUI_SETS)
+# Chunks without a match of this need no cTAKES (see lexical_prefilter.py)
+PREFILTER = lexical_prefilter.TermMatcher(lexical_prefilter.load_terms(FEATURES) + PREFILTER_SYNONYMS) if PREFILTER_MODE != "off" else None
+
+def mention_status(mention):
+    """Map the polarity, conditional, subject and historyOf fields of a DiseaseDisorderMention to a status."""
+    polarity = mention.get('polarity')
+    conditional = mention.get('conditional')
+    subject = mention.get('subject')
+    historyOf = mention.get('historyOf')
+    if polarity == '1' and conditional == 'false' and subject == 'patient' and historyOf == '0':
+        return "A"
+    elif polarity == '-1' and conditional == 'false' and subject == 'patient' and historyOf == '0':
+        return "N"
+    elif polarity == '1' and conditional == 'false' and subject == 'patient' and historyOf == '1':
+        return "H"
+    elif polarity == '1' and conditional == 'false' and subject != 'patient' and historyOf == '0':
+        return "X"
+    return "U"
+
+def iter_xmi_annotations(xmi_file, parser=XMI_PARSER):
+    """
+    Yield (tag, element) for every UmlsConcept and DiseaseDisorderMention in `xmi_file`.
+
+    parser="etree" builds the full ElementTree. parser="iterparse" (or "lxml") streams the
+    file instead and clears every top-level element (Sofa text, tokens, sentences, ...) as
+    soon as it ends, so memory stays flat however large the XMI is. Elements must not be
+    used after the generator resumes.
+    """
+    if parser == "etree":
+        root = ET.parse(xmi_file).getroot()
+        for concept in root.iterfind(".//refsem:UmlsConcept", NAMESPACES):
+            yield UMLS_CONCEPT_TAG, concept
+        for mention in root.iterfind(".//textsem:DiseaseDisorderMention", NAMESPACES):
+            yield DISEASE_DISORDER_MENTION_TAG, mention
+        return
+
+    if parser == "lxml":
+        events = lxml_etree.iterparse(xmi_file, events=("start", "end"), huge_tree=True)
+    else:
+        events = ET.iterparse(xmi_file, events=("start", "end"))
+
+    root = None
+    depth = 0
+    for event, elem in events:
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth > 0 and elem.tag in (UMLS_CONCEPT_TAG, DISEASE_DISORDER_MENTION_TAG):
+            yield elem.tag, elem
+        if depth == 1:
+            # Drop the finished top-level element (and everything before it) from the tree
+            root.clear()
+
+def assign_statuses(xmi_file, cui_sets=CUI_SETS, parser=XMI_PARSER):
+    """
+    Parse `xmi_file` once and return {feature: status} for every feature in `cui_sets`.
+    The status of a feature is the highest ranked status (see STATUS_ORDER) among the
+    DiseaseDisorderMentions that reference a UmlsConcept whose CUI belongs to the feature.
+    """
+    statuses = {feature: "U" for feature in cui_sets}
+
+    # Index the xmi:id of every matching UmlsConcept to the features it belongs to, and keep
+    # (status, concept ids) of every mention, since a streamed mention may precede its concepts
+    concept_features = {}
+    mentions = []
+    for tag, elem in iter_xmi_annotations(xmi_file, parser):
+        if tag == UMLS_CONCEPT_TAG:
+            cui = elem.get('cui')
+            features = [feature for feature, cui_set in cui_sets.items() if cui in cui_set]
+            if features:
+                concept_features.setdefault(elem.get(XMI_ID), []).extend(features)
+        else:
+            ontology_concepts = elem.get('ontologyConceptArr')
+            if ontology_concepts:
+                mentions.append((mention_status(elem), ontology_concepts.split()))
+    if not concept_features:
+        return statuses
+
+    # Resolve each DiseaseDisorderMention against the index in a single pass
+    for status, concept_ids in mentions:
+        for feature in {feature for concept_id in concept_ids for feature in concept_features.get(concept_id, ())}:
+            if STATUS_ORDER[status] > STATUS_ORDER[statuses[feature]]:
+                statuses[feature] = status
+
+    return statuses
+
+def read_document_text(xmi_file):
+    """Return the text cTAKES annotated in `xmi_file` (its Sofa string)."""
+    with open(xmi_file, "rb") as f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == SOFA_TAG:
+                return elem.get("sofaString", "")
+    return ""
 
 def ensure_directory_exists(path):
     """Ensure that `path` directory exists; if not, create it."""
@@ -88,132 +213,365 @@ def parse_filename(xmi_file):
 
     parts = basename.split("_")
     # 5 parts => patient_id, encounter_id, note_id, note_date, provider_id
-    # 6 parts => + chunk_id
+    # 6 parts => + chunk_id (the note part of a chunk name keeps its ".txt")
     if len(parts) == 5:
         patient_id, encounter_id, note_id, note_date, provider_id = parts
     elif len(parts) == 6:
         patient_id, encounter_id, note_id, note_date, provider_id, _ = parts
+        # Without it, the ProviderID of chunks would end in ".txt" (see the README Output section)
+        provider_id = provider_id.removesuffix(".txt")
     else:
         raise ValueError(f"Unexpected filename format: {os.path.basename(xmi_file)}")
 
     return patient_id, encounter_id, note_id, note_date, provider_id
 
-def process_output_folder(folder_index):
+# Columns of the chunk-level FE feature tables
+RESULT_COLUMNS = [
+    "PatID", "EncounterID", "NoteID", "FeatureID", "Feature_dt", "Feature",
+    "FE_CodeType", "ProviderID", "Confidence", "Feature_Status"
+]
+
+def build_feature_rows(metadata, statuses):
+    """Return {feature: row} for one chunk, given its (patient_id, encounter_id, note_id, note_date, provider_id)."""
+    patient_id, encounter_id, note_id, note_date, provider_id = metadata
+    return {
+        feature: [
+            patient_id,         # PatID
+            encounter_id,       # EncounterID
+            note_id,            # NoteID
+            feature_id,         # FeatureID
+            note_date,          # Feature_dt
+            feature_cui,        # Feature
+            "UC",               # FE_CodeType
+            provider_id,        # ProviderID
+            "N",                # Confidence
+            statuses[feature]   # Feature_Status
+        ]
+        for feature, (feature_id, feature_cui) in FEATURES.items()
+    }
+
+def append_feature_rows(folder_index, feature_rows, result_format=RESULT_FORMAT):
     """
-    Incrementally process new XMI files under ./Output/Output_{folder_index}.
-    1) Create (if needed) ./Result/Result_{folder_index}.
-    2) For each new XMI file, parse the name, create 1 obesity row + 1 substance row.
-    3) Append the XMI files to the existing or new tar archive (./Output/Output_{folder_index}.tar), then remove the XMI file.
-    4) Append the new rows to existing or new CSVs:
-         ./Result/fe_feature_detail_table_obesity_{folder_index}.csv
-         ./Result/fe_feature_detail_table_substance_abuse_{folder_index}.csv
-    5) Remove the tar archive to save space if no errors occurred.
+    Append the new rows of each feature to existing or new CSVs:
+         ./Result/Result_{folder_index}/obesity/fe_feature_detail_table_obesity_{folder_index}.csv
+         ./Result/Result_{folder_index}/substance_abuse/fe_feature_detail_table_substance_abuse_{folder_index}.csv
+    With a columnar result_format, add them as a new part file of the partitioned tables
+    ./Result/Result_{folder_index}/{feature}/fe_feature_detail_table_{feature}_{folder_index}/ instead.
     """
-    output_folder = os.path.join(BASE_OUTPUT, f"Output_{folder_index}")
     result_folder = os.path.join(BASE_RESULT, f"Result_{folder_index}")
-    ensure_directory_exists(result_folder)
-    result_folder_obesity = os.path.join(result_folder, "obesity")
-    result_folder_substance_abuse = os.path.join(result_folder, "substance_abuse")
-    ensure_directory_exists(result_folder_obesity)
-    ensure_directory_exists(result_folder_substance_abuse)
-
-    xmi_files = glob.glob(os.path.join(output_folder, "*.xmi"))
-    if not xmi_files:
-        print(f"[Output_{folder_index}] No new XMI files found.")
-        return
+    for feature, rows in feature_rows.items():
+        ensure_directory_exists(os.path.join(result_folder, feature))
+        df_new = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+        table_name = os.path.join(result_folder, feature, f"fe_feature_detail_table_{feature}_{folder_index}")
 
-    # We'll store the new rows for obesity and substance in lists
-    obesity_rows = []
-    substance_rows = []
+        if result_format != "csv":
+            if rows:
+                result_storage.write_part(df_new, table_name, result_format)
+            continue
 
-    # Append or create the existing tar file
-    tar_name = f"Output_{folder_index}.tar"
-    tar_path = os.path.join(output_folder, tar_name)
+        csv_path = f"{table_name}.csv"
+        # If file doesn't exist, write with header. If it does, append without header.
+        if os.path.exists(csv_path):
+            df_new.to_csv(csv_path, mode="a", header=False, index=False)
+        else:
+            df_new.to_csv(csv_path, mode="w", header=True, index=False)
 
-    # open in append mode 'a' => uncompressed tar only
-    with tarfile.open(tar_path, mode="a") if os.path.exists(tar_path) else tarfile.open(tar_path, mode="w") as tar:
-        for xmi_path in xmi_files:
-            patient_id, encounter_id, note_id, note_date, provider_id = parse_filename(xmi_path)
+class XmiArchiver:
+    """
+    Moves processed XMI files into a new compressed tar archive
+    ./Output_archive/Output_{folder_index}/Output_{folder_index}_{timestamp}.tar.gz (or .tar.zst)
+    on a background thread, so that compression overlaps with parsing. A stage keeps one archiver per
+    folder for the whole run (see archive_xmi_files), so each run writes one archive per folder.
+    """
 
-            # ----- Obesity row -----
-            obesity_cui_list = get_cui_list("obesity")
-            try:
-                obesity_status = assign_status(xmi_path, obesity_cui_list)
-            except:
-                obesity_status = "U"
-            obesity_row = [
-                patient_id,         # PatID
-                encounter_id,       # EncounterID
-                note_id,            # NoteID
-                1005,               # FeatureID for obesity
-                note_date,          # Feature_dt
-                "C0028754",         # Feature
-                "UC",               # FE_CodeType
-                provider_id,        # ProviderID
-                "N",                # Confidence
-                obesity_status      # Feature_Status
-            ]
-            obesity_rows.append(obesity_row)
-
-            # ----- Substance Abuse row -----
-            sub_cui_list = get_cui_list("substance_abuse")
+    def __init__(self, folder_index, compression=XMI_ARCHIVE_COMPRESSION):
+        archive_folder = os.path.join(BASE_ARCHIVE, f"Output_{folder_index}")
+        ensure_directory_exists(archive_folder)
+        extension = "tar.zst" if compression == "zstd" else "tar.gz"
+        self.path = os.path.join(archive_folder, f"Output_{folder_index}_{time.time_ns()}.{extension}")
+        self.file = open(self.path, "wb")
+        if compression == "zstd":
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.file)
+            self.tar = tarfile.open(fileobj=self.stream, mode="w|")
+        else:
+            self.stream = None
+            self.tar = tarfile.open(fileobj=self.file, mode="w|gz")
+        self.queue = queue.Queue(maxsize=1000)
+        self.error = None
+        self.count = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while (xmi_path := self.queue.get()) is not None:
+                self.tar.add(xmi_path, arcname=os.path.basename(xmi_path)[:-len(ARCHIVING_SUFFIX)])
+                os.remove(xmi_path)
+        except Exception as e:
+            self.error = e
+            # Keep taking the queued files (leaving them in place), so that add() never blocks
+            while self.queue.get() is not None:
+                pass
+        finally:
             try:
-                sub_status = assign_status(xmi_path, sub_cui_list)
-            except:
-                sub_status = "U"
-            substance_row = [
-                patient_id,         # PatID
-                encounter_id,       # EncounterID
-                note_id,            # NoteID
-                1006,               # FeatureID for substance abuse
-                note_date,          # Feature_dt
-                "C0740858",         # Feature
-                "UC",               # FE_CodeType
-                provider_id,        # ProviderID
-                "N",                # Confidence
-                sub_status          # Feature_Status
-            ]
-            substance_rows.append(substance_row)
-
-            # Add file to the tar archive
-            tar.add(xmi_path, arcname=os.path.basename(xmi_path))
-            # Delete the original file
+                self.tar.close()
+                if self.stream is not None:
+                    self.stream.close()
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                self.file.close()
+
+    def add(self, xmi_path):
+        """Queue `xmi_path` to be archived, renaming it to {xmi_path}.archiving right away (see raise_error)."""
+        os.replace(xmi_path, xmi_path + ARCHIVING_SUFFIX)
+        self.queue.put(xmi_path + ARCHIVING_SUFFIX)
+        self.count += 1
+
+    def raise_error(self):
+        """Raise the error of the archive thread, if it has failed."""
+        if self.error is not None:
+            raise RuntimeError(
+                f"Archiving to '{self.path}' failed: {self.error}. The XMI files not archived are left "
+                f"as *.xmi{ARCHIVING_SUFFIX}; their rows are in the result tables."
+            ) from self.error
+
+    def close(self):
+        """Wait until every queued file is archived and the archive is complete; raise the error of the archive thread if any."""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+def archive_xmi_files(archivers, folder_index, xmi_files):
+    """
+    Hand processed XMI files of folder `folder_index` to its archiver in `archivers`
+    ({folder_index: XmiArchiver}), opening it on first use. Called by the process that writes the
+    result tables, once their rows are written.
+    """
+    if folder_index not in archivers:
+        archivers[folder_index] = XmiArchiver(folder_index)
+    for xmi_path in xmi_files:
+        archivers[folder_index].add(xmi_path)
+    # Once the archive has failed, stop the stage; the files of this batch are all renamed by now
+    archivers[folder_index].raise_error()
+
+def close_archivers(archivers):
+    """Complete the archive of every folder in `archivers`, then raise the first error of any of them."""
+    errors = []
+    for folder_index, archiver in sorted(archivers.items()):
+        try:
+            archiver.close()
+            print(f"[Output_{folder_index}] Archived {archiver.count} XMI file(s) to '{archiver.path}'.")
+        except RuntimeError as e:
+            errors.append(e)
+    archivers.clear()
+    if errors:
+        raise errors[0]
+
+def dispose_xmi_files(folder_index, xmi_files, failed_files, archivers=None, mode=XMI_ARCHIVE_MODE):
+    """
+    Remove processed XMI files of folder `folder_index` as `mode` requires, once their rows are in
+    the result tables. With "compressed", they are handed to `archivers` (see archive_xmi_files),
+    or left for the caller to archive if `archivers` is None. With "failed", the files of
+    `failed_files` (those that failed to parse) are kept under ./Output_failed/Output_{folder_index}.
+    """
+    if mode == "compressed":
+        if archivers is not None:
+            archive_xmi_files(archivers, folder_index, xmi_files)
+        return
+    failed_files = set(failed_files)
+    for xmi_path in xmi_files:
+        if mode == "failed" and xmi_path in failed_files:
+            failed_folder = os.path.join(BASE_FAILED, f"Output_{folder_index}")
+            ensure_directory_exists(failed_folder)
+            os.replace(xmi_path, os.path.join(failed_folder, os.path.basename(xmi_path)))
+        else:
             os.remove(xmi_path)
 
-    # Build DataFrames for newly processed rows
-    columns = [
-        "PatID", "EncounterID", "NoteID", "FeatureID", "Feature_dt", "Feature",
-        "FE_CodeType", "ProviderID", "Confidence", "Feature_Status"
-    ]
-    df_obesity_new = pd.DataFrame(obesity_rows, columns=columns)
-    df_substance_new = pd.DataFrame(substance_rows, columns=columns)
-
-    # CSV paths
-    obesity_csv_path = os.path.join(result_folder_obesity, f"fe_feature_detail_table_obesity_{folder_index}.csv")
-    substance_csv_path = os.path.join(result_folder_substance_abuse, f"fe_feature_detail_table_substance_abuse_{folder_index}.csv")
-
-    # ----- Append or create obesity CSV -----
-    # If file doesn't exist, write with header. If it does, append without header.
-    if os.path.exists(obesity_csv_path):
-        df_obesity_new.to_csv(obesity_csv_path, mode="a", header=False, index=False)
-    else:
-        df_obesity_new.to_csv(obesity_csv_path, mode="w", header=True, index=False)
+def parse_xmi_files(folder_index, xmi_files):
+    """
+    Parse the given XMI files of ./Output/Output_{folder_index} (steps 1 and 5 of
+    process_xmi_files), leaving the result tables to write_xmi_results and the XMI files to
+    dispose_xmi_files. Returns the chunk names, the new rows of each feature, the prefilter
+    disagreements, the XMI files that failed to parse and a message to print.
+    """
+    # We'll store the new rows of each feature in lists
+    feature_rows = {feature: [] for feature in FEATURES}
+    failed_files = []
+    chunk_names = [os.path.basename(xmi_path)[:-4] for xmi_path in xmi_files]  # remove ".xmi"
+    connection = manifest.open_manifest() if USE_MANIFEST else None
+    chunk_metadata = manifest.chunk_metadata(connection, folder_index, chunk_names) if connection is not None else {}
+    if connection is not None:
+        connection.close()
+    # The chunks the cache lookup left pending, with their cache keys
+    cache = annotation_cache.open_cache() if ANNOTATION_CACHE else None
+    pending_keys, new_entries = {}, {}
+    prefilter_skips, disagreements = 0, []
+    if cache is not None:
+        pending_keys = annotation_cache.get_pending(cache, folder_index, chunk_names)
 
-    # ----- Append or create substance CSV -----
-    if os.path.exists(substance_csv_path):
-        df_substance_new.to_csv(substance_csv_path, mode="a", header=False, index=False)
-    else:
-        df_substance_new.to_csv(substance_csv_path, mode="w", header=True, index=False)
+    with pipeline_metrics.Timer(METRICS_PATH, "step5", unit="folder", key=folder_index) as timer:
+        for xmi_path, chunk_name in zip(xmi_files, chunk_names):
+            # Chunks that are not in the manifest fall back to their file name
+            metadata = chunk_metadata.get(chunk_name) or parse_filename(xmi_path)
+
+            parse_start = time.perf_counter()
+            try:
+                statuses = assign_statuses(xmi_path, CUI_SETS)
+                parsed = True
+            except Exception as e:
+                print(f"[Output_{folder_index}] Failed to parse {os.path.basename(xmi_path)}: {e}")
+                statuses = {feature: "U" for feature in CUI_SETS}
+                parsed = False
+                failed_files.append(xmi_path)
+
+            for feature, row in build_feature_rows(metadata, statuses).items():
+                feature_rows[feature].append(row)
+            if parsed and chunk_name in pending_keys:
+                new_entries[pending_keys[chunk_name]] = statuses
+            if PREFILTER_MODE == "validate" and parsed and not PREFILTER.matches(read_document_text(xmi_path)):
+                prefilter_skips += 1
+                if any(status != "U" for status in statuses.values()):
+                    disagreements.append([chunk_name] + [statuses[feature] for feature in FEATURES])
+
+            timer.add(xmi_files=1, parse_seconds=time.perf_counter() - parse_start, failed=int(not parsed))
+
+        timer.add(rows=sum(map(len, feature_rows.values())))
+        if cache is not None:
+            # The pending chunks are only forgotten once their statuses are stored, so that a
+            # failure in between leaves them pending for the next run
+            with cache:
+                evicted = annotation_cache.store(cache, new_entries, ANNOTATION_CACHE_MAX_ENTRIES)
+                annotation_cache.remove_pending(cache, folder_index, pending_keys)
+            cache.close()
 
-    print(f"[Output_{folder_index}] Processed {len(xmi_files)} new XMI file(s). Appended to '{tar_name}' and CSVs.")
+    message = f"[Output_{folder_index}] Processed {len(xmi_files)} new XMI file(s) ({len(failed_files)} failed to parse). Appended to the result tables."
+    if cache is not None:
+        message += f" Cached {len(new_entries)} new annotation(s), evicted {evicted}."
+    if PREFILTER_MODE == "validate":
+        message += f" The prefilter would have skipped {prefilter_skips} of them, {len(disagreements)} wrongly."
+    if XMI_ARCHIVE_MODE == "failed" and failed_files:
+        message += f" Kept the failed XMI file(s) under '{os.path.join(BASE_FAILED, f'Output_{folder_index}')}'."
+    return chunk_names, feature_rows, disagreements, failed_files, message
 
-    os.remove(tar_path) # Remove the tar archive to save space. You may choose to comment this line out so that the output files are recoverable, but be warned, the tar files can be quite large.
+def write_xmi_results(folder_index, chunk_names, feature_rows, disagreements):
+    """Write what parse_xmi_files returned for folder `folder_index` (steps 2, 3 and 6 of process_xmi_files)."""
+    append_feature_rows(folder_index, feature_rows)
+    if disagreements:
+        csv_path = os.path.join(BASE_RESULT, f"Result_{folder_index}", "prefilter_disagreements.csv")
+        df = pd.DataFrame(disagreements, columns=["Chunk"] + list(FEATURES))
+        df.to_csv(csv_path, mode="a", header=not os.path.exists(csv_path), index=False)
+    if USE_MANIFEST:
+        connection = manifest.open_manifest()
+        with connection:
+            manifest.set_chunk_state(connection, folder_index, chunk_names, "parsed")
+        connection.close()
+
+def process_xmi_files(folder_index, xmi_files):
+    """
+    Process the given XMI files of ./Output/Output_{folder_index}.
+    1) For each XMI file, parse the XMI once and create 1 row per feature in FEATURES. The note
+       metadata comes from the manifest with USE_MANIFEST, otherwise from the file name.
+       An XMI file that fails to parse gets status "U" for every feature.
+    2) Append the new rows to the chunk-level CSVs of ./Result/Result_{folder_index}.
+    3) With USE_MANIFEST, record the chunks as parsed.
+    4) Once the rows are written, remove the XMI files according to XMI_ARCHIVE_MODE; with
+       "compressed", they are left for the caller to archive (see archive_xmi_files).
+    5) With ANNOTATION_CACHE, cache the statuses of the chunks the cache lookup left pending.
+    6) With PREFILTER_MODE "validate", check every chunk the prefilter would have skipped against
+       its statuses, and add the chunks that it would have wrongly given status "U" to
+       ./Result/Result_{folder_index}/prefilter_disagreements.csv.
+    The XMI files, parse time and rows are recorded to the metrics file.
+    """
+    chunk_names, feature_rows, disagreements, failed_files, message = parse_xmi_files(folder_index, xmi_files)
+    write_xmi_results(folder_index, chunk_names, feature_rows, disagreements)
+    dispose_xmi_files(folder_index, xmi_files, failed_files)
+    print(message)
+
+def process_chunk_statuses(folder_index, chunk_statuses):
+    """
+    Append the rows of chunks of folder `folder_index` whose statuses are known without an XMI
+    (found in the annotation cache, or skipped by the prefilter), `chunk_statuses` being
+    {chunk_name: {feature: status}}, to the chunk-level tables as process_xmi_files would.
+    With USE_MANIFEST, record the chunks as parsed.
+    """
+    feature_rows = {feature: [] for feature in FEATURES}
+    chunk_names = list(chunk_statuses)
+    connection = manifest.open_manifest() if USE_MANIFEST else None
+    chunk_metadata = manifest.chunk_metadata(connection, folder_index, chunk_names) if connection is not None else {}
+
+    for chunk_name in chunk_names:
+        metadata = chunk_metadata.get(chunk_name) or parse_filename(chunk_name + ".xmi")
+        for feature, row in build_feature_rows(metadata, chunk_statuses[chunk_name]).items():
+            feature_rows[feature].append(row)
+
+    append_feature_rows(folder_index, feature_rows)
+    if connection is not None:
+        with connection:
+            manifest.set_chunk_state(connection, folder_index, chunk_names, "parsed")
+        connection.close()
+
+def list_xmi_files(folder_index):
+    """
+    Return the paths of the new XMI files under ./Output/Output_{folder_index}, creating (if
+    needed) ./Result/Result_{folder_index}. The folder is listed in a single streaming os.scandir
+    pass. With USE_MANIFEST, the new XMI files are those of the chunks the manifest records as
+    annotated instead.
+    """
+    output_folder = os.path.join(BASE_OUTPUT, f"Output_{folder_index}")
+    result_folder = os.path.join(BASE_RESULT, f"Result_{folder_index}")
+    ensure_directory_exists(result_folder)
+    for feature in FEATURES:
+        ensure_directory_exists(os.path.join(result_folder, feature))
+
+    if USE_MANIFEST:
+        connection = manifest.open_manifest()
+        xmi_files = [sharding.file_path(output_folder, name + ".xmi", DIRECTORY_SHARDS) for name in manifest.list_chunks(connection, folder_index, "annotated")]
+        connection.close()
+        # An XMI that was already archived or removed is left out
+        return [path for path in xmi_files if os.path.exists(path)]
+    return [path for _, path in sharding.iter_files(output_folder, ".xmi")]
+
+def parse_xmi_batch(batch):
+    """Parse a batch of XMI files, (folder_index, [path, ...]); returns the batch and what parse_xmi_files returns."""
+    folder_index, xmi_files = batch
+    return (folder_index, xmi_files, *parse_xmi_files(folder_index, xmi_files))
 
 def main():
+    """
+    Process the new XMI files of every ./Output/Output_{folder_index}. The processes take batches
+    of files of any folder from a shared queue (see work_batches.py) and parse them, and this
+    process appends their rows to the result tables, so that it is the only writer of each table,
+    then removes or archives the XMI files of the batch.
+    """
+    result_storage.check_result_format(RESULT_FORMAT)
     folder_indices = range(1, NUM_PROCESSES + 1)
-    with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
-        pool.map(process_output_folder, folder_indices)
+    if USE_MANIFEST:
+        # Create the manifest before the processes open it
+        manifest.open_manifest().close()
+    with pipeline_metrics.Timer(METRICS_PATH, "step5"):
+        with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+            folder_files = dict(zip(folder_indices, pool.map(list_xmi_files, folder_indices)))
+            total = sum(map(len, folder_files.values()))
+            batch_files = work_batches.batch_size(total, NUM_PROCESSES, MIN_BATCH_FILES, XMI_BATCH_FILES)
+            batches = work_batches.split_batches(folder_files, batch_files)
+            print(f"Found {total} new XMI file(s); processing them in {len(batches)} batch(es) of up to {batch_files}.")
+            # With "compressed", one archive per folder for the whole run, written by this process
+            archivers = {}
+            try:
+                with tqdm(total=total, desc="Processing XMI files", unit="file") as progress:
+                    for folder_index, xmi_files, chunk_names, feature_rows, disagreements, failed_files, message in pool.imap_unordered(parse_xmi_batch, batches):
+                        write_xmi_results(folder_index, chunk_names, feature_rows, disagreements)
+                        # Only once the rows are written, so that a failed write leaves the XMI files for the next run
+                        dispose_xmi_files(folder_index, xmi_files, failed_files, archivers)
+                        progress.write(message)
+                        progress.update(len(chunk_names))
+            finally:
+                close_archivers(archivers)
 
+    for folder_index, xmi_files in folder_files.items():
+        if not xmi_files:
+            print(f"[Output_{folder_index}] No new XMI files found.")
     print(f"All {NUM_PROCESSES} processes have finished processing output. Pipeline Step 5 complete.")
 
 if __name__ == "__main__":
@@ -1,8 +1,34 @@
 #!/bin/bash
+FUSE_PREPARE_AND_CHUNK=$(jq -r '.fuse_prepare_and_chunk // false' config.json)
+PIPELINE_MODE=$(jq -r '.pipeline_mode // "sequential"' config.json)
+ANNOTATION_CACHE=$(jq -r '.annotation_cache // false' config.json)
+PREFILTER_MODE=$(jq -r '.prefilter_mode // "off"' config.json)
+
+if [ "$PIPELINE_MODE" == "streaming" ]; then
+  # Steps 1-5 run overlapped: chunks are annotated as soon as they are written and parsed as soon as their XMI lands
+  nohup python3 -u pipeline_orchestrator.py > "Pipeline Orchestrator.log" 2>&1 &
+  wait
+  echo "Pipeline completed. Please execute 'Post Processing.sh' to generate the final output once all inputs have been processed."
+  exit 0
+fi
+
 nohup python3 -u "Pipeline Step 1 - Prepare Input.py" > "Pipeline Step 1 - Prepare Input.log" 2>&1 &
 wait
+# In fused mode Pipeline Step 1 already wrote the chunks to ./Input_chunk
+if [ "$FUSE_PREPARE_AND_CHUNK" != "true" ]; then
 nohup python3 -u "Pipeline Step 2 - Chunk Input.py" > "Pipeline Step 2 - Chunk Input.log" 2>&1 &
 wait
+fi
+# Chunks without a term of the CUI lists get status "U" now and skip cTAKES
+if [ "$PREFILTER_MODE" != "off" ]; then
+nohup python3 -u prefilter_chunks.py > "Prefilter Chunks.log" 2>&1 &
+wait
+fi
+# Chunks found in the annotation cache get their results now and skip cTAKES
+if [ "$ANNOTATION_CACHE" == "true" ]; then
+nohup python3 -u annotation_cache_lookup.py > "Annotation Cache Lookup.log" 2>&1 &
+wait
+fi
 nohup bash "./Pipeline Step 3 - Run cTAKES.sh" > "Pipeline Step 3 - Run cTAKES.log" 2>&1 &
 wait
 nohup python3 -u "Pipeline Step 4 - Remove Processed Note Chunks.py" > "Pipeline Step 4 - Remove Processed Note Chunks.log" 2>&1 &
@@ -1,8 +1,9 @@
 import os
 import glob
-import pandas as pd
 import multiprocessing
 import json
+import result_storage
+import pipeline_metrics
 
 # Load configuration from config.json
 def load_config(config_path="config.json"):
@@ -12,20 +13,35 @@ def load_config(config_path="config.json"):
 config = load_config()
 
 NUM_PROCESSES = config["num_processes"]
+RESULT_FORMAT = config.get("result_format", "csv")
+EXTENSION = result_storage.EXTENSIONS[RESULT_FORMAT]
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
 
 # The custom ranking for Feature_Status
 STATUS_ORDER = {"A": 5, "N": 4, "H": 3, "X": 2, "U": 1}
+RANK_STATUS = {rank: status for status, rank in STATUS_ORDER.items()}
+
+def max_status_by_group(df, grouping_cols):
+    """
+    Return one row per group of `grouping_cols` with the highest ranked Feature_Status of the group.
+    The statuses are mapped to their integer ranks, reduced with a vectorized max and mapped back
+    to letters; a status that is not in STATUS_ORDER ranks lowest and is reported as "U".
+    """
+    ranks = df["Feature_Status"].map(STATUS_ORDER).fillna(0).astype("int8")
+    aggregated_df = ranks.groupby([df[col] for col in grouping_cols], observed=True).max().reset_index()
+    aggregated_df["Feature_Status"] = aggregated_df["Feature_Status"].map(RANK_STATUS).fillna("U")
+    return aggregated_df
 
 def aggregate_csv_file(csv_file):
     """
-    Read the CSV file as a pandas DataFrame, group by all columns except 'Feature_Status'
-    and, for each group, choose the Feature_Status with the highest rank.
-    Save the aggregated DataFrame to a new file named "{original_csv_filename}_aggregated.csv"
+    Read the CSV file (or, with a columnar result_format, the partitioned table folder) as a pandas DataFrame,
+    group by all columns except 'Feature_Status' and, for each group, choose the Feature_Status with the highest rank.
+    Save the aggregated DataFrame to a new file named "{original_filename}_aggregated.csv" (or .parquet/.feather)
     in the same directory.
     """
     try:
         # Read the CSV file
-        df = pd.read_csv(csv_file)
+        df = result_storage.read_table(csv_file, RESULT_FORMAT)
     except Exception as e:
         print(f"Error reading {csv_file}: {e}")
         return
@@ -39,19 +55,17 @@ def aggregate_csv_file(csv_file):
 
     try:
         # Group the DataFrame and, for each group, select the maximum Feature_Status according to STATUS_ORDER.
-        # The lambda function uses STATUS_ORDER to determine the rank; if a value is not found, 0 is used.
-        aggregated_df = df.groupby(grouping_cols, as_index=False).agg({
-            "Feature_Status": lambda s: max(s, key=lambda x: STATUS_ORDER.get(x, 0))
-        })
+        aggregated_df = max_status_by_group(df, grouping_cols)
     except Exception as e:
         print(f"Error aggregating {csv_file}: {e}")
         return
 
-    csv_file = csv_file[:-4] # Remove ".csv" extension
+    if RESULT_FORMAT == "csv":
+        csv_file = csv_file[:-4] # Remove ".csv" extension
     # Build the output filename by appending "_aggregated.csv" to the original filename.
-    output_csv = f"{csv_file}_aggregated.csv"
+    output_csv = f"{csv_file}_aggregated{EXTENSION}"
     try:
-        aggregated_df.to_csv(output_csv, index=False)
+        result_storage.write_table(aggregated_df, output_csv, RESULT_FORMAT)
         print(f"Aggregated CSV saved to {output_csv}")
     except Exception as e:
         print(f"Error saving aggregated CSV for {csv_file}: {e}")
@@ -65,20 +79,27 @@ def process_result_folder(folder_index):
     result_folder_obesity = f"./Result/Result_{folder_index}/obesity"
     result_folder_substance_abuse = f"./Result/Result_{folder_index}/substance_abuse"
     # Find all CSV files in the folder (skip files that have already been aggregated)
-    csv_files = glob.glob(os.path.join(result_folder_obesity, "*.csv")) + glob.glob(os.path.join(result_folder_substance_abuse, "*.csv"))
-    csv_files = [f for f in csv_files if not f.endswith("_aggregated.csv")]
+    if RESULT_FORMAT == "csv":
+        csv_files = glob.glob(os.path.join(result_folder_obesity, "*.csv")) + glob.glob(os.path.join(result_folder_substance_abuse, "*.csv"))
+        csv_files = [f for f in csv_files if not f.endswith("_aggregated.csv")]
+    else:
+        # The chunk-level tables are folders of part files
+        csv_files = [f for f in glob.glob(os.path.join(result_folder_obesity, "*")) + glob.glob(os.path.join(result_folder_substance_abuse, "*")) if os.path.isdir(f)]
 
     if not csv_files:
         print(f"[Result_{folder_index}] No CSV files to process.")
         return
 
-    for csv_file in csv_files:
-        aggregate_csv_file(csv_file)
+    with pipeline_metrics.Timer(METRICS_PATH, "post1", unit="folder", key=folder_index) as timer:
+        for csv_file in csv_files:
+            aggregate_csv_file(csv_file)
+            timer.add(files=1)
     print(f"[Result_{folder_index}] Processed {len(csv_files)} CSV file(s).")
 
 def main():
+    result_storage.check_result_format(RESULT_FORMAT)
     folder_indices = range(1, NUM_PROCESSES + 1)
-    with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+    with pipeline_metrics.Timer(METRICS_PATH, "post1"), multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
         pool.map(process_result_folder, folder_indices)
     print("Aggregation completed for all result folders. Post Processing Step 1 complete.")
 
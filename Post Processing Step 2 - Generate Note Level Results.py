@@ -3,6 +3,8 @@ import glob
 import pandas as pd
 import multiprocessing
 import json
+import result_storage
+import pipeline_metrics
 
 # Load configuration from config.json
 def load_config(config_path="config.json"):
@@ -12,37 +14,118 @@ def load_config(config_path="config.json"):
 config = load_config()
 
 NUM_PROCESSES = config["num_processes"]
+RESULT_FORMAT = config.get("result_format", "csv")
+EXTENSION = result_storage.EXTENSIONS[RESULT_FORMAT]
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+# "memory" concatenates the aggregated tables in memory, "streaming" appends them to the output one at a time
+NOTE_LEVEL_CONCAT = config.get("note_level_concat", "memory")
+CHUNK_ROWS = config.get("post_processing_chunk_rows", 500000)
+COPY_BUFFER_BYTES = 16 * 2**20
+
+def stream_csv_files(csv_files, output_csv):
+    """
+    Copy the CSV files byte for byte into output_csv, one after another, keeping only the header of
+    the first one. Memory use is constant. Returns the number of rows written.
+    """
+    rows = 0
+    header = None
+    with open(output_csv, "wb") as out_f:
+        for csv_file in csv_files:
+            with open(csv_file, "rb") as in_f:
+                file_header = in_f.readline()
+                if header is None:
+                    header = file_header
+                    out_f.write(header)
+                elif file_header != header:
+                    print(f"Skipping {csv_file}: its header differs from the one of {csv_files[0]}.")
+                    continue
+
+                last_byte = b"\n"
+                while block := in_f.read(COPY_BUFFER_BYTES):
+                    out_f.write(block)
+                    rows += block.count(b"\n")
+                    last_byte = block[-1:]
+                if last_byte != b"\n":
+                    # Terminate the last row of a file without a trailing newline
+                    out_f.write(b"\n")
+                    rows += 1
+    return rows
+
+def stream_table_files(table_files, output_name):
+    """
+    Append the columnar tables to output_name (without extension) and to its CSV export, one batch of
+    at most CHUNK_ROWS rows at a time, so that memory use is constant. Returns the written paths and the number of rows.
+    """
+    writers = [
+        result_storage.TableWriter(output_name + EXTENSION, RESULT_FORMAT),
+        result_storage.TableWriter(output_name + ".csv", "csv"),
+    ]
+    try:
+        for table_file in table_files:
+            for df in result_storage.iter_table_batches(table_file, RESULT_FORMAT, CHUNK_ROWS):
+                for writer in writers:
+                    writer.write(df)
+    finally:
+        for writer in writers:
+            writer.close()
+    return [writer.path for writer in writers], writers[0].rows
 
 def aggregate_csv_files(folders, output_csv):
     """
     Given a list of folder paths, find all CSV files within these folders,
     read them into DataFrames, concatenate them, print the total row count,
-    and save the result to output_csv.
+    and save the result to output_csv (without extension; see result_storage.write_final_table).
+    With "note_level_concat": "streaming" the files are appended to the output one at a time instead.
     """
-    # List to hold DataFrames read from CSV files.
-    df_list = []
-    
+    # List of the CSV files to concatenate.
+    csv_files = []
+
     # Iterate over each folder.
     for folder in folders:
         # Use glob to find all CSV files in the folder.
-        csv_files = glob.glob(os.path.join(folder, "*_aggregated.csv"))
-        if len(csv_files) == 0:
+        folder_csv_files = glob.glob(os.path.join(folder, f"*_aggregated{EXTENSION}"))
+        if len(folder_csv_files) == 0:
             print(f"No CSV files found in folder: {folder}")
-        for csv_file in csv_files:
-            try:
-                df = pd.read_csv(csv_file)
-                df_list.append(df)
-            except Exception as e:
-                print(f"Error reading {csv_file}: {e}")
-    
+        csv_files.extend(folder_csv_files)
+
+    if not csv_files:
+        print(f"No CSV files found in folders: {folders}")
+        return
+
+    if NOTE_LEVEL_CONCAT == "streaming":
+        try:
+            if RESULT_FORMAT == "csv":
+                paths = [output_csv + EXTENSION]
+                total_rows = stream_csv_files(csv_files, paths[0])
+            else:
+                paths, total_rows = stream_table_files(csv_files, output_csv)
+        except Exception as e:
+            print(f"Error saving {output_csv}: {e}")
+            return
+        print(f"Total number of rows in {output_csv}: {total_rows}")
+        for path in paths:
+            print(f"Aggregated table saved to {path}")
+        return
+
+    # List to hold DataFrames read from CSV files.
+    df_list = []
+    for csv_file in csv_files:
+        try:
+            df = result_storage.read_table(csv_file, RESULT_FORMAT)
+            df_list.append(df)
+        except Exception as e:
+            print(f"Error reading {csv_file}: {e}")
+
     # Concatenate all DataFrames if any were found.
     if df_list:
         aggregated_df = pd.concat(df_list, ignore_index=True)
+        if RESULT_FORMAT != "csv":
+            aggregated_df = result_storage.with_categories(aggregated_df)
         total_rows = len(aggregated_df)
         print(f"Total number of rows in {output_csv}: {total_rows}")
         try:
-            aggregated_df.to_csv(output_csv, index=False)
-            print(f"Aggregated CSV saved to {output_csv}")
+            for path in result_storage.write_final_table(aggregated_df, output_csv, RESULT_FORMAT):
+                print(f"Aggregated table saved to {path}")
         except Exception as e:
             print(f"Error saving {output_csv}: {e}")
     else:
@@ -53,37 +136,41 @@ def process_obesity():
     Process all obesity CSV files from: 
       ./Result/Result_{folder_index}/obesity
     and save the aggregated CSV to:
-      ./fe_feature_detail_table_obesity.csv
+      ./fe_feature_detail_table_obesity.csv (and .parquet/.feather with a columnar result_format)
     """
     folders = [
         f"./Result/Result_{folder_index}/obesity" for folder_index in range(1, NUM_PROCESSES + 1)
     ]
-    output_csv = "./fe_feature_detail_table_obesity.csv"
-    aggregate_csv_files(folders, output_csv)
+    output_csv = "./fe_feature_detail_table_obesity"
+    with pipeline_metrics.Timer(METRICS_PATH, "post2", unit="feature", key="obesity"):
+        aggregate_csv_files(folders, output_csv)
 
 def process_substance_abuse():
     """
     Process all substance abuse CSV files from: 
       ./Result/Result_{folder_index}/substance_abuse
     and save the aggregated CSV to:
-      ./fe_feature_detail_table_substance_abuse.csv
+      ./fe_feature_detail_table_substance_abuse.csv (and .parquet/.feather with a columnar result_format)
     """
     folders = [
         f"./Result/Result_{folder_index}/substance_abuse" for folder_index in range(1, NUM_PROCESSES + 1)
     ]
-    output_csv = "./fe_feature_detail_table_substance_abuse.csv"
-    aggregate_csv_files(folders, output_csv)
+    output_csv = "./fe_feature_detail_table_substance_abuse"
+    with pipeline_metrics.Timer(METRICS_PATH, "post2", unit="feature", key="substance_abuse"):
+        aggregate_csv_files(folders, output_csv)
 
 def main():
+    result_storage.check_result_format(RESULT_FORMAT)
     # Create two processes: one for obesity and one for substance abuse.
     p_obesity = multiprocessing.Process(target=process_obesity)
     p_substance = multiprocessing.Process(target=process_substance_abuse)
     
-    p_obesity.start()
-    p_substance.start()
-    
-    p_obesity.join()
-    p_substance.join()
+    with pipeline_metrics.Timer(METRICS_PATH, "post2"):
+        p_obesity.start()
+        p_substance.start()
+
+        p_obesity.join()
+        p_substance.join()
     
     print("Aggregation completed for both obesity and substance abuse CSV files. Note level results saved as fe_feature_detail_table_obesity.csv and fe_feature_detail_table_substance_abuse.csv. Post Processing Step 2 complete.")
 
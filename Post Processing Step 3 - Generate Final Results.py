@@ -1,84 +1,233 @@
-import numpy as np
+import os
+import json
+import heapq
+import pickle
+import shutil
+import multiprocessing
 import pandas as pd
 from datetime import date
+import result_storage
+import pipeline_metrics
+
+# Load configuration from config.json
+def load_config(config_path="config.json"):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+config = load_config()
+
+NUM_PROCESSES = config["num_processes"]
+RESULT_FORMAT = config.get("result_format", "csv")
+# "pandas" aggregates each note-level table in memory, "partitioned" out of core (see aggregate_partitioned)
+ENGINE = config.get("final_results_engine", "pandas")
+NUM_PARTITIONS = config.get("final_results_partitions", 64)
+CHUNK_ROWS = config.get("post_processing_chunk_rows", 500000)
+SPILL_FOLDER = "./Result/final_results_spill"
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+# The columns of the note-level tables the final tables are built from (NoteID is not needed)
+INPUT_COLUMNS = ["PatID", "EncounterID", "FeatureID", "Feature_dt", "Feature", "FE_CodeType", "ProviderID", "Confidence", "Feature_Status"]
+
+# Features: feature name -> (FeatureID, pipeline description)
+FEATURES = {
+    "obesity": (1005, "Rule-based pipeline to extract obesity status."),
+    "substance_abuse": (1006, "Rule-based pipeline to extract substance abuse status."),
+}
+
+# The custom ranking for Feature_Status
+STATUS_ORDER = {"A": 5, "N": 4, "H": 3, "X": 2, "U": 1}
+RANK_STATUS = {rank: status for status, rank in STATUS_ORDER.items()}
+
+GROUPING_COLUMNS = ["PatID", "EncounterID", "FeatureID", "Feature", "FE_CodeType", "Confidence"]
+SORT_COLUMNS = ["PatID", "EncounterID"]
+OUTPUT_COLUMNS = ["PatID", "EncounterID", "FeatureID", "Feature_dt", "Feature", "FE_CodeType", "ProviderID", "Confidence", "Feature_Status"]
+
+def aggregate_encounters(df):
+    """
+    Aggregate the note-level rows of `df` into one row per encounter in a single groupby pass:
+    the Feature_dt and ProviderID of its earliest note (taken from the same row, even where the
+    ProviderID is missing), and the highest ranked Feature_Status (computed on integer ranks and
+    mapped back to letters).
+    """
+    df = df.assign(Feature_Status=df["Feature_Status"].map(STATUS_ORDER).fillna(0).astype("int8"))
+    # After a stable sort by date, the first row of every group is its earliest note
+    df = df.sort_values(by="Feature_dt", kind="stable").reset_index(drop=True)
+    df = df.assign(row=df.index)
+    encounters = df.groupby(GROUPING_COLUMNS, observed=True).agg(
+        row=("row", "first"),
+        Feature_Status=("Feature_Status", "max"),
+    ).reset_index()
+    for column in ["Feature_dt", "ProviderID"]:
+        encounters[column] = df[column].iloc[encounters["row"]].reset_index(drop=True)
+    encounters["Feature_Status"] = encounters["Feature_Status"].map(RANK_STATUS).fillna("U")
+    return encounters[OUTPUT_COLUMNS]
+
+def finalize_feature_table(df, feature_id):
+    """Sort the encounter-level rows by PatID and EncounterID and give each a FeatureID {feature_id}{row number:08d}."""
+    df = df.sort_values(by=["PatID", "EncounterID"]).reset_index(drop=True)
+    df["FeatureID"] = str(feature_id) + df.index.astype(str).str.zfill(8)
+    return df
+
+def numeric_kind(values):
+    """
+    Return the kind of a column ("int", "float" or None for text), so that the partitioned engine
+    sorts and writes it as reading the whole table with pandas would.
+    """
+    if RESULT_FORMAT != "csv":
+        # Typed tables keep the type they were written with
+        return {"i": "int", "u": "int", "f": "float"}.get(values.dtype.kind)
+    numbers = pd.to_numeric(values.dropna(), errors="coerce")
+    if numbers.isna().any():
+        return None
+    return "float" if (numbers % 1 != 0).any() else "int"
+
+def combine_kinds(kind, other):
+    """Combine the kinds of two parts of the same column."""
+    if kind is None or other is None:
+        return None
+    return "float" if "float" in (kind, other) else "int"
+
+def iter_pickles(path):
+    """Yield every object pickled one after another into `path`."""
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def partition_note_table(table_path, spill_folder):
+    """
+    Hash-partition the rows of the note-level table by (PatID, EncounterID) into NUM_PARTITIONS spill
+    files, reading it CHUNK_ROWS rows at a time (CSV values are kept as text). Returns the spill file paths.
+    """
+    os.makedirs(spill_folder, exist_ok=True)
+    spill_paths = [os.path.join(spill_folder, f"partition_{i}.pkl") for i in range(NUM_PARTITIONS)]
+    for df in result_storage.iter_table_batches(table_path, RESULT_FORMAT, CHUNK_ROWS, columns=INPUT_COLUMNS, csv_dtype=str):
+        partitions = pd.util.hash_pandas_object(df[SORT_COLUMNS].astype(str), index=False).to_numpy() % NUM_PARTITIONS
+        for partition, part_df in df.groupby(partitions):
+            with open(spill_paths[partition], "ab") as f:
+                pickle.dump(part_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return [path for path in spill_paths if os.path.exists(path)]
+
+def aggregate_partition(spill_path):
+    """Aggregate one spill file to encounter-level rows; return the path of the result and the numeric kind of each of SORT_COLUMNS."""
+    df = aggregate_encounters(pd.concat(iter_pickles(spill_path), ignore_index=True))
+    os.remove(spill_path)
+    aggregated_path = spill_path[:-4] + "_aggregated.pkl"
+    df.to_pickle(aggregated_path)
+    return aggregated_path, {column: numeric_kind(df[column]) for column in SORT_COLUMNS}
+
+def convert_sort_columns(df, kinds):
+    """Convert the SORT_COLUMNS of `df` to numbers where `kinds` says they are numeric."""
+    for column, kind in kinds.items():
+        if kind is not None:
+            df[column] = pd.to_numeric(df[column])
+    return df
+
+def sort_partition(args):
+    """Sort one aggregated partition by SORT_COLUMNS and store it as pickled blocks of rows; return the path."""
+    aggregated_path, kinds, block_rows = args
+    df = convert_sort_columns(pd.read_pickle(aggregated_path), kinds).sort_values(by=SORT_COLUMNS)
+    os.remove(aggregated_path)
+    sorted_path = aggregated_path[:-len("_aggregated.pkl")] + "_sorted.pkl"
+    with open(sorted_path, "wb") as f:
+        # Rows as tuples of plain Python objects; converting whole columns at once is much faster than itertuples
+        columns = [df[column].to_numpy(dtype=object) for column in df.columns]
+        for i in range(0, len(df), block_rows):
+            pickle.dump(list(zip(*(values[i:i + block_rows] for values in columns))), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return sorted_path
+
+def iter_sorted_rows(sorted_path):
+    """Yield the rows of a sorted partition, one block in memory at a time."""
+    for rows in iter_pickles(sorted_path):
+        yield from rows
+
+def aggregate_partitioned(table_path, feature, feature_id):
+    """
+    The out-of-core engine: hash-partition the note-level table by encounter into spill files,
+    aggregate and sort the partitions in parallel, and merge the sorted partitions into the final
+    table while numbering the FeatureIDs. Memory use is bounded by the size of a partition and of
+    CHUNK_ROWS. Returns the written paths.
+    """
+    spill_folder = os.path.join(SPILL_FOLDER, feature)
+    shutil.rmtree(spill_folder, ignore_errors=True)
+    spill_paths = partition_note_table(table_path, spill_folder)
+    with multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+        aggregated = pool.map(aggregate_partition, spill_paths)
+        # A column is numeric only if it is numeric in every partition
+        kinds = {column: "int" for column in SORT_COLUMNS}
+        for _, partition_kinds in aggregated:
+            for column in SORT_COLUMNS:
+                kinds[column] = combine_kinds(kinds[column], partition_kinds[column])
+        block_rows = max(1, CHUNK_ROWS // max(1, len(aggregated)))
+        sorted_paths = pool.map(sort_partition, [(path, kinds, block_rows) for path, _ in aggregated])
+
+    name = f"fe_feature_table_{feature}"
+    writers = [result_storage.TableWriter(name + result_storage.EXTENSIONS[RESULT_FORMAT], RESULT_FORMAT)]
+    if RESULT_FORMAT != "csv":
+        writers.append(result_storage.TableWriter(name + ".csv", "csv"))
+
+    def flush(rows):
+        df = pd.DataFrame(rows, columns=OUTPUT_COLUMNS)
+        df["FeatureID"] = str(feature_id) + pd.Series(range(writers[0].rows, writers[0].rows + len(df))).astype(str).str.zfill(8)
+        for writer in writers:
+            writer.write(df)
+
+    try:
+        rows = []
+        # PatID and EncounterID lead every row and an encounter lives in a single partition,
+        # so plain tuple comparison merges the partitions in (PatID, EncounterID) order
+        for row in heapq.merge(*(iter_sorted_rows(path) for path in sorted_paths)):
+            rows.append(row)
+            if len(rows) == CHUNK_ROWS:
+                flush(rows)
+                rows = []
+        if rows or writers[0].rows == 0:
+            flush(rows)
+    finally:
+        for writer in writers:
+            writer.close()
+    shutil.rmtree(spill_folder, ignore_errors=True)
+    if not os.listdir(SPILL_FOLDER):
+        os.rmdir(SPILL_FOLDER)
+    return [writer.path for writer in writers]
+
+def write_pipeline_table(feature, feature_id, description):
+    """Save the pipeline information of `feature` to fe_pipeline_table_{feature}.csv."""
+    featureid_df = pd.DataFrame({
+        'FeatureID': [feature_id],
+        'Feature': [f"cTAKES pipeline - {feature}"],
+        'Version': ["1.0.0"],
+        'Run_Date': [date.today()],
+        'Description': [description],
+        'Source': ["https://github.com/YLab-Open/fe5_cTAKES"]
+    })
+
+    featureid_df_output_file = f"fe_pipeline_table_{feature}.csv"
+    featureid_df.to_csv(featureid_df_output_file, index=False)
+    print("Pipeline information CSV saved to:", featureid_df_output_file)
 
 def main():
-    feature_list = ["obesity", "substance_abuse"]
-    
-    for feature in feature_list:
-        # Read the CSV file
-        df = pd.read_csv(f"fe_feature_detail_table_{feature}.csv")
-
-        # Group the rows and aggregate the Feature_Status values of different NoteIDs by the order
-        order = {"A": 5, "N": 4, "H": 3, "X": 2, "U": 1}
-        df_grouped_status = df.groupby(["PatID", "EncounterID", "FeatureID", "Feature", "FE_CodeType", "Confidence"]).agg({"Feature_Status": lambda x: max(x, key=lambda y: order[y])}).reset_index()
-
-        # Group the rows and aggregate the Feature_dt and ProviderID of different NoteIDs by the earliest date
-        df_grouped_date = df.groupby(["PatID", "EncounterID", "FeatureID", "Feature", "FE_CodeType", "Confidence"]).agg({"Feature_dt": "min", "ProviderID": "first"}).reset_index()
-
-        # Merge the two DataFrames
-        df = pd.merge(df_grouped_date, df_grouped_status, on=["PatID", "EncounterID", "FeatureID", "Feature", "FE_CodeType", "Confidence"], how="inner")
-
-        # Ensure that the columns are in the order of the original table
-        df = df[["PatID", "EncounterID", "FeatureID", "Feature_dt", "Feature", "FE_CodeType", "ProviderID", "Confidence", "Feature_Status"]]
-
-        # Sort the rows by PatID and EncounterID
-        df = df.sort_values(by=["PatID", "EncounterID"], inplace=True)
-
-        df.reset_index(drop=True)
-
-        if feature == "obesity":
-            df["FeatureID"] = df.index.map(lambda x: f"1005{x:08d}")
-
-            id = 1005
-            name = "cTAKES pipeline - obesity"
-            version = "1.0.0"
-            run_date = date.today()
-            description = "Rule-based pipeline to extract obesity status."
-            source = "https://github.com/YLab-Open/fe5_cTAKES"
-
-            featureid_df = pd.DataFrame({
-                'FeatureID': [id],
-                'Feature': [name],
-                'Version': [version],
-                'Run_Date': [run_date],
-                'Description': [description],
-                'Source': [source]
-            })
-
-            featureid_df["FeatureID"] = df.index.map(lambda x: f"{id}{x:08d}")
-
-            featureid_df_output_file = "fe_pipeline_table_obesity.csv"
-            featureid_df.to_csv(featureid_df_output_file, index=False)
-            print("Pipeline information CSV saved to:", featureid_df_output_file)
-        elif feature == "substance_abuse":
-            df["FeatureID"] = df.index.map(lambda x: f"1006{x:08d}")
-
-            id = 1006
-            name = "cTAKES pipeline - substance_abuse"
-            version = "1.0.0"
-            run_date = date.today()
-            description = "Rule-based pipeline to extract substance abuse status."
-            source = "https://github.com/YLab-Open/fe5_cTAKES"
-
-            featureid_df = pd.DataFrame({
-                'FeatureID': [id],
-                'Feature': [name],
-                'Version': [version],
-                'Run_Date': [run_date],
-                'Description': [description],
-                'Source': [source]
-            })
-
-            featureid_df["FeatureID"] = df.index.map(lambda x: f"{id}{x:08d}")
-
-            featureid_df_output_file = "fe_pipeline_table_substance_abuse.csv"
-            featureid_df.to_csv(featureid_df_output_file, index=False)
-            print("Pipeline information CSV saved to:", featureid_df_output_file)
-
-        df.to_csv(f"fe_feature_table_{feature}.csv", index=False)
-
-        print(f"Saved fe_feature_table_{feature}.csv")
+    result_storage.check_result_format(RESULT_FORMAT)
+
+    with pipeline_metrics.Timer(METRICS_PATH, "post3"):
+        for feature, (feature_id, description) in FEATURES.items():
+            table_path = f"fe_feature_detail_table_{feature}{result_storage.EXTENSIONS[RESULT_FORMAT]}"
+            with pipeline_metrics.Timer(METRICS_PATH, "post3", unit="feature", key=feature):
+                if ENGINE == "partitioned":
+                    paths = aggregate_partitioned(table_path, feature, feature_id)
+                else:
+                    # Read the note-level table
+                    df = result_storage.read_table(table_path, RESULT_FORMAT, columns=INPUT_COLUMNS)
+
+                    # Group the rows of different NoteIDs by encounter
+                    df = finalize_feature_table(aggregate_encounters(df), feature_id)
+                    paths = result_storage.write_final_table(df, f"fe_feature_table_{feature}", RESULT_FORMAT)
+
+            write_pipeline_table(feature, feature_id, description)
+
+            for path in paths:
+                print(f"Saved {path}")
 
     print("Final results generated for both obesity and substance abuse. Final results saved as fe_feature_table_obesity.csv and fe_feature_table_substance_abuse.csv. Post Processing Step 3 complete.")
 
@@ -1,4 +1,14 @@
 #!/bin/bash
+POST_PROCESSING_MODE=$(jq -r '.post_processing_mode // "full"' config.json)
+
+if [ "$POST_PROCESSING_MODE" == "incremental" ]; then
+  # Only the chunk-level rows added since the last run are read and merged into ./Result/post_processing_state.db
+  nohup python3 -u incremental_post_processing.py > "Post Processing - Incremental.log" 2>&1 &
+  wait
+  echo "Post Processing completed. Please see fe_feature_table_obesity.csv and fe_feature_table_substance_abuse.csv for final results."
+  exit 0
+fi
+
 nohup python3 -u "Post Processing Step 1 - Aggregate Output.py" > "Post Processing Step 1 - Aggregate Output.log" 2>&1 &
 wait
 nohup python3 -u "Post Processing Step 2 - Generate Note Level Results.py" > "Post Processing Step 2 - Generate Note Level Results.log" 2>&1 &
@@ -0,0 +1,93 @@
+import time
+import json
+import sqlite3
+import hashlib
+
+# Content-addressed cache of annotation results ("annotation_cache": true in config.json).
+#
+# ./annotation_cache.db maps a hash of the text of a chunk (and of the CUI sets of the features) to
+# the feature statuses Pipeline Step 5 assigned to it. Before cTAKES runs, every chunk is looked up:
+# a chunk whose text was annotated before gets its result rows from the cache under its own note
+# metadata and never reaches cTAKES. The other chunks are recorded as pending with their hash, so
+# that Step 5 can store their statuses once their XMI is parsed. The least recently used entries
+# are evicted beyond a maximum number of entries.
+
+CACHE_PATH = "./annotation_cache.db"
+# Keys per query, under SQLite's limit on the number of parameters
+QUERY_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, statuses TEXT NOT NULL, last_used INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS pending (
+    folder_index INTEGER NOT NULL, chunk_name TEXT NOT NULL, key TEXT NOT NULL,
+    PRIMARY KEY (folder_index, chunk_name)
+);
+CREATE INDEX IF NOT EXISTS entries_by_use ON entries (last_used);
+"""
+
+def open_cache(path=CACHE_PATH):
+    """Open (creating if needed) the cache; several processes may use it at once."""
+    connection = sqlite3.connect(path, timeout=600)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+def fingerprint(cui_sets):
+    """Return a digest of `cui_sets` ({feature: CUIs}), so that changing a feature invalidates its entries."""
+    digest = hashlib.sha256()
+    for feature in sorted(cui_sets):
+        digest.update(feature.encode("utf-8") + b"\0" + "\n".join(sorted(cui_sets[feature])).encode("utf-8") + b"\0")
+    return digest.digest()
+
+def chunk_key(data, cui_fingerprint):
+    """Return the cache key of a chunk whose text (UTF-8) is `data`."""
+    return hashlib.sha256(cui_fingerprint + data).hexdigest()
+
+def lookup(connection, keys):
+    """Return {key: {feature: status}} for the cached `keys`, marking them as just used."""
+    found = {}
+    keys = list(keys)
+    for i in range(0, len(keys), QUERY_BATCH):
+        batch = keys[i:i + QUERY_BATCH]
+        rows = connection.execute(f"SELECT key, statuses FROM entries WHERE key IN ({', '.join('?' * len(batch))})", batch)
+        found.update((key, json.loads(statuses)) for key, statuses in rows)
+    now = time.time_ns()
+    connection.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+    return found
+
+def store(connection, entries, max_entries):
+    """Cache `entries` ({key: {feature: status}}), then evict the least recently used entries beyond `max_entries`; return the number evicted."""
+    now = time.time_ns()
+    connection.executemany(
+        "INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET statuses = excluded.statuses, last_used = excluded.last_used",
+        [(key, json.dumps(statuses, sort_keys=True), now) for key, statuses in entries.items()],
+    )
+    excess = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - max_entries
+    if excess <= 0:
+        return 0
+    connection.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)", (excess,))
+    return excess
+
+def add_pending(connection, folder_index, chunk_keys):
+    """Record the chunks of `folder_index` that have to be annotated, `chunk_keys` being {chunk_name: key}."""
+    connection.executemany(
+        "INSERT INTO pending VALUES (?, ?, ?) ON CONFLICT (folder_index, chunk_name) DO UPDATE SET key = excluded.key",
+        [(folder_index, name, key) for name, key in chunk_keys.items()],
+    )
+
+def get_pending(connection, folder_index, chunk_names):
+    """Return {chunk_name: key} for the pending `chunk_names` of `folder_index`."""
+    found = {}
+    for i in range(0, len(chunk_names), QUERY_BATCH):
+        names = chunk_names[i:i + QUERY_BATCH]
+        rows = connection.execute(
+            f"SELECT chunk_name, key FROM pending WHERE folder_index = ? AND chunk_name IN ({', '.join('?' * len(names))})",
+            (folder_index, *names),
+        )
+        found.update(rows)
+    return found
+
+def remove_pending(connection, folder_index, chunk_names):
+    """Forget the pending `chunk_names` of `folder_index` (in the transaction that stores their statuses)."""
+    connection.executemany("DELETE FROM pending WHERE folder_index = ? AND chunk_name = ?", [(folder_index, name) for name in chunk_names])
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import itertools
+import multiprocessing
+import annotation_cache
+import manifest
+import result_storage
+import pipeline_metrics
+import pipeline_scripts
+
+# Annotation cache lookup ("annotation_cache": true in config.json), run by Pipeline.sh between
+# Pipeline Steps 2 and 3. Every chunk of ./Input_chunk whose text is in the annotation cache gets its
+# rows in the chunk-level result tables right away and is removed, so cTAKES never sees it. The other
+# chunks are left pending for Pipeline Step 5 to cache once they are annotated.
+
+# Load configuration from config.json
+def load_config(config_path="config.json"):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+config = load_config()
+step5 = pipeline_scripts.load_script("Pipeline Step 5 - Process Output.py")
+
+NUM_PROCESSES = config["num_processes"]
+USE_MANIFEST = config.get("manifest", False)
+DIRECTORY_SHARDS = config.get("directory_shards", 0)
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+# Chunk files looked up at a time
+LOOKUP_BATCH_FILES = 10000
+
+def lookup_chunks(folder_index, chunk_files):
+    """
+    Look the chunk files `chunk_files`, a list of (file name, path) of folder `folder_index`, up
+    in the annotation cache. Chunks that are found get their result rows (see
+    process_chunk_statuses of Pipeline Step 5) and are removed; the others are recorded as pending.
+    Returns the number of chunks found.
+    """
+    keys = {}
+    for name, path in chunk_files:
+        with open(path, "rb") as f:
+            keys[name] = annotation_cache.chunk_key(f.read(), step5.CUI_FINGERPRINT)
+
+    cache = annotation_cache.open_cache()
+    with cache:
+        found = annotation_cache.lookup(cache, set(keys.values()))
+        annotation_cache.add_pending(cache, folder_index, {name: key for name, key in keys.items() if key not in found})
+    cache.close()
+
+    cached = {name: found[key] for name, key in keys.items() if key in found}
+    if cached:
+        step5.process_chunk_statuses(folder_index, cached)
+        for name, path in chunk_files:
+            if name in cached:
+                os.remove(path)
+    return len(cached)
+
+def lookup_folder(folder_index):
+    """
+    Look up every chunk of ./Input_chunk/Input_{folder_index} that has no XMI yet, LOOKUP_BATCH_FILES
+    at a time. With USE_MANIFEST, the chunks are looked up in the manifest instead of listed.
+    Returns (number of chunks looked up, number found).
+    """
+    chunk_files = pipeline_scripts.iter_pending_chunks(folder_index, USE_MANIFEST, DIRECTORY_SHARDS)
+
+    looked_up = found = 0
+    with pipeline_metrics.Timer(METRICS_PATH, "cache_lookup", unit="folder", key=folder_index) as timer:
+        while batch := list(itertools.islice(chunk_files, LOOKUP_BATCH_FILES)):
+            batch_found = lookup_chunks(folder_index, batch)
+            found += batch_found
+            looked_up += len(batch)
+            timer.add(chunks=len(batch), found=batch_found)
+    print(f"[Input_{folder_index}] Found {found} of {looked_up} chunk(s) in the annotation cache.")
+    return looked_up, found
+
+def main():
+    start_time = time.time()
+    result_storage.check_result_format(step5.RESULT_FORMAT)
+    if USE_MANIFEST:
+        # Create the manifest before the processes open it
+        manifest.open_manifest().close()
+    annotation_cache.open_cache().close()
+    folder_indices = range(1, NUM_PROCESSES + 1)
+    with pipeline_metrics.Timer(METRICS_PATH, "cache_lookup"), multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+        results = pool.map(lookup_folder, folder_indices)
+
+    looked_up = sum(result[0] for result in results)
+    found = sum(result[1] for result in results)
+    hit_rate = found / looked_up if looked_up else 0
+    print(f"Annotation cache hit rate: {found} of {looked_up} chunk(s) ({hit_rate:.1%}) skipped cTAKES.")
+    print(f"Annotation cache lookup completed in {time.time() - start_time:.1f} seconds.")
+
+if __name__ == "__main__":
+    main()
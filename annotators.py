@@ -0,0 +1,148 @@
+import os
+import json
+import signal
+import subprocess
+
+# The annotator backends Pipeline Step 3 can drive. An annotator turns a folder of chunk files
+# {name} into a folder of {name}.xmi files.
+#
+# "cli" runs a command (by default cTAKES' runClinicalPipeline.sh) once per batch, paying the JVM
+# and dictionary start-up every time.
+#
+# "persistent" starts one long-lived worker process and keeps it (and its models) warm between
+# batches. The worker reads one JSON request per line on stdin,
+#     {"input": "/abs/input/folder", "output": "/abs/output/folder"}
+# annotates the folder and answers with one JSON line on stdout,
+#     {"status": "ok", "count": <number of XMI files written>}
+# cTAKES ships no such server and none is included here: the worker is supplied by the user.
+# `python3 stub_annotator.py --serve` implements this protocol for testing. There is no default
+# persistent command: the stub must never annotate production notes by accident.
+#
+# Both run their command in a process group of its own, so that kill() also stops the JVM a launch
+# script like runClinicalPipeline.sh starts.
+
+DEFAULT_CLI_COMMAND = [
+    "./cTAKES/apache-ctakes-4.0.0.1_{worker}/bin/runClinicalPipeline.sh",
+    "-i", "{input}", "--xmiOut", "{output}",
+    "--user", "{user}", "--pass", "{password}", "--key", "{key}",
+]
+
+def fill_command(command, **values):
+    """Fill in the {placeholders} of every argument of `command`."""
+    return [part.format(**values) for part in command]
+
+class Annotator:
+    """Base class of the annotator backends."""
+
+    def __init__(self, worker_id, config):
+        self.worker_id = worker_id
+        self.values = {
+            "worker": worker_id,
+            "user": config.get("UMLS_username", ""),
+            "password": config.get("UMLS_password", ""),
+            "key": config.get("UMLS_API_key", ""),
+        }
+
+    def start(self):
+        """Prepare the backend before the first batch."""
+
+    def annotate(self, input_folder, output_folder):
+        """Annotate every file of `input_folder` into `output_folder`; return True on success."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the backend after the last batch."""
+
+    def kill(self):
+        """Kill a running annotation (called from another thread); the next batch starts a fresh process."""
+
+def kill_process_group(process):
+    """Kill `process` and every process it started, if it is still running."""
+    if process is not None and process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+class CliAnnotator(Annotator):
+    """Runs `annotator_command` once per batch."""
+
+    def __init__(self, worker_id, config):
+        super().__init__(worker_id, config)
+        self.command = config.get("annotator_command", DEFAULT_CLI_COMMAND)
+        self.process = None
+
+    def annotate(self, input_folder, output_folder):
+        command = fill_command(self.command, input=os.path.abspath(input_folder), output=os.path.abspath(output_folder), **self.values)
+        self.process = subprocess.Popen(command, start_new_session=True)
+        returncode = self.process.wait()
+        if returncode != 0:
+            print(f"[Worker {self.worker_id}] Annotator exited with code {returncode}.")
+        return returncode == 0
+
+    def kill(self):
+        kill_process_group(self.process)
+
+class PersistentAnnotator(Annotator):
+    """Keeps one `persistent_annotator_command` process alive and sends it one request per batch."""
+
+    def __init__(self, worker_id, config):
+        super().__init__(worker_id, config)
+        self.command = config.get("persistent_annotator_command")
+        if not self.command:
+            raise ValueError(
+                'annotator_backend "persistent" requires persistent_annotator_command, the command of the '
+                "long-lived annotator (see README.md)"
+            )
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            fill_command(self.command, **self.values),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1, start_new_session=True,
+        )
+
+    def annotate(self, input_folder, output_folder):
+        if self.process is None or self.process.poll() is not None:
+            # The worker died (or was never started); bring up a fresh one
+            self.start()
+
+        request = {"input": os.path.abspath(input_folder), "output": os.path.abspath(output_folder)}
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+            reply = self.process.stdout.readline()
+        except (BrokenPipeError, OSError) as e:
+            print(f"[Worker {self.worker_id}] Persistent annotator failed: {e}")
+            return False
+
+        if not reply:
+            print(f"[Worker {self.worker_id}] Persistent annotator exited with code {self.process.wait()}.")
+            return False
+        return json.loads(reply).get("status") == "ok"
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            kill_process_group(self.process)
+            self.process.wait()
+        self.process = None
+
+    def kill(self):
+        kill_process_group(self.process)
+
+ANNOTATOR_BACKENDS = {
+    "cli": CliAnnotator,
+    "persistent": PersistentAnnotator,
+}
+
+def make_annotator(worker_id, config):
+    """Create the annotator selected by `annotator_backend` for one worker."""
+    backend = config.get("annotator_backend", "cli")
+    if backend not in ANNOTATOR_BACKENDS:
+        raise ValueError(f"Unknown annotator_backend '{backend}'; expected one of {sorted(ANNOTATOR_BACKENDS)}")
+    return ANNOTATOR_BACKENDS[backend](worker_id, config)
@@ -1,7 +1,17 @@
 #!/bin/bash
 
-# Define the target directory
-TARGET_DIR="./Input"
+# With the manifest, count the notes and chunks of each state instead of scanning the folders
+if [ "$(jq -r '.manifest // false' config.json)" == "true" ]; then
+  python3 manifest.py
+  exit $?
+fi
+
+# Define the target directory (in fused mode the notes are written as chunks straight to ./Input_chunk)
+if [ "$(jq -r '.fuse_prepare_and_chunk // false' config.json)" == "true" ]; then
+  TARGET_DIR="./Input_chunk"
+else
+  TARGET_DIR="./Input"
+fi
 
 # Efficiently count the total number of TXT files (including subdirectories)
 CSV_COUNT=$(find "$TARGET_DIR" -type f -name "*.txt" | wc -l)
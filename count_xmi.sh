@@ -1,5 +1,11 @@
 #!/bin/bash
 
+# With the manifest, count the notes and chunks of each state instead of scanning the folders
+if [ "$(jq -r '.manifest // false' config.json)" == "true" ]; then
+  python3 manifest.py
+  exit $?
+fi
+
 # Define the target directory
 TARGET_DIR="./Output"
 
@@ -0,0 +1,315 @@
+import os
+import glob
+import json
+import shutil
+import threading
+import time
+import collections
+from annotators import make_annotator
+from note_chunking import split_in_two, piece_file_name
+import manifest
+import sharding
+import pipeline_metrics
+
+# Load configuration from config.json
+def load_config(config_path="config.json"):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+config = load_config()
+
+NUM_PROCESSES = config["num_processes"]
+NUM_WORKERS = config.get("ctakes_workers", NUM_PROCESSES)
+BATCH_SIZE = config.get("ctakes_batch_size", 50)
+USE_MANIFEST = config.get("manifest", False)
+DIRECTORY_SHARDS = config.get("directory_shards", 0)
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+# A batch is killed once this many seconds pass without a new XMI file (0 turns the watchdog off)
+STALL_TIMEOUT_SECONDS = config.get("ctakes_stall_timeout_seconds", 0)
+WATCHDOG_POLL_SECONDS = 1
+# A stalled chunk of at most this many bytes is not split any further
+MIN_SPLIT_BYTES = 256
+BASE_INPUT = "./Input_chunk"
+BASE_OUTPUT = "./Output"
+BASE_STAGING = "./cTAKES_staging"
+
+class BatchQueue:
+    """
+    The batches the workers share. Besides the batches put by the producer, a worker puts back the
+    retries of a batch (see run_batch) before marking it done, so get() only returns None (stop)
+    once the queue is closed and no batch is queued or being worked on.
+    """
+
+    def __init__(self):
+        self.batches = collections.deque()
+        self.in_progress = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, batch):
+        with self.condition:
+            self.batches.append(batch)
+            self.condition.notify()
+
+    def close(self):
+        """No more batches will be put, other than retries."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def get(self):
+        """Wait for the next batch; return None once there is none left. Every batch must be followed by task_done()."""
+        with self.condition:
+            while not self.batches and not (self.closed and self.in_progress == 0):
+                self.condition.wait()
+            if not self.batches:
+                return None
+            self.in_progress += 1
+            return self.batches.popleft()
+
+    def task_done(self):
+        with self.condition:
+            self.in_progress -= 1
+            self.condition.notify_all()
+
+    def qsize(self):
+        with self.condition:
+            return len(self.batches)
+
+def reset_directory(path):
+    """Remove `path` with everything in it and create it again empty."""
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+def folder_index_of(folder):
+    """Return k for a folder named Input_k."""
+    return int(os.path.basename(folder).rsplit("_", 1)[-1])
+
+def build_batches(batch_size=BATCH_SIZE):
+    """
+    List the chunk files of every ./Input_chunk/Input_k that do not have an XMI in
+    ./Output/Output_k yet, and split them into batches of (folder_index, file name) of at
+    most `batch_size` files. A batch never mixes folders, so file names within a batch are
+    unique. Batches of different folders are interleaved so that every folder makes progress.
+    With USE_MANIFEST, the chunk files are looked up in the manifest instead of listed.
+    """
+    connection = manifest.open_manifest() if USE_MANIFEST else None
+    if connection is not None:
+        folder_indices = manifest.list_folders(connection)
+    else:
+        folder_indices = sorted(map(folder_index_of, glob.glob(os.path.join(BASE_INPUT, "Input_*"))))
+
+    folder_batches = []
+    for folder_index in folder_indices:
+        input_folder = os.path.join(BASE_INPUT, f"Input_{folder_index}")
+        output_folder = os.path.join(BASE_OUTPUT, f"Output_{folder_index}")
+        if connection is not None:
+            chunk_names = manifest.list_chunks(connection, folder_index, "chunked")
+        else:
+            chunk_names = (name for name, _ in sharding.iter_files(input_folder, ".txt"))
+        names = sorted(name for name in chunk_names if not os.path.exists(sharding.file_path(output_folder, name + ".xmi", DIRECTORY_SHARDS)))
+        folder_batches.append([
+            [(folder_index, name) for name in names[i:i + batch_size]]
+            for i in range(0, len(names), batch_size)
+        ])
+    if connection is not None:
+        connection.close()
+
+    batches = []
+    for i in range(max(map(len, folder_batches), default=0)):
+        batches.extend(batches_of_folder[i] for batches_of_folder in folder_batches if i < len(batches_of_folder))
+    return batches
+
+def link_or_copy(src, dst):
+    """Hard link `src` to `dst`, copying it if the two are on different file systems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def count_files(folder):
+    """Return the number of entries of `folder`."""
+    with os.scandir(folder) as entries:
+        return sum(1 for _ in entries)
+
+def annotate_watched(worker_id, annotator, staging_input, staging_output):
+    """
+    Annotate `staging_input` into `staging_output`. With STALL_TIMEOUT_SECONDS, a watchdog kills
+    the annotator once that many seconds pass without a new XMI file; the next batch restarts it.
+    Returns whether the annotator was killed, and whether it succeeded (a killed one did not).
+    """
+    if not STALL_TIMEOUT_SECONDS:
+        return False, annotator.annotate(staging_input, staging_output)
+
+    result = {"ok": False}
+    thread = threading.Thread(target=lambda: result.update(ok=annotator.annotate(staging_input, staging_output)))
+    thread.start()
+    produced, last_progress = 0, time.monotonic()
+    while True:
+        thread.join(WATCHDOG_POLL_SECONDS)
+        if not thread.is_alive():
+            return False, result["ok"]
+        count = count_files(staging_output)
+        if count != produced:
+            produced, last_progress = count, time.monotonic()
+        elif time.monotonic() - last_progress > STALL_TIMEOUT_SECONDS:
+            print(f"[Worker {worker_id}] No new XMI file for {STALL_TIMEOUT_SECONDS} seconds; killing the annotator.")
+            annotator.kill()
+            thread.join()
+            return True, False
+
+def annotate_batch(worker_id, annotator, batch):
+    """
+    Stage `batch` into the worker's own flat input directory, annotate it, and move every XMI
+    produced to ./Output/Output_k of the folder its chunk came from (into its shard subdirectory
+    if DIRECTORY_SHARDS is set). The chunk files stay in
+    ./Input_chunk so that Pipeline Step 4 can still match them against their XMIs.
+    With USE_MANIFEST, the chunks that produced an XMI are recorded as annotated.
+    Returns the chunks of `batch` that produced an XMI, whether the annotator stalled, and whether
+    it succeeded.
+    """
+    staging_input = os.path.join(BASE_STAGING, f"Worker_{worker_id}", "Input")
+    staging_output = os.path.join(BASE_STAGING, f"Worker_{worker_id}", "Output")
+    reset_directory(staging_input)
+    reset_directory(staging_output)
+
+    for folder_index, name in batch:
+        link_or_copy(sharding.file_path(os.path.join(BASE_INPUT, f"Input_{folder_index}"), name, DIRECTORY_SHARDS), os.path.join(staging_input, name))
+
+    stalled, ok = annotate_watched(worker_id, annotator, staging_input, staging_output)
+
+    annotated = []
+    for folder_index, name in batch:
+        xmi_path = os.path.join(staging_output, f"{name}.xmi")
+        if os.path.exists(xmi_path):
+            output_folder = os.path.join(BASE_OUTPUT, f"Output_{folder_index}")
+            shutil.move(xmi_path, sharding.new_file_path(output_folder, f"{name}.xmi", DIRECTORY_SHARDS))
+            annotated.append((folder_index, name))
+
+    if USE_MANIFEST and annotated:
+        connection = manifest.open_manifest()
+        with connection:
+            for folder_index in {folder_index for folder_index, _ in annotated}:
+                manifest.set_chunk_state(connection, folder_index, [name for index, name in annotated if index == folder_index], "annotated")
+        connection.close()
+
+    shutil.rmtree(os.path.join(BASE_STAGING, f"Worker_{worker_id}"), ignore_errors=True)
+    return annotated, stalled, ok
+
+def split_stalled_chunk(folder_index, name):
+    """
+    Replace the chunk file `name` of ./Input_chunk/Input_{folder_index} by two smaller pieces
+    holding the same text (see note_chunking.split_in_two), and return them as chunks of the
+    folder. Returns no chunks, and leaves the file alone, if it is at most MIN_SPLIT_BYTES.
+    """
+    input_folder = os.path.join(BASE_INPUT, f"Input_{folder_index}")
+    path = sharding.file_path(input_folder, name, DIRECTORY_SHARDS)
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        text = file.read()
+    if len(text.encode("utf-8")) <= MIN_SPLIT_BYTES:
+        return []
+
+    pieces = [piece_file_name(name, piece_id) for piece_id in (1, 2)]
+    for piece, piece_text in zip(pieces, split_in_two(text)):
+        with open(sharding.new_file_path(input_folder, piece, DIRECTORY_SHARDS), "w", encoding="utf-8", newline="") as file:
+            file.write(piece_text)
+    if USE_MANIFEST:
+        connection = manifest.open_manifest()
+        with connection:
+            manifest.replace_chunk(connection, folder_index, name, pieces)
+        connection.close()
+    os.remove(path)
+    return [(folder_index, piece) for piece in pieces]
+
+def run_batch(worker_id, annotator, batch, work_queue):
+    """
+    Annotate `batch` (see annotate_batch). When the watchdog kills a stalled batch, or the annotator
+    fails, the chunks of the batch without an XMI are put back on `work_queue` in two halves, so
+    that any idle worker can retry them, until the chunk that stalls or fails is alone. A chunk
+    that stalls alone is split into two pieces of text (see split_stalled_chunk), which are queued
+    the same way; a chunk that fails alone is left without an XMI.
+    Returns the number of XMI files produced, of chunks left without an XMI, and of chunks added
+    by splitting.
+    """
+    annotated, stalled, ok = annotate_batch(worker_id, annotator, batch)
+    annotated = set(annotated)
+    left = [chunk for chunk in batch if chunk not in annotated]
+    if not left:
+        return len(annotated), 0, 0
+    if not ok and not stalled:
+        print(f"[Worker {worker_id}] The annotator failed; {len(left)} of {len(batch)} chunk(s) have no XMI.")
+    if ok:
+        return len(annotated), len(left), 0
+    if len(left) > 1:
+        work_queue.put(left[:len(left) // 2])
+        work_queue.put(left[len(left) // 2:])
+        return len(annotated), 0, 0
+    if not stalled:
+        return len(annotated), 1, 0
+
+    pieces = split_stalled_chunk(*left[0])
+    if not pieces:
+        print(f"[Worker {worker_id}] The stalled chunk {left[0][1]} is too small to split; leaving it without an XMI.")
+        return len(annotated), 1, 0
+    print(f"[Worker {worker_id}] Split the stalled chunk {left[0][1]} into {len(pieces)} pieces.")
+    work_queue.put(pieces)
+    return len(annotated), 0, len(pieces) - 1
+
+def worker_loop(worker_id, annotator, work_queue, progress):
+    """Keep pulling batches from `work_queue` (a BatchQueue) until none is left, annotating them with `annotator`."""
+    annotator.start()
+    try:
+        while (batch := work_queue.get()) is not None:
+            try:
+                process_batch(worker_id, annotator, batch, work_queue, progress)
+            finally:
+                work_queue.task_done()
+    finally:
+        annotator.close()
+
+def process_batch(worker_id, annotator, batch, work_queue, progress):
+    """Annotate one batch and report the progress of the whole queue (retried chunks count once done)."""
+    with pipeline_metrics.Timer(METRICS_PATH, "step3", unit="worker", key=worker_id, threaded=True, queue_depth=work_queue.qsize()) as timer:
+        produced, missing, added = run_batch(worker_id, annotator, batch, work_queue)
+        timer.add(chunks=len(batch), xmi_files=produced, missing=missing)
+    with progress["lock"]:
+        progress["batches"] += 1
+        progress["chunks"] += produced + missing
+        progress["total"] += added
+        progress["xmi"] += produced
+        print(
+            f"[Worker {worker_id}] Annotated {produced}/{len(batch)} chunk(s). "
+            f"Progress: {progress['chunks']}/{progress['total']} chunk(s), {work_queue.qsize()} batch(es) queued."
+        )
+
+def main():
+    start_time = time.time()
+
+    batches = build_batches()
+    total = sum(len(batch) for batch in batches)
+    print(f"Queued {total} chunk(s) in {len(batches)} batch(es) of up to {BATCH_SIZE}. Annotating with {NUM_WORKERS} worker(s).")
+
+    work_queue = BatchQueue()
+    for batch in batches:
+        work_queue.put(batch)
+    work_queue.close()
+
+    progress = {"lock": threading.Lock(), "batches": 0, "chunks": 0, "xmi": 0, "total": total}
+    # Create the annotators first, so that a configuration error stops the step before any work
+    annotators = {worker_id: make_annotator(worker_id, config) for worker_id in range(1, NUM_WORKERS + 1)}
+    workers = [
+        threading.Thread(target=worker_loop, args=(worker_id, annotators[worker_id], work_queue, progress))
+        for worker_id in range(1, NUM_WORKERS + 1)
+    ]
+    with pipeline_metrics.Timer(METRICS_PATH, "step3", total=total, total_counter="chunks"):
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    shutil.rmtree(BASE_STAGING, ignore_errors=True)
+
+    print(f"All {NUM_WORKERS} workers have completed cTAKES annotation: {progress['xmi']}/{progress['total']} chunk(s) produced an XMI. Pipeline Step 3 complete.")
+    print(f"Total execution time: {int(time.time() - start_time)} seconds.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import os
+import glob
+import json
+import time
+import sqlite3
+import pandas as pd
+import result_storage
+import pipeline_metrics
+import pipeline_scripts
+
+# Incremental post processing ("post_processing_mode": "incremental" in config.json).
+#
+# Instead of re-aggregating every chunk-level table from scratch, this keeps the note-level and the
+# encounter-level results in a SQLite database (./Result/post_processing_state.db) together with a
+# watermark per chunk-level table: the byte offset up to which a CSV has been read, or the part files
+# of a columnar table that have been read. Every run only reads the rows appended since the last run,
+# merges them into the stored state with the Feature_Status ranking (highest rank wins) and the
+# earliest-date rule (earliest Feature_dt and its ProviderID win), and rewrites the note-level and
+# final tables from the state. Both merges are idempotent, so reading a row twice never changes a result.
+# The merge only costs what was appended, but the note-level and final tables are always rewritten in
+# full from the state, which grows with the history; a feature without new rows keeps its tables.
+
+# Load configuration from config.json
+def load_config(config_path="config.json"):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+config = load_config()
+step1 = pipeline_scripts.load_script("Post Processing Step 1 - Aggregate Output.py")
+step3 = pipeline_scripts.load_script("Post Processing Step 3 - Generate Final Results.py")
+
+NUM_PROCESSES = config["num_processes"]
+RESULT_FORMAT = config.get("result_format", "csv")
+CHUNK_ROWS = config.get("post_processing_chunk_rows", 500000)
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+BASE_RESULT = "./Result"
+STATE_PATH = os.path.join(BASE_RESULT, "post_processing_state.db")
+
+NOTE_KEYS = ["PatID", "EncounterID", "NoteID", "FeatureID", "Feature_dt", "Feature", "FE_CodeType", "ProviderID", "Confidence"]
+NOTE_COLUMNS = NOTE_KEYS + ["Feature_Status"]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS watermarks (path TEXT PRIMARY KEY, offset INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS notes (
+    feature_name TEXT NOT NULL, {", ".join(f"{column} TEXT NOT NULL" for column in NOTE_KEYS)}, rank INTEGER NOT NULL,
+    PRIMARY KEY (feature_name, {", ".join(NOTE_KEYS)})
+);
+CREATE TABLE IF NOT EXISTS encounters (
+    feature_name TEXT NOT NULL, {", ".join(f"{column} TEXT NOT NULL" for column in step3.GROUPING_COLUMNS)},
+    Feature_dt TEXT, ProviderID TEXT, rank INTEGER NOT NULL,
+    PRIMARY KEY (feature_name, {", ".join(step3.GROUPING_COLUMNS)})
+);
+"""
+
+UPSERT_NOTE = f"""
+INSERT INTO notes (feature_name, {", ".join(NOTE_KEYS)}, rank) VALUES ({", ".join("?" * (len(NOTE_KEYS) + 2))})
+ON CONFLICT (feature_name, {", ".join(NOTE_KEYS)}) DO UPDATE SET rank = MAX(notes.rank, excluded.rank)
+"""
+
+UPSERT_ENCOUNTER = f"""
+INSERT INTO encounters (feature_name, {", ".join(step3.GROUPING_COLUMNS)}, Feature_dt, ProviderID, rank)
+VALUES ({", ".join("?" * (len(step3.GROUPING_COLUMNS) + 4))})
+ON CONFLICT (feature_name, {", ".join(step3.GROUPING_COLUMNS)}) DO UPDATE SET
+    Feature_dt = CASE WHEN encounters.Feature_dt IS NULL OR excluded.Feature_dt < encounters.Feature_dt
+                 THEN excluded.Feature_dt ELSE encounters.Feature_dt END,
+    ProviderID = CASE WHEN encounters.Feature_dt IS NULL OR excluded.Feature_dt < encounters.Feature_dt
+                 THEN excluded.ProviderID ELSE encounters.ProviderID END,
+    rank = MAX(encounters.rank, excluded.rank)
+"""
+
+def open_state(path=STATE_PATH):
+    """Open (creating if needed) the post processing state database."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+def records(df, columns):
+    """Return the rows of `df[columns]` as tuples of plain Python values (None for missing values)."""
+    df = df[columns].astype(object).where(df[columns].notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+def merge_rows(connection, feature, df):
+    """Merge chunk-level rows of `feature` into the note-level and encounter-level state."""
+    # Like the groupbys of the full mode, rows with a missing key are left out
+    df = df.dropna(subset=NOTE_KEYS).astype({column: str for column in NOTE_KEYS})
+    if df.empty:
+        return
+
+    notes = step1.max_status_by_group(df, NOTE_KEYS)
+    notes.insert(0, "feature_name", feature)
+    notes["Feature_Status"] = notes["Feature_Status"].map(step1.STATUS_ORDER)
+    connection.executemany(UPSERT_NOTE, records(notes, ["feature_name"] + NOTE_COLUMNS))
+
+    encounters = step3.aggregate_encounters(df)
+    encounters.insert(0, "feature_name", feature)
+    encounters["Feature_Status"] = encounters["Feature_Status"].map(step3.STATUS_ORDER)
+    columns = ["feature_name"] + step3.GROUPING_COLUMNS + ["Feature_dt", "ProviderID", "Feature_Status"]
+    connection.executemany(UPSERT_ENCOUNTER, records(encounters, columns))
+
+def get_watermark(connection, path):
+    row = connection.execute("SELECT offset FROM watermarks WHERE path = ?", (path,)).fetchone()
+    return row[0] if row else None
+
+def set_watermark(connection, path, offset):
+    connection.execute("INSERT INTO watermarks (path, offset) VALUES (?, ?) ON CONFLICT (path) DO UPDATE SET offset = excluded.offset", (path, offset))
+
+def update_from_csv(connection, feature, csv_path):
+    """Merge the rows appended to `csv_path` since its watermark (a byte offset); return the number of rows read."""
+    size = os.path.getsize(csv_path)
+    offset = get_watermark(connection, csv_path)
+    if offset is not None and size < offset:
+        # The file was recreated; reading it again from the start is safe since the merges are idempotent
+        print(f"{csv_path} is smaller than its watermark; reading it again from the start.")
+        offset = None
+    if offset == size:
+        return 0
+
+    rows = 0
+    with open(csv_path, "rb") as f:
+        header = f.readline().decode("utf-8").strip().split(",")
+        if offset is not None:
+            f.seek(offset)
+        for df in pd.read_csv(f, header=None, names=header, dtype=str, chunksize=CHUNK_ROWS):
+            merge_rows(connection, feature, df)
+            rows += len(df)
+        # Commit the merged rows and the new watermark together
+        set_watermark(connection, csv_path, f.tell())
+        connection.commit()
+    return rows
+
+def update_from_parts(connection, feature, table_folder):
+    """Merge the part files of the partitioned table `table_folder` that have not been read yet; return the number of rows read."""
+    rows = 0
+    for part in sorted(glob.glob(os.path.join(table_folder, "*" + result_storage.EXTENSIONS[RESULT_FORMAT]))):
+        if get_watermark(connection, part) is not None:
+            continue
+        df = result_storage.read_table(part, RESULT_FORMAT, columns=NOTE_COLUMNS)
+        merge_rows(connection, feature, df.astype({column: object for column in df.columns}))
+        set_watermark(connection, part, os.path.getsize(part))
+        connection.commit()
+        rows += len(df)
+    return rows
+
+def numeric_if_possible(df, columns):
+    """Convert `columns` of `df` to numbers where every value is numeric, as reading a CSV with pandas would."""
+    for column in columns:
+        try:
+            df[column] = pd.to_numeric(df[column])
+        except (ValueError, TypeError):
+            pass
+    return df
+
+def tables_exist(feature):
+    """Return whether every table write_tables writes for `feature` exists."""
+    names = [f"./fe_feature_detail_table_{feature}", f"fe_feature_table_{feature}"]
+    return all(os.path.exists(name + extension) for name in names for extension in {result_storage.EXTENSIONS[RESULT_FORMAT], ".csv"})
+
+def write_tables(connection, feature, feature_id, description):
+    """Rewrite the note-level and the final table of `feature` from the state."""
+    notes = pd.read_sql_query(f"SELECT {', '.join(NOTE_KEYS)}, rank AS Feature_Status FROM notes WHERE feature_name = ?", connection, params=(feature,))
+    notes["Feature_Status"] = notes["Feature_Status"].map(step1.RANK_STATUS)
+    notes = numeric_if_possible(notes, ["PatID", "EncounterID", "NoteID", "FeatureID", "ProviderID"])
+    for path in result_storage.write_final_table(notes, f"./fe_feature_detail_table_{feature}", RESULT_FORMAT):
+        print(f"Note level table saved to {path} ({len(notes)} rows)")
+
+    encounters = pd.read_sql_query(
+        f"SELECT {', '.join(step3.GROUPING_COLUMNS)}, Feature_dt, ProviderID, rank AS Feature_Status FROM encounters WHERE feature_name = ?",
+        connection, params=(feature,),
+    )
+    encounters["Feature_Status"] = encounters["Feature_Status"].map(step3.RANK_STATUS)
+    encounters = numeric_if_possible(encounters, ["PatID", "EncounterID", "ProviderID"])
+    encounters = step3.finalize_feature_table(encounters[step3.OUTPUT_COLUMNS], feature_id)
+    step3.write_pipeline_table(feature, feature_id, description)
+    for path in result_storage.write_final_table(encounters, f"fe_feature_table_{feature}", RESULT_FORMAT):
+        print(f"Saved {path} ({len(encounters)} rows)")
+
+def main():
+    result_storage.check_result_format(RESULT_FORMAT)
+    start_time = time.time()
+    connection = open_state()
+
+    with pipeline_metrics.Timer(METRICS_PATH, "post_incremental"):
+        for feature, (feature_id, description) in step3.FEATURES.items():
+            with pipeline_metrics.Timer(METRICS_PATH, "post_incremental", unit="feature", key=feature) as timer:
+                rows = 0
+                for folder_index in range(1, NUM_PROCESSES + 1):
+                    table_name = os.path.join(BASE_RESULT, f"Result_{folder_index}", feature, f"fe_feature_detail_table_{feature}_{folder_index}")
+                    if RESULT_FORMAT == "csv" and os.path.exists(f"{table_name}.csv"):
+                        rows += update_from_csv(connection, feature, f"{table_name}.csv")
+                    elif RESULT_FORMAT != "csv" and os.path.isdir(table_name):
+                        rows += update_from_parts(connection, feature, table_name)
+                timer.add(rows=rows)
+                print(f"[{feature}] Merged {rows} new chunk-level row(s) into {STATE_PATH}.")
+                if rows or not tables_exist(feature):
+                    write_tables(connection, feature, feature_id, description)
+                else:
+                    print(f"[{feature}] No new rows; the note-level and final tables are unchanged.")
+
+    connection.close()
+    print(f"Incremental post processing completed in {time.time() - start_time:.1f} seconds.")
+
+if __name__ == "__main__":
+    main()
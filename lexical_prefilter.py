@@ -0,0 +1,53 @@
+import os
+import re
+
+# Lexical prefilter of the chunks ("prefilter_mode" in config.json).
+#
+# cTAKES can only give a chunk a status other than "U" for a feature if it finds one of the CUIs of
+# ./CUI/{feature}_umls_cui_clean.txt in it, which takes one of their terms (or a synonym cTAKES knows
+# for them) in its text. The prefilter compiles the terms and the configured synonyms into a single
+# case-insensitive pattern, and a chunk without a match gets status "U" for every feature without
+# going through cTAKES. The words of a term may be separated by any non-word characters and the
+# last one may be followed by more letters (e.g. "obese" matches "obesely"), so the pattern errs on
+# the side of sending a chunk to cTAKES.
+#
+# "validate" skips nothing, but makes Pipeline Step 5 check every chunk the prefilter would have
+# skipped against the statuses cTAKES gave it.
+
+PREFILTER_MODES = ("off", "on", "validate")
+
+def load_terms(features, cui_folder="./CUI"):
+    """Return the terms (the part of each line before "|") of the CUI lists of `features`."""
+    terms = []
+    for feature in features:
+        with open(os.path.join(cui_folder, f"{feature}_umls_cui_clean.txt"), "r") as file:
+            terms.extend(line.rpartition("|")[0].strip() for line in file)
+    return [term for term in terms if term]
+
+def term_words(term):
+    return re.findall(r"\w+", term.lower())
+
+class TermMatcher:
+    """
+    Matches the terms given to it in a text. A term that contains another term is left out, since
+    the shorter term matches wherever it does. Since most texts contain none of the terms, a text
+    is first checked for the longest (so most likely rare) word of any term with plain substring
+    searches, and only a text that has one is searched with the pattern.
+    """
+
+    def __init__(self, terms):
+        phrases = sorted({" ".join(words) for words in map(term_words, terms) if words}, key=len)
+        kept = []
+        for phrase in phrases:
+            if not any(f" {shorter} " in f" {phrase} " for shorter in kept):
+                kept.append(phrase)
+        self.key_words = sorted({max(phrase.split(), key=len) for phrase in kept})
+        alternatives = (r"\W+".join(map(re.escape, phrase.split())) for phrase in kept)
+        self.pattern = re.compile(r"\b(?:" + "|".join(alternatives) + ")", re.IGNORECASE)
+
+    def matches(self, text):
+        """Return whether `text` contains one of the terms, i.e. has to go through cTAKES."""
+        lowered = text.lower()
+        if not any(word in lowered for word in self.key_words):
+            return False
+        return self.pattern.search(text) is not None
@@ -0,0 +1,131 @@
+import sys
+import sqlite3
+
+# Manifest of the notes and chunks of a run ("manifest": true in config.json).
+#
+# ./manifest.db records every note with its metadata (patient, encounter, note, date and provider
+# read from the CSV, not parsed out of a file name), the folder it was assigned to and its state, and
+# every chunk with the note it belongs to and its state:
+#     notes:  ingested (written to ./Input) -> chunked
+#     chunks: chunked (written to ./Input_chunk) -> annotated (has an XMI) -> parsed (in the result tables)
+# The pipeline steps record their work in batched transactions and query the manifest for the
+# notes and chunks they have to process instead of listing the folders.
+
+MANIFEST_PATH = "./manifest.db"
+CHUNK_STATES = ["chunked", "annotated", "parsed"]
+# Chunk names per query, under SQLite's limit on the number of parameters
+QUERY_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    folder_index INTEGER NOT NULL, note_name TEXT NOT NULL,
+    patient_id TEXT, encounter_id TEXT, note_id TEXT, note_date TEXT, provider_id TEXT,
+    state TEXT NOT NULL,
+    PRIMARY KEY (folder_index, note_name)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    folder_index INTEGER NOT NULL, chunk_name TEXT NOT NULL, note_name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (folder_index, chunk_name)
+);
+CREATE INDEX IF NOT EXISTS notes_by_state ON notes (folder_index, state);
+CREATE INDEX IF NOT EXISTS chunks_by_state ON chunks (folder_index, state);
+"""
+
+def open_manifest(path=MANIFEST_PATH):
+    """Open (creating if needed) the manifest; several processes may use it at once."""
+    connection = sqlite3.connect(path, timeout=600)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+def add_notes(connection, notes, state="ingested"):
+    """Record `notes`, a list of (folder_index, note_name, patient_id, encounter_id, note_id, note_date, provider_id)."""
+    connection.executemany(
+        """
+        INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (folder_index, note_name) DO UPDATE SET
+            patient_id = excluded.patient_id, encounter_id = excluded.encounter_id, note_id = excluded.note_id,
+            note_date = excluded.note_date, provider_id = excluded.provider_id, state = excluded.state
+        """,
+        [(*note, state) for note in notes],
+    )
+
+def add_chunks(connection, chunks):
+    """Record `chunks`, a list of (folder_index, chunk_name, note_name), and mark their notes as chunked."""
+    connection.executemany(
+        """
+        INSERT INTO chunks VALUES (?, ?, ?, 'chunked')
+        ON CONFLICT (folder_index, chunk_name) DO UPDATE SET note_name = excluded.note_name, state = 'chunked'
+        """,
+        chunks,
+    )
+    connection.executemany(
+        "UPDATE notes SET state = 'chunked' WHERE folder_index = ? AND note_name = ?",
+        sorted({(folder_index, note_name) for folder_index, _, note_name in chunks}),
+    )
+
+def replace_chunk(connection, folder_index, chunk_name, piece_names):
+    """Replace the chunk `chunk_name` of `folder_index` by the chunks `piece_names` of the same note."""
+    row = connection.execute("SELECT note_name FROM chunks WHERE folder_index = ? AND chunk_name = ?", (folder_index, chunk_name)).fetchone()
+    if row is None:
+        return
+    connection.execute("DELETE FROM chunks WHERE folder_index = ? AND chunk_name = ?", (folder_index, chunk_name))
+    add_chunks(connection, [(folder_index, name, row[0]) for name in piece_names])
+
+def set_chunk_state(connection, folder_index, chunk_names, state):
+    """Advance the given chunks of `folder_index` to `state`; a chunk never moves back to an earlier state."""
+    earlier = CHUNK_STATES[:CHUNK_STATES.index(state)]
+    connection.executemany(
+        f"UPDATE chunks SET state = ? WHERE folder_index = ? AND chunk_name = ? AND state IN ({', '.join('?' * len(earlier))})",
+        [(state, folder_index, name, *earlier) for name in chunk_names],
+    )
+
+def list_folders(connection):
+    """Return the indices of the folders that have chunks."""
+    return [row[0] for row in connection.execute("SELECT DISTINCT folder_index FROM chunks ORDER BY folder_index")]
+
+def list_notes(connection, folder_index, state):
+    """Return the names of the notes of `folder_index` in `state`."""
+    query = "SELECT note_name FROM notes WHERE folder_index = ? AND state = ? ORDER BY note_name"
+    return [row[0] for row in connection.execute(query, (folder_index, state))]
+
+def list_chunks(connection, folder_index, state):
+    """Return the names of the chunks of `folder_index` in `state`."""
+    query = "SELECT chunk_name FROM chunks WHERE folder_index = ? AND state = ? ORDER BY chunk_name"
+    return [row[0] for row in connection.execute(query, (folder_index, state))]
+
+def chunk_metadata(connection, folder_index, chunk_names):
+    """Return {chunk_name: (patient_id, encounter_id, note_id, note_date, provider_id)} for the recorded `chunk_names`."""
+    metadata = {}
+    for i in range(0, len(chunk_names), QUERY_BATCH):
+        names = chunk_names[i:i + QUERY_BATCH]
+        rows = connection.execute(
+            f"""
+            SELECT chunks.chunk_name, notes.patient_id, notes.encounter_id, notes.note_id, notes.note_date, notes.provider_id
+            FROM chunks JOIN notes USING (folder_index, note_name)
+            WHERE chunks.folder_index = ? AND chunks.chunk_name IN ({', '.join('?' * len(names))})
+            """,
+            (folder_index, *names),
+        )
+        metadata.update((row[0], row[1:]) for row in rows)
+    return metadata
+
+def count_states(connection):
+    """Return {(table, state): count} over the whole manifest."""
+    counts = {}
+    for table in ("notes", "chunks"):
+        for state, count in connection.execute(f"SELECT state, COUNT(*) FROM {table} GROUP BY state"):
+            counts[(table, state)] = count
+    return counts
+
+def main():
+    connection = open_manifest()
+    counts = count_states(connection)
+    connection.close()
+    print(f"Notes: {counts.get(('notes', 'ingested'), 0)} ingested, {counts.get(('notes', 'chunked'), 0)} chunked.")
+    print("Chunks: " + ", ".join(f"{counts.get(('chunks', state), 0)} {state}" for state in CHUNK_STATES) + ".")
+
+if __name__ == "__main__":
+    sys.exit(main())
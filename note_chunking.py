@@ -0,0 +1,133 @@
+import io
+import sharding
+
+# How lines longer than the chunk size are handled ("chunk_split_mode" in config.json): "line"
+# keeps such a line whole in a chunk of its own, "hard_cap" breaks it into pieces that fit
+CHUNK_SPLIT_MODES = ("line", "hard_cap")
+SENTENCE_ENDS = (b". ", b"! ", b"? ")
+WHITESPACE = (b" ", b"\t")
+# The longest UTF-8 character; a "hard_cap" chunk must have room for any character
+MIN_HARD_CAP_BYTES = 4
+
+def check_split_mode(split_mode, chunk_size_bytes):
+    """Raise an error if `split_mode` is unknown, or is "hard_cap" with a chunk size too small for a character."""
+    if split_mode not in CHUNK_SPLIT_MODES:
+        raise ValueError(f"Unknown chunk_split_mode '{split_mode}'; expected one of {list(CHUNK_SPLIT_MODES)}")
+    if split_mode == "hard_cap" and chunk_size_bytes < MIN_HARD_CAP_BYTES:
+        raise ValueError(
+            f'"chunk_split_mode": "hard_cap" requires note_chunk_size_bytes of at least {MIN_HARD_CAP_BYTES} '
+            f"(the longest UTF-8 character), got {chunk_size_bytes}"
+        )
+
+def split_long_line(line, chunk_size_bytes):
+    """
+    Break `line` into pieces of at most `chunk_size_bytes` (UTF-8, at least 4) that add up to
+    `line`, and yield each piece with its size in bytes. Each piece ends at the last sentence
+    end of the window if that lies in its second half, otherwise at the last whitespace, and
+    only if there is none at the last character boundary.
+    """
+    check_split_mode("hard_cap", chunk_size_bytes)
+    data = line.encode("utf-8")
+    start = 0
+    while len(data) - start > chunk_size_bytes:
+        end = start + chunk_size_bytes
+        cut = max(data.rfind(boundary, start, end) for boundary in SENTENCE_ENDS) + 2
+        if cut - start <= chunk_size_bytes // 2:
+            cut = max(data.rfind(boundary, start, end) for boundary in WHITESPACE) + 1
+        if cut <= start:
+            # No whitespace: back off to the start of a UTF-8 character
+            cut = end
+            while data[cut] & 0xC0 == 0x80:
+                cut -= 1
+        yield data[start:cut].decode("utf-8"), cut - start
+        start = cut
+    yield data[start:].decode("utf-8"), len(data) - start
+
+def iter_chunks(lines, chunk_size_bytes, split_mode="line"):
+    """
+    Group `lines` into chunks of up to `chunk_size_bytes` (UTF-8) and yield each chunk
+    as a list of lines.
+
+    With `split_mode` "line", a single line larger than `chunk_size_bytes` will occupy a chunk
+    by itself. With "hard_cap", such a line is broken into pieces (see split_long_line), so
+    that no chunk ever exceeds `chunk_size_bytes`.
+    """
+    check_split_mode(split_mode, chunk_size_bytes)
+
+    buffer_lines = []
+    buffer_size = 0  # track bytes in current chunk
+
+    for line in lines:
+        # Calculate the size (in bytes) of this line (including the newline if present)
+        line_bytes = len(line.encode("utf-8"))
+        if split_mode == "hard_cap" and line_bytes > chunk_size_bytes:
+            pieces = split_long_line(line, chunk_size_bytes)
+        else:
+            pieces = [(line, line_bytes)]
+
+        for line, line_bytes in pieces:
+            # If adding this line would exceed chunk_size_bytes, flush what we have so far
+            # BUT if buffer is empty, we have to put this line alone in a chunk (even if > chunk_size_bytes).
+            if buffer_lines and (buffer_size + line_bytes > chunk_size_bytes):
+                yield buffer_lines
+                buffer_lines = []
+                buffer_size = 0
+
+            # Now add the current line to the buffer (even if it alone exceeds chunk_size_bytes).
+            buffer_lines.append(line)
+            buffer_size += line_bytes
+
+    # After reading all lines, if anything remains in the buffer, flush it
+    if buffer_lines:
+        yield buffer_lines
+
+def chunk_text(text, chunk_size_bytes, split_mode="line"):
+    """
+    Chunk an in-memory note exactly as if it had been written to a `.txt` file and read
+    back line by line (universal newlines), yielding each chunk as a list of lines.
+    """
+    return iter_chunks(io.StringIO(text, newline=None), chunk_size_bytes, split_mode)
+
+# Boundaries to split a chunk at, most preferred first: a line end, a sentence end, any whitespace
+SPLIT_BOUNDARIES = ["\n", ". ", " "]
+
+def split_in_two(text):
+    """
+    Split `text` (at least 2 characters) into two pieces near its middle: at the boundary of
+    SPLIT_BOUNDARIES closest to the middle within the middle half of `text`, or at the middle
+    itself if there is none. The two pieces always add up to `text`.
+    """
+    middle = len(text) // 2
+    low, high = len(text) // 4, len(text) - len(text) // 4
+    for boundary in SPLIT_BOUNDARIES:
+        before = text.rfind(boundary, low, middle)
+        after = text.find(boundary, middle, high)
+        cuts = [i + len(boundary) for i in (before, after) if i != -1 and 0 < i + len(boundary) < len(text)]
+        if cuts:
+            cut = min(cuts, key=lambda i: abs(i - middle))
+            return text[:cut], text[cut:]
+    return text[:middle], text[middle:]
+
+def piece_file_name(chunk_name, piece_id):
+    """
+    Return the file name of piece `piece_id` of the chunk file `chunk_name`, e.g. a.txt_3-1.txt
+    for a.txt_3.txt, which parses to the same note as the chunk.
+    """
+    return f"{chunk_name[:-4]}-{piece_id}.txt"
+
+def chunk_file_name(original_name, chunk_id):
+    """Return the file name of chunk `chunk_id` of the note file `original_name`."""
+    return f"{original_name}_{chunk_id}.txt"
+
+def write_chunks(chunks, original_name, output_folder, shards=0):
+    """
+    Write each chunk to `output_folder` (in its shard subdirectory if `shards` is set) as
+    {original_name}_{chunk_id}.txt, with chunk_id starting at 1, and return the number of
+    chunks written.
+    """
+    chunk_id = 0
+    for chunk_id, chunk_lines in enumerate(chunks, start=1):
+        out_path = sharding.new_file_path(output_folder, chunk_file_name(original_name, chunk_id), shards)
+        with open(out_path, "w", encoding="utf-8") as out_f:
+            out_f.writelines(chunk_lines)
+    return chunk_id
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+# Metrics of the pipeline ("metrics" in config.json).
+#
+# The pipeline and post processing steps append JSON lines to ./pipeline_metrics.jsonl: a "start"
+# and an "end" record for every stage and for every unit of work of a stage (a csv file, a folder,
+# a batch of chunks or XMI files), with the wall time, CPU time and counters (notes, chunks, bytes,
+# XMI files, parse seconds, ...) of the unit, and a "progress" record with the counters so far
+# every PROGRESS_SECONDS while a unit runs. `python3 pipeline_metrics.py status` summarizes the
+# latest run from this file alone, without listing the folders.
+
+METRICS_PATH = "./pipeline_metrics.jsonl"
+PROGRESS_SECONDS = 5
+
+# Stages in pipeline order, with their names in the status report
+STAGES = {
+    "step1": "Pipeline Step 1 - Prepare Input",
+    "step2": "Pipeline Step 2 - Chunk Input",
+    "prefilter": "Prefilter",
+    "cache_lookup": "Annotation Cache Lookup",
+    "step3": "Pipeline Step 3 - Run cTAKES",
+    "step4": "Pipeline Step 4 - Remove Processed Note Chunks",
+    "step5": "Pipeline Step 5 - Process Output",
+    "orchestrator": "Pipeline Orchestrator",
+    "post1": "Post Processing Step 1 - Aggregate Output",
+    "post2": "Post Processing Step 2 - Generate Note Level Results",
+    "post3": "Post Processing Step 3 - Generate Final Results",
+    "post_incremental": "Post Processing - Incremental",
+}
+# A stage without a total of its own is measured against a counter of an earlier stage:
+# stage -> (counter, earlier stage)
+UPSTREAM_TOTALS = {"step2": ("notes", "step1"), "step5": ("xmi_files", "step3")}
+RATE_COUNTERS = ["notes", "chunks", "bytes", "xmi_files", "rows"]
+
+def record(path, stage, event, **fields):
+    """Append one record to the metrics file `path`; nothing happens if `path` is None."""
+    if path is None:
+        return
+    line = json.dumps({"time": time.time(), "stage": stage, "event": event, "pid": os.getpid(), **fields}) + "\n"
+    # A single short append, so that the records of concurrent processes do not interleave
+    with open(path, "a") as f:
+        f.write(line)
+
+def cpu_time():
+    """Return the CPU time of this process and of its finished child processes (e.g. cTAKES)."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+class Timer:
+    """
+    Records the start and the end (wall time, CPU time and counters) of a stage, or of one unit of
+    work of a stage (`unit`, e.g. "folder", with its `key`, e.g. the folder index) to the metrics
+    file `path`. Count work with add(). A unit run in a thread (`threaded`) only gets the CPU time
+    of its thread.
+    """
+
+    def __init__(self, path, stage, unit=None, key=None, threaded=False, **fields):
+        self.path = path
+        self.stage = stage
+        self.fields = {"unit": unit, "key": key, **fields}
+        self.cpu_time = time.thread_time if threaded else cpu_time
+        self.counters = {}
+
+    def __enter__(self):
+        self.id = f"{os.getpid()}-{time.time_ns()}"
+        self.start_wall = self.last_progress = time.perf_counter()
+        self.start_cpu = self.cpu_time()
+        record(self.path, self.stage, "start", id=self.id, **self.fields)
+        return self
+
+    def add(self, **counts):
+        """Add `counts` to the counters, recording the progress at most every PROGRESS_SECONDS."""
+        for name, count in counts.items():
+            self.counters[name] = self.counters.get(name, 0) + count
+        now = time.perf_counter()
+        if now - self.last_progress >= PROGRESS_SECONDS:
+            self.last_progress = now
+            record(self.path, self.stage, "progress", id=self.id, wall_seconds=now - self.start_wall, counters=self.counters, **self.fields)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(
+            self.path, self.stage, "end", id=self.id, ok=exc_type is None,
+            wall_seconds=time.perf_counter() - self.start_wall, cpu_seconds=self.cpu_time() - self.start_cpu,
+            counters=self.counters, **self.fields,
+        )
+
+def read_records(path=METRICS_PATH):
+    """Return the records of the latest run: those since the last start of Pipeline Step 1 or of the orchestrator."""
+    with open(path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    starts = [
+        i for i, r in enumerate(records)
+        if r["event"] == "start" and r.get("unit") is None and r["stage"] in ("step1", "orchestrator")
+    ]
+    return records[starts[-1]:] if starts else records
+
+def summarize_stage(stage, records, now):
+    """Return the state, wall and CPU time, counters, units and latest queue depth of `stage` from its `records`."""
+    stage_records = [r for r in records if r.get("unit") is None]
+    started = next((r for r in stage_records if r["event"] == "start"), None)
+    ended = next((r for r in reversed(stage_records) if r["event"] == "end"), None)
+    # The latest record of every unit
+    units = {}
+    for r in records:
+        if r.get("unit") is not None:
+            units[r["id"]] = r
+    counters = {}
+    for r in units.values():
+        for name, count in r.get("counters", {}).items():
+            counters[name] = counters.get(name, 0) + count
+    if not counters:
+        # A stage without units (the orchestrator) records snapshots of its counters instead
+        counters = next((r["counters"] for r in reversed(stage_records) if r.get("counters")), {})
+
+    units_cpu = sum(r.get("cpu_seconds", 0) for r in units.values())
+    if ended is not None:
+        # The static scheduler of Pipeline Step 3 (a shell script) records no CPU time
+        state, wall, cpu = "done", ended["wall_seconds"], ended.get("cpu_seconds", units_cpu)
+    else:
+        # Without a record of its own (e.g. Step 5 run by the orchestrator), a stage is done once all its units are
+        state = "running" if started is not None or any(r["event"] != "end" for r in units.values()) else "done"
+        wall = (now if state == "running" else records[-1]["time"]) - (started or records[0])["time"]
+        cpu = units_cpu
+    queued = next((r for r in reversed(records) if "queue_depth" in r), None)
+    return {"state": state, "wall": wall, "cpu": cpu, "counters": counters, "units": units, "started": started, "queued": queued}
+
+def format_count(name, count):
+    if name == "bytes":
+        return f"{count / 2**20:,.1f} MB"
+    if name.endswith("seconds"):
+        return f"{count:,.1f}s"
+    return f"{count:,}"
+
+def straggler_lines(summary, now):
+    """Describe how unevenly the units of a stage (by key, e.g. folder) take time."""
+    key_walls = {}
+    running = []
+    for r in summary["units"].values():
+        if r["event"] == "end":
+            wall = r["wall_seconds"]
+        else:
+            # The unit started wall_seconds before its latest progress record
+            wall = now - r["time"] + r.get("wall_seconds", 0)
+            running.append((wall, r["unit"], r["key"]))
+        key = (r["unit"], r["key"])
+        key_walls[key] = key_walls.get(key, 0) + wall
+    lines = []
+    if len(key_walls) > 1:
+        walls = sorted(key_walls.values())
+        median = statistics.median(walls)
+        (unit, key), slowest = max(key_walls.items(), key=lambda item: item[1])
+        skew = f" ({slowest / median:.2f}x the median)" if median else ""
+        lines.append(
+            f"    {len(walls)} {unit}(s): min/median/max {walls[0]:.1f}/{median:.1f}/{walls[-1]:.1f}s; "
+            f"slowest {unit} {key}{skew}"
+        )
+    for wall, unit, key in sorted(running, reverse=True)[:3]:
+        lines.append(f"    still running: {unit} {key} for {wall:.0f}s")
+    return lines
+
+def status(path=METRICS_PATH):
+    """Print the progress, rates, ETA and stragglers of every stage of the latest run."""
+    if not os.path.exists(path):
+        print(f"No metrics found at {path}. Is \"metrics\" enabled in config.json?")
+        return 1
+    records = read_records(path)
+    now = time.time()
+    by_stage = {}
+    for r in records:
+        by_stage.setdefault(r["stage"], []).append(r)
+    summaries = {stage: summarize_stage(stage, stage_records, now) for stage, stage_records in by_stage.items()}
+    if records:
+        print(f"Latest run started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(records[0]['time']))} ({(now - records[0]['time']) / 60:.1f} minutes ago).")
+
+    for stage in sorted(summaries, key=lambda stage: list(STAGES).index(stage) if stage in STAGES else len(STAGES)):
+        summary = summaries[stage]
+        counters = summary["counters"]
+        print(f"{STAGES.get(stage, stage)}: {summary['state']}, wall {summary['wall']:.1f}s, CPU {summary['cpu']:.1f}s")
+        if counters:
+            print("    " + ", ".join(f"{name} {format_count(name, count)}" for name, count in sorted(counters.items())))
+        rates = [
+            f"{format_count(name, counters[name] / summary['wall'])}/s" if name == "bytes" else f"{counters[name] / summary['wall']:,.1f} {name}/s"
+            for name in RATE_COUNTERS if counters.get(name) and summary["wall"] > 0
+        ]
+        if rates:
+            print("    " + ", ".join(rates))
+        if counters.get("parse_seconds") and counters.get("xmi_files"):
+            print(f"    XMI parse time {1000 * counters['parse_seconds'] / counters['xmi_files']:.2f} ms per file")
+
+        queued = summary["queued"]
+        if queued is not None and summary["state"] == "running":
+            print(f"    queue depth {queued['queue_depth']}" + (f", {queued['pending']} chunk(s) pending" if "pending" in queued else ""))
+
+        # Progress against the total of the stage, or against what an earlier stage produced
+        started = summary["started"] or {}
+        counter, total = started.get("total_counter"), started.get("total")
+        if total is None and stage in UPSTREAM_TOTALS:
+            counter, upstream = UPSTREAM_TOTALS[stage]
+            if upstream in summaries and summaries[upstream]["state"] == "done":
+                total = summaries[upstream]["counters"].get(counter)
+        if summary["state"] == "running" and counter and total:
+            done = counters.get(counter, 0)
+            line = f"    {done:,} of {total:,} {counter} ({done / total:.1%})"
+            if 0 < done < total:
+                line += f", ETA {summary['wall'] * (total - done) / done / 60:.1f} minutes"
+            print(line)
+        for line in straggler_lines(summary, now):
+            print(line)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the metrics of the latest pipeline run.")
+    parser.add_argument("command", choices=["status"], help="status: print the progress, rates, ETA and stragglers of every stage")
+    parser.add_argument("--metrics", default=METRICS_PATH, help="the metrics file")
+    args = parser.parse_args()
+    return status(args.metrics)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,417 @@
+import os
+import sys
+import json
+import time
+import threading
+import multiprocessing
+from note_chunking import chunk_text, chunk_file_name, check_split_mode
+from annotators import make_annotator
+import ctakes_scheduler
+import provision_ctakes
+import result_storage
+import manifest
+import sharding
+import annotation_cache
+import lexical_prefilter
+import pipeline_metrics
+import pipeline_scripts
+
+# Load configuration from config.json
+def load_config(config_path="config.json"):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+config = load_config()
+step1 = pipeline_scripts.load_script("Pipeline Step 1 - Prepare Input.py")
+step5 = pipeline_scripts.load_script("Pipeline Step 5 - Process Output.py")
+
+NUM_PROCESSES = config["num_processes"]
+NUM_FOLDERS = NUM_PROCESSES
+NUM_WORKERS = config.get("ctakes_workers", NUM_PROCESSES)
+BATCH_SIZE = config.get("ctakes_batch_size", 50)
+CHUNK_SIZE_BYTES = config["note_chunk_size_bytes"]
+CHUNK_SPLIT_MODE = config.get("chunk_split_mode", "line")
+CSV_CHUNK_ROWS = config.get("csv_chunk_rows", 0) or 10000
+FOLDER_ASSIGNMENT = config.get("folder_assignment", "round_robin")
+# How many chunks may be written to ./Input_chunk but not yet parsed by Step 5
+MAX_PENDING_CHUNKS = config.get("max_pending_chunks", 20000)
+OUTPUT_POLL_SECONDS = config.get("output_poll_seconds", 2)
+USE_MANIFEST = config.get("manifest", False)
+DIRECTORY_SHARDS = config.get("directory_shards", 0)
+ANNOTATION_CACHE = config.get("annotation_cache", False)
+PREFILTER_MODE = config.get("prefilter_mode", "off")
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+BASE_INPUT = "./Input_chunk"
+BASE_OUTPUT = "./Output"
+
+class IngestAborted(Exception):
+    """Raised in the ingesting thread once main has given up on the run."""
+
+class PendingChunks:
+    """Counts the chunks written to ./Input_chunk that have not been parsed (or given up on) yet."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self.aborted = False
+        self.condition = threading.Condition()
+
+    def has_room(self, n):
+        with self.condition:
+            return self.count == 0 or self.count + n <= self.limit
+
+    def reserve(self, n):
+        """Wait until `n` more chunks fit under the limit (a single oversized note is always let through)."""
+        with self.condition:
+            while not self.aborted and self.count and self.count + n > self.limit:
+                self.condition.wait()
+            if self.aborted:
+                raise IngestAborted("the run was aborted")
+            self.count += n
+
+    def release(self, n):
+        with self.condition:
+            self.count -= n
+            self.condition.notify_all()
+
+    def abort(self):
+        """Make every waiting and later reserve() raise IngestAborted."""
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+class KnownChunks:
+    """
+    Chunks whose statuses are known without cTAKES (found in the annotation cache, or skipped by
+    the prefilter), by folder, whose rows have not been appended yet.
+    """
+
+    def __init__(self):
+        self.chunks = {}
+        self.lock = threading.Lock()
+
+    def add(self, folder_index, chunks):
+        with self.lock:
+            self.chunks.setdefault(folder_index, {}).update(chunks)
+
+    def take(self):
+        """Return {folder_index: {chunk_name: statuses}} and forget them."""
+        with self.lock:
+            chunks, self.chunks = self.chunks, {}
+        return chunks
+
+def ingest_notes(work_queue, pending, known_chunks, progress):
+    """
+    Pipeline Steps 1 and 2: read the notes of every csv file of clinical_notes_directory, chunk them
+    in memory, write the chunks to ./Input_chunk/Input_k and queue them in batches for annotation.
+    Blocks whenever MAX_PENDING_CHUNKS chunks are waiting to be annotated and parsed.
+    With USE_MANIFEST, the notes and chunks are recorded in the manifest before they are queued.
+    With PREFILTER_MODE "on", chunks without a term, and with ANNOTATION_CACHE, chunks found in the
+    annotation cache are not written but handed to `known_chunks`; the other chunks are left
+    pending for Step 5 to cache.
+    """
+    clinical_notes_dir = config["clinical_notes_directory"]
+    note_columns = [
+        config["patient_id_column_name"], config["encounter_id_column_name"], config["note_id_column_name"],
+        config["note_date_column_name"], config["provider_id_column_name"], config["note_text_column_name"],
+    ]
+    note_text_col = note_columns[-1]
+
+    # Chunks of each folder that are written but not queued yet
+    unqueued = {folder_index: [] for folder_index in range(1, NUM_FOLDERS + 1)}
+    # Notes and chunks that are written but not recorded in the manifest yet
+    connection = manifest.open_manifest() if USE_MANIFEST else None
+    manifest_notes, manifest_chunks = [], []
+    cache = annotation_cache.open_cache() if ANNOTATION_CACHE else None
+    # Chunks of each folder whose statuses are known but not handed over yet
+    known = {folder_index: {} for folder_index in range(1, NUM_FOLDERS + 1)}
+
+    def record():
+        if connection is not None and manifest_notes:
+            with connection:
+                manifest.add_notes(connection, manifest_notes)
+                manifest.add_chunks(connection, manifest_chunks)
+            manifest_notes.clear()
+            manifest_chunks.clear()
+
+    def flush(folder_index, min_size=1):
+        if len(unqueued[folder_index]) >= min_size:
+            # The workers and Step 5 look the chunks up in the manifest
+            record()
+        while len(unqueued[folder_index]) >= min_size:
+            batch = [(folder_index, name) for name in unqueued[folder_index][:BATCH_SIZE]]
+            del unqueued[folder_index][:BATCH_SIZE]
+            work_queue.put(batch)
+
+    def hand_over(folder_index, min_size=1):
+        if len(known[folder_index]) >= min_size:
+            # Step 5 looks the chunks up in the manifest
+            record()
+            known_chunks.add(folder_index, known[folder_index])
+            known[folder_index] = {}
+
+    try:
+        csv_files = sorted(os.path.join(clinical_notes_dir, f) for f in os.listdir(clinical_notes_dir) if f.endswith(".csv"))
+        print(f"Found {len(csv_files)} CSV files.")
+
+        row_id = 0
+        folder_heap = step1.new_folder_heap(NUM_FOLDERS, 0)
+        for input_file in csv_files:
+            try:
+                for df in step1.iter_note_batches(input_file, note_columns, CSV_CHUNK_ROWS):
+                    df[note_text_col] = step1.sanitize_note_texts(df[note_text_col])
+                    note_sizes = df[note_text_col].str.encode("utf-8").str.len().tolist()
+                    if FOLDER_ASSIGNMENT == "balanced":
+                        folders = step1.assign_balanced_folders(note_sizes, folder_heap)
+                    else:
+                        folders = [(row_id + i) % NUM_FOLDERS + 1 for i in range(len(df))]
+
+                    for folder_index, (patient_id, encounter_id, note_id, note_date, provider_id, note_text) in zip(
+                        folders, df[note_columns].itertuples(index=False, name=None)
+                    ):
+                        row_id += 1
+                        original_name = f"{patient_id}_{encounter_id}_{note_id}_{note_date}_{provider_id}.txt"
+                        chunks = list(chunk_text(str(note_text), CHUNK_SIZE_BYTES, CHUNK_SPLIT_MODE))
+                        names = [chunk_file_name(original_name, chunk_id) for chunk_id in range(1, len(chunks) + 1)]
+                        skipped, cached = {}, {}
+                        if PREFILTER_MODE == "on":
+                            skipped = {
+                                name: {feature: "U" for feature in step5.FEATURES}
+                                for name, chunk_lines in zip(names, chunks) if not step5.PREFILTER.matches("".join(chunk_lines))
+                            }
+                        if cache is not None:
+                            keys = {
+                                name: annotation_cache.chunk_key("".join(chunk_lines).encode("utf-8"), step5.CUI_FINGERPRINT)
+                                for name, chunk_lines in zip(names, chunks) if name not in skipped
+                            }
+                            with cache:
+                                statuses = annotation_cache.lookup(cache, set(keys.values()))
+                                cached = {name: statuses[key] for name, key in keys.items() if key in statuses}
+                                annotation_cache.add_pending(cache, folder_index, {name: key for name, key in keys.items() if name not in cached})
+                        num_written = len(chunks) - len(skipped) - len(cached)
+
+                        if not pending.has_room(num_written):
+                            # Hand every written chunk to the workers before waiting for them
+                            for index in unqueued:
+                                flush(index)
+                        pending.reserve(num_written)
+
+                        output_folder = os.path.join(BASE_INPUT, f"Input_{folder_index}")
+                        for name, chunk_lines in zip(names, chunks):
+                            manifest_chunks.append((folder_index, name, original_name))
+                            if name in skipped or name in cached:
+                                continue
+                            with open(sharding.new_file_path(output_folder, name, DIRECTORY_SHARDS), "w", encoding="utf-8") as out_f:
+                                out_f.writelines(chunk_lines)
+                            unqueued[folder_index].append(name)
+                        manifest_notes.append((folder_index, original_name, patient_id, encounter_id, note_id, note_date, provider_id))
+                        known[folder_index].update(skipped)
+                        known[folder_index].update(cached)
+                        flush(folder_index, BATCH_SIZE)
+                        hand_over(folder_index, BATCH_SIZE)
+
+                        with progress["lock"]:
+                            progress["notes"] += 1
+                            progress["chunks"] += len(chunks)
+                            progress["skipped"] += len(skipped)
+                            progress["cached"] += len(cached)
+                print(f"Ingested file: {input_file}")
+            except IngestAborted:
+                raise
+            except Exception as e:
+                print(f"Error processing file {input_file}: {e}")
+
+        for folder_index in unqueued:
+            flush(folder_index)
+            hand_over(folder_index)
+    finally:
+        if connection is not None:
+            connection.close()
+        if cache is not None:
+            cache.close()
+        # Even if ingesting fails, so that the workers do not wait for batches forever
+        work_queue.close()
+
+def annotation_worker(worker_id, annotator, work_queue, pending, progress):
+    """Pipeline Step 3: annotate queued batches with `annotator` until none is left (see ctakes_scheduler.BatchQueue)."""
+    annotator.start()
+    try:
+        while (batch := work_queue.get()) is not None:
+            try:
+                # After an abort, the batches still queued are left to a later run
+                if pending.aborted:
+                    continue
+                with pipeline_metrics.Timer(METRICS_PATH, "step3", unit="worker", key=worker_id, threaded=True, queue_depth=work_queue.qsize()) as timer:
+                    produced, missing, added = ctakes_scheduler.run_batch(worker_id, annotator, batch, work_queue)
+                    timer.add(chunks=len(batch), xmi_files=produced, missing=missing)
+                # Chunks without an XMI stay in ./Input_chunk for Pipeline Step 4 to report, while the
+                # pieces split off stalled chunks are pending like any other chunk
+                pending.release(missing - added)
+                with progress["lock"]:
+                    progress["annotated"] += produced + missing
+                    progress["missing"] += missing
+            finally:
+                work_queue.task_done()
+    finally:
+        annotator.close()
+
+def run_thread(name, target, failures, *args):
+    """Run `target(*args)` in a thread, storing its exception in `failures` for main to re-raise."""
+    try:
+        target(*args)
+    except BaseException as e:
+        failures.append((name, e))
+
+def check_threads(failures, producer, workers):
+    """
+    Raise if a thread has failed, or if every worker has stopped while notes are still being
+    ingested (the producer would wait for room in `pending` forever).
+    """
+    if failures:
+        name, error = failures[0]
+        raise RuntimeError(f"{name} failed: {error}") from error
+    if producer.is_alive() and not any(worker.is_alive() for worker in workers):
+        # The workers also stop once the producer, just before it ends, has closed the queue
+        producer.join(OUTPUT_POLL_SECONDS)
+        if producer.is_alive():
+            raise RuntimeError("Every annotation worker stopped while notes were still being ingested")
+
+def parse_outputs(args):
+    """
+    Pipeline Steps 5 and 4 for the XMI files that have landed in ./Output/Output_k: process them
+    into the chunk-level result tables, then delete their input chunks. The rows of the chunks
+    whose statuses are known without cTAKES are appended first. Returns the number of XMI files.
+    """
+    folder_index, xmi_paths, known = args
+    if known:
+        step5.process_chunk_statuses(folder_index, known)
+    if xmi_paths:
+        step5.process_xmi_files(folder_index, xmi_paths)
+    input_folder = os.path.join(BASE_INPUT, f"Input_{folder_index}")
+    for xmi_path in xmi_paths:
+        chunk_path = sharding.file_path(input_folder, os.path.basename(xmi_path)[:-4], DIRECTORY_SHARDS)  # remove ".xmi"
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+    return len(xmi_paths)
+
+def collect_outputs(pool, known_chunks, archivers):
+    """
+    Parse every XMI file currently in the output folders, along with the chunks whose statuses
+    became known so far; return how many XMI files were parsed. With xmi_archive_mode "compressed",
+    the parsed XMI files are then handed to the archive of their folder in `archivers`.
+    """
+    tasks = []
+    known = known_chunks.take()
+    for folder_index in range(1, NUM_FOLDERS + 1):
+        output_folder = os.path.join(BASE_OUTPUT, f"Output_{folder_index}")
+        xmi_paths = [path for _, path in sharding.iter_files(output_folder, ".xmi")]
+        if xmi_paths or folder_index in known:
+            # One task per folder, so that a single process appends to its tables
+            tasks.append((folder_index, xmi_paths, known.get(folder_index)))
+    parsed = sum(pool.imap_unordered(parse_outputs, tasks))
+    if step5.XMI_ARCHIVE_MODE == "compressed":
+        for folder_index, xmi_paths, _ in tasks:
+            step5.archive_xmi_files(archivers, folder_index, xmi_paths)
+    return parsed
+
+def provision_workers():
+    """Provision (if needed) and verify one cTAKES folder per worker; return False on failure."""
+    if provision_ctakes.PROVISIONING == "none":
+        return True
+    os.makedirs(provision_ctakes.CTAKES_FOLDER, exist_ok=True)
+    ok = True
+    for worker_id in range(1, NUM_WORKERS + 1):
+        target = provision_ctakes.provision_worker(worker_id)
+        for problem in provision_ctakes.verify_worker(target):
+            print(f"[{os.path.basename(target)}] {problem}")
+            ok = False
+    return ok
+
+def record_progress(work_queue, pending, progress):
+    """Record the counters of `progress`, the queued batches and the pending chunks to the metrics file."""
+    pipeline_metrics.record(
+        METRICS_PATH, "orchestrator", "progress", queue_depth=work_queue.qsize(), pending=pending.count,
+        counters={name: progress[name] for name in ("notes", "chunks", "skipped", "cached", "annotated", "parsed")},
+    )
+
+def main():
+    start_time = time.time()
+    result_storage.check_result_format(step5.RESULT_FORMAT)
+    check_split_mode(CHUNK_SPLIT_MODE, CHUNK_SIZE_BYTES)
+    if PREFILTER_MODE not in lexical_prefilter.PREFILTER_MODES:
+        raise ValueError(f"Unknown prefilter_mode '{PREFILTER_MODE}'; expected one of {list(lexical_prefilter.PREFILTER_MODES)}")
+    if not provision_workers():
+        print("Error: cTAKES folders failed verification. Remove them and run again.")
+        return 1
+    if USE_MANIFEST:
+        # Create the manifest before the processes open it
+        manifest.open_manifest().close()
+    if ANNOTATION_CACHE:
+        annotation_cache.open_cache().close()
+
+    work_queue = ctakes_scheduler.BatchQueue()
+    pending = PendingChunks(MAX_PENDING_CHUNKS)
+    known_chunks = KnownChunks()
+    progress = {"lock": threading.Lock(), "notes": 0, "chunks": 0, "skipped": 0, "cached": 0, "annotated": 0, "missing": 0, "parsed": 0}
+    # Create the annotators first, so that a configuration error stops the run before any work
+    annotators = {worker_id: make_annotator(worker_id, config) for worker_id in range(1, NUM_WORKERS + 1)}
+
+    # Start the parsing processes before any thread exists
+    with pipeline_metrics.Timer(METRICS_PATH, "orchestrator"), multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+        # A thread that fails stores its exception here, for this loop to stop the run
+        failures = []
+        producer = threading.Thread(target=run_thread, args=("Ingesting notes", ingest_notes, failures, work_queue, pending, known_chunks, progress))
+        workers = [
+            threading.Thread(target=run_thread, args=(f"Annotation worker {worker_id}", annotation_worker, failures, worker_id, annotators[worker_id], work_queue, pending, progress))
+            for worker_id in range(1, NUM_WORKERS + 1)
+        ]
+        producer.start()
+        for worker in workers:
+            worker.start()
+
+        # With xmi_archive_mode "compressed", one archive per folder for the whole run
+        archivers = {}
+        try:
+            while producer.is_alive() or any(worker.is_alive() for worker in workers):
+                check_threads(failures, producer, workers)
+                parsed = collect_outputs(pool, known_chunks, archivers)
+                pending.release(parsed)
+                progress["parsed"] += parsed
+                print(
+                    f"Progress: {progress['notes']} note(s) ingested into {progress['chunks']} chunk(s), "
+                    f"{progress['annotated']} annotated, {progress['parsed']} parsed, {pending.count} pending."
+                )
+                record_progress(work_queue, pending, progress)
+                if not parsed:
+                    time.sleep(OUTPUT_POLL_SECONDS)
+            check_threads(failures, producer, workers)
+            # Parse whatever the last batches produced
+            parsed = collect_outputs(pool, known_chunks, archivers)
+            pending.release(parsed)
+            progress["parsed"] += parsed
+            record_progress(work_queue, pending, progress)
+        except BaseException:
+            # Stop ingesting (the producer then closes the queue) and let the workers finish
+            # their current batch before the pool goes away
+            pending.abort()
+            for thread in [producer] + workers:
+                thread.join()
+            raise
+        finally:
+            step5.close_archivers(archivers)
+
+    print(f"Ingested {progress['notes']} note(s) into {progress['chunks']} chunk(s); parsed {progress['parsed']} XMI file(s).")
+    if PREFILTER_MODE == "on":
+        skip_rate = progress["skipped"] / progress["chunks"] if progress["chunks"] else 0
+        print(f"Prefilter: {progress['skipped']} of {progress['chunks']} chunk(s) ({skip_rate:.1%}) have no term and skipped cTAKES.")
+    if ANNOTATION_CACHE:
+        looked_up = progress["chunks"] - progress["skipped"]
+        hit_rate = progress["cached"] / looked_up if looked_up else 0
+        print(f"Annotation cache hit rate: {progress['cached']} of {looked_up} chunk(s) ({hit_rate:.1%}) skipped cTAKES.")
+    if progress["missing"]:
+        print(f"{progress['missing']} chunk(s) did not produce an XMI file and were left in {BASE_INPUT}.")
+    print(f"Streaming pipeline completed in {int(time.time() - start_time)} seconds.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
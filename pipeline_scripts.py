@@ -0,0 +1,42 @@
+import os
+import sys
+import importlib.util
+import sharding
+import manifest
+
+# Helpers shared by the stages that reuse the pipeline scripts: importing a script (whose file name
+# contains spaces) as a module, and listing the chunks of ./Input_chunk that still need cTAKES.
+
+BASE_INPUT = "./Input_chunk"
+BASE_OUTPUT = "./Output"
+
+def load_script(file_name):
+    """Import a pipeline script (whose file name contains spaces, optionally with a folder) as a module."""
+    module_name = os.path.basename(file_name)[:-3].replace(" - ", "_").replace(" ", "_")
+    spec = importlib.util.spec_from_file_location(module_name, file_name)
+    module = importlib.util.module_from_spec(spec)
+    # Registered, so that the functions of the script can be sent to worker processes
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def iter_pending_chunks(folder_index, use_manifest=False, shards=0):
+    """
+    Yield (file name, path) of every chunk of ./Input_chunk/Input_{folder_index} that has no XMI in
+    ./Output/Output_{folder_index} yet. With `use_manifest`, the chunks the manifest records as
+    chunked are looked up instead of listing the folder. A chunk annotated by an earlier run is left
+    to Pipeline Steps 4 and 5.
+    """
+    input_folder = os.path.join(BASE_INPUT, f"Input_{folder_index}")
+    output_folder = os.path.join(BASE_OUTPUT, f"Output_{folder_index}")
+    if use_manifest:
+        connection = manifest.open_manifest()
+        names = manifest.list_chunks(connection, folder_index, "chunked")
+        connection.close()
+        chunk_files = ((name, sharding.file_path(input_folder, name, shards)) for name in names)
+        chunk_files = ((name, path) for name, path in chunk_files if os.path.exists(path))
+    else:
+        chunk_files = sharding.iter_files(input_folder, ".txt")
+    for name, path in chunk_files:
+        if not os.path.exists(sharding.file_path(output_folder, name + ".xmi", shards)):
+            yield name, path
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import itertools
+import multiprocessing
+import lexical_prefilter
+import manifest
+import result_storage
+import pipeline_metrics
+import pipeline_scripts
+
+# Lexical prefilter stage ("prefilter_mode" in config.json), run by Pipeline.sh between Pipeline
+# Steps 2 and 3. Every chunk of ./Input_chunk without a term of the CUI lists (or a configured
+# synonym) gets status "U" for every feature in the chunk-level result tables right away and is
+# removed, so cTAKES never sees it. With "validate" the chunks are only counted.
+
+# Load configuration from config.json
+def load_config(config_path="config.json"):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+config = load_config()
+step5 = pipeline_scripts.load_script("Pipeline Step 5 - Process Output.py")
+
+NUM_PROCESSES = config["num_processes"]
+PREFILTER_MODE = config.get("prefilter_mode", "off")
+USE_MANIFEST = config.get("manifest", False)
+DIRECTORY_SHARDS = config.get("directory_shards", 0)
+METRICS_PATH = pipeline_metrics.METRICS_PATH if config.get("metrics", True) else None
+# Chunk files filtered at a time
+FILTER_BATCH_FILES = 10000
+
+def filter_chunks(folder_index, chunk_files):
+    """
+    Check the chunk files `chunk_files`, a list of (file name, path) of folder `folder_index`, for
+    a term. With PREFILTER_MODE "on", the chunks without one get status "U" for every feature (see
+    process_chunk_statuses of Pipeline Step 5) and are removed. Returns the number of chunks
+    without a term.
+    """
+    skipped = {}
+    for name, path in chunk_files:
+        with open(path, "r", encoding="utf-8") as f:
+            if not step5.PREFILTER.matches(f.read()):
+                skipped[name] = {feature: "U" for feature in step5.FEATURES}
+
+    if skipped and PREFILTER_MODE == "on":
+        step5.process_chunk_statuses(folder_index, skipped)
+        for name, path in chunk_files:
+            if name in skipped:
+                os.remove(path)
+    return len(skipped)
+
+def filter_folder(folder_index):
+    """
+    Filter every chunk of ./Input_chunk/Input_{folder_index} that has no XMI yet, FILTER_BATCH_FILES
+    at a time. With USE_MANIFEST, the chunks are looked up in the manifest instead of listed.
+    Returns (number of chunks checked, number without a term).
+    """
+    chunk_files = pipeline_scripts.iter_pending_chunks(folder_index, USE_MANIFEST, DIRECTORY_SHARDS)
+
+    checked = skipped = 0
+    with pipeline_metrics.Timer(METRICS_PATH, "prefilter", unit="folder", key=folder_index) as timer:
+        while batch := list(itertools.islice(chunk_files, FILTER_BATCH_FILES)):
+            batch_skipped = filter_chunks(folder_index, batch)
+            skipped += batch_skipped
+            checked += len(batch)
+            timer.add(chunks=len(batch), skipped=batch_skipped)
+    print(f"[Input_{folder_index}] {skipped} of {checked} chunk(s) have no term.")
+    return checked, skipped
+
+def main():
+    if PREFILTER_MODE not in lexical_prefilter.PREFILTER_MODES:
+        raise ValueError(f"Unknown prefilter_mode '{PREFILTER_MODE}'; expected one of {list(lexical_prefilter.PREFILTER_MODES)}")
+    start_time = time.time()
+    result_storage.check_result_format(step5.RESULT_FORMAT)
+    if USE_MANIFEST:
+        # Create the manifest before the processes open it
+        manifest.open_manifest().close()
+    folder_indices = range(1, NUM_PROCESSES + 1)
+    with pipeline_metrics.Timer(METRICS_PATH, "prefilter"), multiprocessing.Pool(processes=NUM_PROCESSES) as pool:
+        results = pool.map(filter_folder, folder_indices)
+
+    checked = sum(result[0] for result in results)
+    skipped = sum(result[1] for result in results)
+    skip_rate = skipped / checked if checked else 0
+    if PREFILTER_MODE == "on":
+        print(f"Prefilter: {skipped} of {checked} chunk(s) ({skip_rate:.1%}) have no term and skipped cTAKES.")
+    else:
+        print(f"Prefilter validation: {skipped} of {checked} chunk(s) ({skip_rate:.1%}) have no term; they still go through cTAKES, "
+              "and Pipeline Step 5 reports the ones whose statuses disagree.")
+    print(f"Prefilter completed in {time.time() - start_time:.1f} seconds.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import shutil
+import time
+
+# Load configuration from config.json
+def load_config(config_path="config.json"):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+config = load_config()
+
+CTAKES_SOURCE = "apache-ctakes-4.0.0.1"
+CTAKES_FOLDER = "./cTAKES"
+PROVISIONING = config.get("ctakes_provisioning", "copy")
+# "none" provisions nothing (the callers skip this module)
+PROVISIONING_MODES = ("copy", "symlink", "hardlink", "none")
+# Paths (relative to the cTAKES folder) that every worker gets its own real copy of: the launch
+# scripts, which resolve CTAKES_HOME through symlinks, and the HSQLDB dictionary, which cTAKES
+# writes to and locks while it runs. Everything else is read-only and can be shared.
+PRIVATE_PATHS = config.get("ctakes_private_paths", [
+    "bin",
+    "resources/org/apache/ctakes/dictionary/lookup/fast",
+])
+
+def link_function(mode):
+    """Return the copy_function of shutil.copytree for a provisioning mode."""
+    if mode == "symlink":
+        return lambda src, dst: os.symlink(os.path.abspath(src), dst)
+    if mode != "hardlink":
+        raise ValueError(f"Unknown ctakes_provisioning '{mode}' for linking; expected one of ['symlink', 'hardlink']")
+
+    def hardlink(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Hard links cannot cross file systems
+            shutil.copy2(src, dst)
+    return hardlink
+
+def ignore_private_paths(source, private_paths):
+    """Return an `ignore` callable for shutil.copytree that skips `private_paths` of `source`."""
+    private = {os.path.normpath(path) for path in private_paths}
+
+    def ignore(directory, names):
+        relative = os.path.relpath(directory, source)
+        return [name for name in names if os.path.normpath(os.path.join(relative, name)) in private]
+    return ignore
+
+def provision_worker(worker_id, mode=PROVISIONING, source=CTAKES_SOURCE, private_paths=PRIVATE_PATHS):
+    """
+    Create ./cTAKES/{source}_{worker_id} if it does not exist yet.
+    mode="copy" copies the whole cTAKES folder (like `cp -r`). mode="symlink" or "hardlink" links every file to
+    the shared folder instead and only copies `private_paths`, which takes a fraction of the time
+    and disk space. The tree is built under a temporary name and renamed once complete.
+    """
+    target = os.path.join(CTAKES_FOLDER, f"{source}_{worker_id}")
+    if os.path.isdir(target):
+        return target
+
+    partial = f"{target}.partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    if mode == "copy":
+        shutil.copytree(source, partial, symlinks=True)
+    else:
+        shutil.copytree(source, partial, symlinks=True, copy_function=link_function(mode), ignore=ignore_private_paths(source, private_paths))
+        for path in private_paths:
+            if os.path.isdir(os.path.join(source, path)):
+                shutil.copytree(os.path.join(source, path), os.path.join(partial, path), symlinks=True)
+            elif os.path.exists(os.path.join(source, path)):
+                shutil.copy2(os.path.join(source, path), os.path.join(partial, path))
+    os.rename(partial, target)
+    return target
+
+def verify_worker(target, source=CTAKES_SOURCE, private_paths=PRIVATE_PATHS):
+    """Return a list of problems that would keep the cTAKES folder `target` from running."""
+    problems = []
+    launcher = os.path.join(target, "bin", "runClinicalPipeline.sh")
+    if not os.path.isfile(launcher) or not os.access(launcher, os.X_OK):
+        problems.append(f"{launcher} is missing or not executable")
+
+    for path in private_paths:
+        source_path = os.path.join(source, path)
+        target_path = os.path.join(target, path)
+        if not os.path.exists(source_path):
+            continue
+        if os.path.islink(target_path) or not os.path.exists(target_path):
+            problems.append(f"{target_path} is not a private copy")
+            continue
+        # A private file must not share its inode with the shared folder
+        for directory, _, names in os.walk(target_path):
+            for name in names:
+                file_path = os.path.join(directory, name)
+                shared_path = os.path.join(source_path, os.path.relpath(file_path, target_path))
+                if os.path.islink(file_path) or (os.path.exists(shared_path) and os.path.samefile(file_path, shared_path)):
+                    problems.append(f"{file_path} is shared with {source}")
+
+    for directory, dir_names, names in os.walk(target):
+        for name in names + dir_names:
+            path = os.path.join(directory, name)
+            if os.path.islink(path) and not os.path.exists(path):
+                problems.append(f"{path} is a broken link")
+    return problems
+
+def inodes_under(path):
+    """Map (device, inode) -> allocated bytes of every file under `path`, not following symlinks."""
+    inodes = {}
+    for directory, _, names in os.walk(path):
+        for name in names:
+            stat = os.lstat(os.path.join(directory, name))
+            inodes[(stat.st_dev, stat.st_ino)] = stat.st_blocks * 512
+    return inodes
+
+def extra_disk_usage_bytes(path, source=CTAKES_SOURCE):
+    """Bytes allocated under `path` on top of the shared cTAKES folder (hard links count once)."""
+    shared = inodes_under(source)
+    return sum(size for inode, size in inodes_under(path).items() if inode not in shared)
+
+def main():
+    num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else config["num_processes"]
+    if PROVISIONING not in PROVISIONING_MODES:
+        raise ValueError(f"Unknown ctakes_provisioning '{PROVISIONING}'; expected one of {list(PROVISIONING_MODES)}")
+    if PROVISIONING == "none":
+        print("ctakes_provisioning is 'none'; no cTAKES folders to provision.")
+        return 0
+    if not os.path.isdir(CTAKES_SOURCE):
+        print(f"Error: cTAKES folder {CTAKES_SOURCE} not found!")
+        return 1
+    os.makedirs(CTAKES_FOLDER, exist_ok=True)
+
+    start_time = time.time()
+    failed = 0
+    for worker_id in range(1, num_workers + 1):
+        target = provision_worker(worker_id)
+        problems = verify_worker(target)
+        for problem in problems:
+            print(f"[{os.path.basename(target)}] {problem}")
+        failed += bool(problems)
+
+    print(f"Provisioned {num_workers} cTAKES folder(s) under {CTAKES_FOLDER} ({PROVISIONING}) in {time.time() - start_time:.1f} seconds; {extra_disk_usage_bytes(CTAKES_FOLDER) / 2**20:.1f} MB of extra disk space used.")
+    if failed:
+        print(f"Error: {failed} cTAKES folder(s) failed verification. Remove them and run again.")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
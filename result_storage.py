@@ -0,0 +1,142 @@
+import os
+import glob
+import time
+import pandas as pd
+
+try:
+    import pyarrow  # The engine pandas uses for Parquet and Feather
+except ImportError:
+    pyarrow = None
+
+# Storage of the FE feature tables ("result_format" in config.json).
+#
+# "csv" keeps the original layout: Pipeline Step 5 appends to one CSV per folder and feature.
+# "parquet" and "feather" store every table as a typed, compressed columnar file instead. Pipeline
+# Step 5 writes a new part file into the folder ./Result/Result_k/{feature}/fe_feature_detail_table_{feature}_k/
+# for every batch of XMI files (a partitioned table), and post processing reads only the columns it
+# needs. The final tables are also exported as CSV.
+
+RESULT_FORMATS = ("csv", "parquet", "feather")
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+# Columns with a handful of distinct values, stored as categoricals in the columnar formats
+CATEGORICAL_COLUMNS = ["FeatureID", "Feature", "FE_CodeType", "Confidence", "Feature_Status"]
+# A column with more distinct values than this, or than half its rows (e.g. the per-row FeatureIDs
+# of the final tables), is left as is
+MAX_CATEGORIES = 1000
+
+def check_result_format(result_format):
+    """Raise an error if `result_format` is unknown or its engine is not installed."""
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result_format '{result_format}'; expected one of {list(RESULT_FORMATS)}")
+    if result_format != "csv" and pyarrow is None:
+        raise ImportError(f'"result_format": "{result_format}" requires pyarrow. Install it (pip install pyarrow) or set "result_format": "csv".')
+
+def with_categories(df):
+    """Convert the low-cardinality columns of `df` to categoricals."""
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns and (isinstance(df[column].dtype, pd.CategoricalDtype) or df[column].nunique() <= min(MAX_CATEGORIES, len(df) // 2)):
+            df[column] = df[column].astype("category")
+    return df
+
+def write_table(df, path, result_format):
+    """Write `df` to the single file `path` in `result_format`."""
+    if result_format == "csv":
+        df.to_csv(path, index=False)
+    elif result_format == "parquet":
+        with_categories(df).to_parquet(path, index=False)
+    else:
+        with_categories(df).reset_index(drop=True).to_feather(path)
+
+def write_part(df, table_folder, result_format):
+    """Add `df` to the partitioned table `table_folder` as a new part file; return its path."""
+    os.makedirs(table_folder, exist_ok=True)
+    path = os.path.join(table_folder, f"part-{time.time_ns()}-{os.getpid()}{EXTENSIONS[result_format]}")
+    write_table(df, path, result_format)
+    return path
+
+def read_table(path, result_format, columns=None):
+    """
+    Read the table `path` (a single file, or the folder of a partitioned table) in `result_format`,
+    keeping only `columns` if given.
+    """
+    if result_format == "csv":
+        return pd.read_csv(path, usecols=columns)
+
+    paths = sorted(glob.glob(os.path.join(path, "*" + EXTENSIONS[result_format]))) if os.path.isdir(path) else [path]
+    read = pd.read_parquet if result_format == "parquet" else pd.read_feather
+    parts = [read(part, columns=columns) for part in paths]
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    # Concatenating categoricals with different categories falls back to object; convert them back
+    return with_categories(pd.concat(parts, ignore_index=True))
+
+def write_final_table(df, name, result_format):
+    """Write the table `name` (a path without extension) in `result_format`, and also as CSV; return the paths."""
+    paths = [name + EXTENSIONS[result_format]]
+    write_table(df, paths[0], result_format)
+    if result_format != "csv":
+        paths.append(name + ".csv")
+        df.to_csv(paths[1], index=False)
+    return paths
+
+def iter_table_batches(path, result_format, batch_rows, columns=None, csv_dtype=None):
+    """Yield the single-file table `path` as DataFrames of at most `batch_rows` rows (CSV columns are read as `csv_dtype`)."""
+    if result_format == "csv":
+        yield from pd.read_csv(path, usecols=columns, dtype=csv_dtype, chunksize=batch_rows)
+        return
+
+    if result_format == "parquet":
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns)
+    else:
+        import pyarrow.ipc as ipc
+        reader = ipc.open_file(path)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    for batch in batches:
+        df = batch.to_pandas()
+        yield df[columns] if columns else df
+
+class TableWriter:
+    """Writes a single-file table in `result_format` one DataFrame at a time (CSV gets one header)."""
+
+    def __init__(self, path, result_format):
+        self.path = path
+        self.result_format = result_format
+        self.file = open(path, "w", newline="") if result_format == "csv" else None
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+
+    def write(self, df):
+        if self.result_format == "csv":
+            df.to_csv(self.file, header=self.file.tell() == 0, index=False)
+        else:
+            table = pyarrow.Table.from_pandas(with_categories(df), preserve_index=False)
+            if self.writer is None:
+                self.schema = table.schema
+                if self.result_format == "parquet":
+                    import pyarrow.parquet as pq
+                    # Wide dictionary indices, so later DataFrames may bring more categories
+                    self.schema = pyarrow.schema([
+                        field.with_type(pyarrow.dictionary(pyarrow.int32(), field.type.value_type)) if pyarrow.types.is_dictionary(field.type) else field
+                        for field in self.schema
+                    ])
+                    self.writer = pq.ParquetWriter(self.path, self.schema)
+                else:
+                    import pyarrow.ipc as ipc
+                    # A Feather file allows only one dictionary per column, so the categoricals are stored decoded
+                    self.schema = pyarrow.schema([
+                        field.with_type(field.type.value_type) if pyarrow.types.is_dictionary(field.type) else field
+                        for field in self.schema
+                    ])
+                    self.writer = ipc.new_file(self.path, self.schema)
+            # The categories (and so the dictionary index width) may differ between DataFrames
+            table = table.cast(self.schema)
+            self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,53 @@
+import os
+import zlib
+
+# Layout of the note, chunk and XMI folders ("directory_shards" in config.json).
+#
+# With 0 every folder (./Input/Input_k, ./Input_chunk/Input_k, ./Output/Output_k) is flat, as cTAKES
+# expects. With N > 0 the Python stages put every file into one of N subdirectories named after a
+# hash of its file name (e.g. ./Input_chunk/Input_1/a7/{name}), so that no directory holds more
+# than a fraction of the files. cTAKES still reads and writes flat directories: the queue scheduler
+# stages every batch into a flat folder per worker.
+#
+# Listing is layout-agnostic: iter_files streams the files of a folder, flat or sharded, in one
+# os.scandir pass per directory.
+
+def shard_name(file_name, shards=0):
+    """Return the subdirectory `file_name` belongs to (a stable hash of the name, in hex)."""
+    width = len(f"{shards - 1:x}")
+    return f"{zlib.crc32(file_name.encode('utf-8')) % shards:0{width}x}"
+
+def file_path(folder, file_name, shards=0):
+    """Return the path of `file_name` in `folder`."""
+    if not shards:
+        return os.path.join(folder, file_name)
+    return os.path.join(folder, shard_name(file_name, shards), file_name)
+
+# Directories known to exist, so that creating many files does not stat the same few directories
+_existing_directories = set()
+
+def new_file_path(folder, file_name, shards=0):
+    """Like file_path, creating the directory the file goes into if needed."""
+    path = file_path(folder, file_name, shards)
+    directory = os.path.dirname(path)
+    if directory not in _existing_directories:
+        os.makedirs(directory, exist_ok=True)
+        _existing_directories.add(directory)
+    return path
+
+def iter_files(folder, suffix=""):
+    """
+    Yield (file name, path) for every file of `folder` (and of its shard subdirectories) whose
+    name ends with `suffix`, streaming the entries instead of building a list. Yields nothing if
+    `folder` does not exist.
+    """
+    try:
+        entries = os.scandir(folder)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path, suffix)
+            elif entry.name.endswith(suffix):
+                yield entry.name, entry.path
@@ -0,0 +1,131 @@
+import os
+import sys
+import glob
+import time
+import json
+import argparse
+import regex
+from xml.sax.saxutils import quoteattr
+
+# A lightweight stand-in for cTAKES' runClinicalPipeline.sh, for exercising and benchmarking the
+# pipeline without a cTAKES install. For every {name} in the input folder it writes {name}.xmi to
+# the output folder, with a refsem:UmlsConcept and a textsem:DiseaseDisorderMention for every
+# dictionary term of ./CUI/*_umls_cui_clean.txt found in the text (case-insensitive).
+# With --serve it runs as a persistent annotator instead (see annotators.py for the protocol).
+
+CUI_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CUI")
+
+XMI_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<xmi:XMI xmlns:xmi="http://www.omg.org/XMI" xmlns:cas="http:///uima/cas.ecore"'
+    ' xmlns:refsem="http:///org/apache/ctakes/typesystem/type/refsem.ecore"'
+    ' xmlns:textsem="http:///org/apache/ctakes/typesystem/type/textsem.ecore" xmi:version="2.0">'
+)
+
+NEGATION_RE = regex.compile(r"\b(?:no|denies|denied|without|negative for)\W+(?:\w+\W+){0,3}$", regex.IGNORECASE)
+HISTORY_RE = regex.compile(r"\b(?:history of|hx of|h/o)\W+(?:\w+\W+){0,3}$", regex.IGNORECASE)
+FAMILY_RE = regex.compile(r"\b(?:mother|father|brother|sister|family)\b[^.\n]*$", regex.IGNORECASE)
+
+def load_dictionary(cui_folder=CUI_FOLDER):
+    """Read every `term | CUI` line of the CUI dictionaries into {lowercase term: CUI}."""
+    dictionary = {}
+    for path in sorted(glob.glob(os.path.join(cui_folder, "*_umls_cui_clean.txt"))):
+        with open(path, "r") as file:
+            for line in file:
+                term, _, cui = line.rpartition("|")
+                if term.strip():
+                    dictionary[term.strip().lower()] = cui.strip()
+    return dictionary
+
+def build_term_pattern(dictionary):
+    """Compile one case-insensitive alternation of all dictionary terms, longest first."""
+    terms = sorted(dictionary, key=len, reverse=True)
+    return regex.compile(r"\b(?:" + "|".join(regex.escape(term) for term in terms) + r")\b", regex.IGNORECASE)
+
+def annotate_text(text, dictionary, term_pattern):
+    """Return the XMI document for `text`."""
+    parts = [XMI_HEADER, f'<cas:Sofa xmi:id="1" sofaNum="1" sofaID="_InitialView" mimeType="text" sofaString={quoteattr(text)}/>']
+    next_id = 2
+    for match in term_pattern.finditer(text):
+        prefix = text[max(0, match.start() - 80):match.start()]
+        polarity = "-1" if NEGATION_RE.search(prefix) else "1"
+        history_of = "1" if HISTORY_RE.search(prefix) else "0"
+        subject = "family_member" if FAMILY_RE.search(prefix) else "patient"
+        concept_id, mention_id = next_id, next_id + 1
+        next_id += 2
+        parts.append(
+            f'<refsem:UmlsConcept xmi:id="{concept_id}" codingScheme="SNOMEDCT_US"'
+            f' cui="{dictionary[match.group().lower()]}" tui="T047"/>'
+        )
+        parts.append(
+            f'<textsem:DiseaseDisorderMention xmi:id="{mention_id}" sofa="1" begin="{match.start()}" end="{match.end()}"'
+            f' ontologyConceptArr="{concept_id}" polarity="{polarity}" conditional="false" subject="{subject}"'
+            f' historyOf="{history_of}" confidence="0.0"/>'
+        )
+    parts.append("</xmi:XMI>")
+    return "".join(parts)
+
+def annotate_folder(input_folder, output_folder, dictionary, term_pattern, delay_seconds=0.0, stall_bytes=0):
+    """
+    Annotate every file of `input_folder` into `output_folder`; return the number of files annotated.
+    If `stall_bytes` is set, hang forever on a file larger than that, as cTAKES may on a large chunk.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    count = 0
+    for entry in sorted(os.scandir(input_folder), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        if stall_bytes and entry.stat().st_size > stall_bytes:
+            while True:
+                time.sleep(60)
+        with open(entry.path, "r", encoding="utf-8") as file:
+            xmi = annotate_text(file.read(), dictionary, term_pattern)
+        if delay_seconds:
+            time.sleep(delay_seconds)
+        with open(os.path.join(output_folder, f"{entry.name}.xmi"), "w", encoding="utf-8") as file:
+            file.write(xmi)
+        count += 1
+    return count
+
+def serve(dictionary, term_pattern, delay_seconds=0.0, stall_bytes=0):
+    """Answer one {"input": ..., "output": ...} request per stdin line until stdin is closed."""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            count = annotate_folder(request["input"], request["output"], dictionary, term_pattern, delay_seconds, stall_bytes)
+            reply = {"status": "ok", "count": count}
+        except Exception as e:
+            reply = {"status": "error", "error": str(e)}
+        sys.stdout.write(json.dumps(reply) + "\n")
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for runClinicalPipeline.sh that emits cTAKES-style XMI.")
+    parser.add_argument("-i", "--inputDir", help="folder of input text files")
+    parser.add_argument("--xmiOut", help="folder to write {name}.xmi files to")
+    parser.add_argument("--serve", action="store_true", help="run as a persistent annotator reading requests from stdin")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to sleep per file, to simulate annotation cost")
+    parser.add_argument("--stall-bytes", type=int, default=0, help="hang on input files larger than this many bytes, to simulate cTAKES stalling")
+    parser.add_argument("--startup-delay", type=float, default=0.0, help="seconds to sleep at start-up, to simulate JVM and dictionary loading")
+    # Accept and ignore the UMLS credentials runClinicalPipeline.sh takes
+    parser.add_argument("--user")
+    parser.add_argument("--pass", dest="password")
+    parser.add_argument("--key")
+    args = parser.parse_args()
+    if not args.serve and not (args.inputDir and args.xmiOut):
+        parser.error("-i and --xmiOut are required unless --serve is given")
+
+    time.sleep(args.startup_delay)
+    dictionary = load_dictionary()
+    term_pattern = build_term_pattern(dictionary)
+    if args.serve:
+        serve(dictionary, term_pattern, args.delay, args.stall_bytes)
+        return
+
+    count = annotate_folder(args.inputDir, args.xmiOut, dictionary, term_pattern, args.delay, args.stall_bytes)
+    print(f"Stub annotator wrote {count} XMI file(s) to {args.xmiOut}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import itertools
+
+# Dynamic scheduling of the files of Pipeline Steps 2, 4 and 5.
+#
+# Instead of one task per folder, which leaves every process but one idle while the largest
+# folder (or the one with a few giant XMI files) finishes, the files of all folders are split into
+# batches that the processes take from a shared queue (Pool.imap_unordered), so that a step takes
+# about as long as its total work divided by the processes. A batch never mixes folders, so the
+# per-folder outputs keep their layout.
+
+# Batches per process, so that the last batches of a step are small next to the whole step
+BATCHES_PER_PROCESS = 16
+
+def batch_size(total, processes, min_size, max_size):
+    """Return the batch size that gives every one of `processes` about BATCHES_PER_PROCESS of `total` files, within [min_size, max_size]."""
+    return max(min_size, min(max_size, -(-total // (processes * BATCHES_PER_PROCESS))))
+
+def split_batches(folder_files, size):
+    """
+    Split `folder_files`, {folder_index: [file, ...]}, into (folder_index, [file, ...]) batches of
+    at most `size` files. The batches of different folders are interleaved, so that every folder
+    makes progress.
+    """
+    folder_batches = [
+        [(folder_index, files[i:i + size]) for i in range(0, len(files), size)]
+        for folder_index, files in folder_files.items()
+    ]
+    return [batch for batches in itertools.zip_longest(*folder_batches) for batch in batches if batch is not None]